@@ -0,0 +1,225 @@
+import glob
+import os
+import re
+from typing import Iterable, Iterator, List, Optional
+
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ARTIFACT_FORMATS = ("jsonl", "parquet")
+DEFAULT_MAX_RECORDS = 100_000
+DEFAULT_ROW_GROUP_SIZE = 10_000
+TMP_SUFFIX = ".tmp"
+# Parquet schema metadata listing the columns stored as JSON text
+JSON_COLUMNS_KEY = b"artifact_json_columns"
+
+
+def _part_number(path: str, name: str) -> Optional[int]:
+    match = re.fullmatch(re.escape(name) + r"-(\d+)\.(?:jsonl|parquet)", os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+
+class ArtifactWriter:
+
+    def __init__(self, directory: str, name: str, format: str = "jsonl", max_records: int = DEFAULT_MAX_RECORDS, row_group_size: int = DEFAULT_ROW_GROUP_SIZE):
+        """
+        Initializes the ArtifactWriter class, streaming records (sections, hierarchies, extracted entities) to numbered part files.
+        Every part is written under a temporary name and renamed once complete, so readers never see a partial file.
+        Parts are numbered after those already in the directory, so a new run never overwrites the previous ones.
+
+        Parameters:
+        directory (str): The output directory. It is created if missing.
+        name (str): The artifact name, used as the prefix of the part files, e.g. "sections" for sections-00000.jsonl.
+        format (str): "jsonl" for JSON Lines written with orjson, "parquet" for Parquet row groups. Nested values are stored as JSON text.
+        The Parquet schema is inferred from the rows; a row group with new columns or wider types starts a new part with the widened schema.
+        max_records (int): The number of records after which the current part is closed and a new one started.
+        row_group_size (int): The number of records per Parquet row group.
+        """
+        if format not in ARTIFACT_FORMATS:
+            raise ValueError(f"Unsupported artifact format: {format}. Possible values are {ARTIFACT_FORMATS}.")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.format = format
+        self.max_records = max_records
+        self.row_group_size = row_group_size
+        existing = [number for path in os.listdir(directory) if (number := _part_number(path, name)) is not None]
+        self.next_part = max(existing, default=-1) + 1
+        self.parts: List[str] = []
+        self.records = 0
+        self._file = None
+        self._parquet_writer: Optional[pq.ParquetWriter] = None
+        self._schema: Optional[pa.Schema] = None
+        self._json_columns: List[str] = []
+        self._rows: List[dict] = []
+        self._part_records = 0
+        self._path: Optional[str] = None
+
+    @staticmethod
+    def _widen(schema: pa.Schema, new: pa.Schema) -> pa.Schema:
+        try:
+            return pa.unify_schemas([schema, new], promote_options="permissive")
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Incompatible types, e.g. a column nested from now on: the new type replaces the old one
+            return pa.schema([new.field(name) if name in new.names else schema.field(name) for name in schema.names]
+                             + [field for field in new if field.name not in schema.names])
+
+    def _open(self) -> None:
+        self._path = os.path.join(self.directory, f"{self.name}-{self.next_part:05d}.{self.format}")
+        self.next_part += 1
+        self._part_records = 0
+        if self.format == "jsonl":
+            self._file = open(self._path + TMP_SUFFIX, "wb")
+
+    def _flush_rows(self) -> None:
+        if not self._rows:
+            return
+        # Nested values do not have a stable Parquet type across records, so they are stored as JSON text
+        json_columns = set(self._json_columns) | {key for row in self._rows for key, value in row.items() if isinstance(value, (dict, list))}
+        # Columns are taken from every row, not only the first one, and their types are inferred one column at a time
+        columns = list(dict.fromkeys(key for row in self._rows for key in row))
+        fields = []
+        for column in columns:
+            if column not in json_columns:
+                try:
+                    fields.append(pa.field(column, pa.array([row.get(column) for row in self._rows]).type))
+                    continue
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    # Mixed scalar types, e.g. 3 and "3", are stored as JSON text so every value is read back with its own type
+                    json_columns.add(column)
+            fields.append(pa.field(column, pa.string()))
+        schema = pa.schema(fields)
+        json_columns = sorted(json_columns)
+        rows = [{key: orjson.dumps(value).decode("utf-8") if key in json_columns and value is not None else value for key, value in row.items()}
+                for row in self._rows]
+        if self._schema is not None:
+            schema = self._widen(self._schema.remove_metadata(), schema)
+        if self._parquet_writer is not None and (not schema.equals(self._schema.remove_metadata()) or json_columns != self._json_columns):
+            # A Parquet file has a single schema, so new columns or wider types go to a new part
+            self._rename_part()
+            self._open()
+            self._part_records = len(rows)
+        self._json_columns = json_columns
+        self._schema = schema.with_metadata({JSON_COLUMNS_KEY: orjson.dumps(json_columns)})
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self._path + TMP_SUFFIX, self._schema)
+        self._parquet_writer.write_table(pa.Table.from_pylist(rows, schema=self._schema))
+        self._rows = []
+
+    def _rename_part(self) -> None:
+        if self.format == "jsonl":
+            self._file.close()
+            self._file = None
+        else:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        os.replace(self._path + TMP_SUFFIX, self._path)
+        self.parts.append(self._path)
+        self._path = None
+
+    def _close_part(self) -> None:
+        if self._path is None:
+            return
+        if self.format == "parquet":
+            self._flush_rows()
+            if self._parquet_writer is None:
+                self._path = None
+                return
+        self._rename_part()
+
+    def discard(self) -> None:
+        """
+        Drops the current, incomplete part. The parts already completed are kept.
+        """
+        if self._path is None:
+            return
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if os.path.exists(self._path + TMP_SUFFIX):
+            os.remove(self._path + TMP_SUFFIX)
+        self._rows = []
+        self._path = None
+
+    def write(self, record: dict) -> None:
+        if self._path is None:
+            self._open()
+        if self.format == "jsonl":
+            self._file.write(orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE))
+        else:
+            self._rows.append(record)
+        self.records += 1
+        self._part_records += 1
+        if self.format == "parquet" and len(self._rows) >= self.row_group_size:
+            self._flush_rows()
+        if self._part_records >= self.max_records:
+            self._close_part()
+
+    def write_many(self, records: Iterable[dict]) -> None:
+        for record in records:
+            self.write(record)
+
+    def close(self) -> List[str]:
+        """
+        Completes the current part.
+
+        Returns:
+        List[str]: The paths of all the parts written.
+        """
+        self._close_part()
+        return self.parts
+
+    def __enter__(self) -> "ArtifactWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # A part interrupted by an error is not renamed into place
+        if exc_type is not None:
+            self.discard()
+        self.close()
+
+
+def artifact_paths(path: str, name: Optional[str] = None) -> List[str]:
+    """
+    Lists the complete part files of an artifact, in order. Temporary parts of an interrupted writer are ignored.
+
+    Parameters:
+    path (str): A part file, a glob or the directory of the artifact.
+    name (str): The artifact name, when path is a directory holding several artifacts.
+
+    Returns:
+    List[str]: The part files.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, f"{name or '*'}-*")
+    return sorted(p for p in glob.glob(path) if p.endswith((".jsonl", ".parquet")))
+
+
+def iter_artifact(path: str, name: Optional[str] = None, batch_size: int = DEFAULT_ROW_GROUP_SIZE) -> Iterator[dict]:
+    """
+    Reads the records of an artifact lazily: JSON Lines one line at a time, Parquet one batch of rows at a time.
+
+    Parameters:
+    path (str): A part file, a glob or the directory of the artifact.
+    name (str): The artifact name, when path is a directory holding several artifacts.
+    batch_size (int): The number of Parquet rows decoded at once.
+
+    Returns:
+    Iterator[dict]: The records, in the order they were written.
+    """
+    for part in artifact_paths(path, name):
+        if part.endswith(".jsonl"):
+            with open(part, "rb") as f:
+                for line in f:
+                    if line.strip():
+                        yield orjson.loads(line)
+            continue
+        parquet_file = pq.ParquetFile(part)
+        json_columns = set(orjson.loads((parquet_file.schema_arrow.metadata or {}).get(JSON_COLUMNS_KEY, b"[]")))
+        for batch in parquet_file.iter_batches(batch_size=batch_size):
+            for row in batch.to_pylist():
+                yield {key: orjson.loads(value) if key in json_columns and value is not None else value for key, value in row.items()}
@@ -0,0 +1,165 @@
+import asyncio
+import random
+from functools import lru_cache
+from typing import Dict, List, Optional, Type
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.prompts import ChatPromptTemplate
+from pydantic import BaseModel, Field, create_model
+
+import rate_limiter
+from llm_ledger import BudgetExceededError, LLMLedger
+
+DEFAULT_BATCH_TOKENS = 6000
+DEFAULT_MAX_SECTIONS = 8
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_MAX_CONCURRENCY = 4
+
+batch_prompt = ChatPromptTemplate.from_messages([
+    ("system", "{instructions}\n"
+               "You receive several independent sections, each one wrapped in a <section id=\"...\"> tag. "
+               "Extract the entities of every section on its own, using only the text of that section, "
+               "and return exactly one result per section with the id of the section."),
+    ("user", "{sections}")]
+)
+
+
+@lru_cache(maxsize=None)
+def batch_schema(output_class: Type[BaseModel]) -> Type[BaseModel]:
+    """
+    Builds the structured output schema of a batch: one output_class object per section id.
+
+    Parameters:
+    output_class (Type[BaseModel]): The schema extracted from a single section, e.g. EntityContainer.
+
+    Returns:
+    Type[BaseModel]: The batch schema, with a "sections" list of "section_id" and "entities" pairs.
+    """
+    section_result = create_model(f"{output_class.__name__}Section",
+                                  section_id=(str, Field(..., description="The id of the section, exactly as given")),
+                                  entities=(output_class, Field(..., description="The entities extracted from the section")))
+    return create_model(f"{output_class.__name__}Batch",
+                        sections=(List[section_result], Field(..., description="One result for every section")))
+
+
+def pack_sections(sections: List[dict], max_tokens: int = DEFAULT_BATCH_TOKENS, max_sections: int = DEFAULT_MAX_SECTIONS, model_name: Optional[str] = None) -> List[List[dict]]:
+    """
+    Packs sections, in order, into batches under a token budget. A section larger than the budget gets a batch of its own.
+
+    Parameters:
+    sections (List[dict]): The sections, with an "id" and a "text".
+    max_tokens (int): The budget of the section text of every batch, in tokens.
+    max_sections (int): The maximum number of sections per batch.
+    model_name (str): The model whose tokenizer is used for the estimate.
+
+    Returns:
+    List[List[dict]]: The batches.
+    """
+    batches, batch, batch_tokens = [], [], 0
+    for section in sections:
+        tokens = rate_limiter.estimate_tokens(section["text"], model_name)
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_sections):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(section)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class BatchExtractor:
+
+    def __init__(self, llm: BaseChatModel, output_class: Type[BaseModel], instructions: str, max_tokens: int = DEFAULT_BATCH_TOKENS,
+                 max_sections: int = DEFAULT_MAX_SECTIONS, max_attempts: int = DEFAULT_MAX_ATTEMPTS, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 ledger: Optional[LLMLedger] = None):
+        """
+        Initializes the BatchExtractor class, extracting several sections per structured output request.
+        Batches that fail, or whose response misses some sections, are split and the missing sections retried, so every section keeps its own result.
+
+        Parameters:
+        llm (BaseChatModel): The language model.
+        output_class (Type[BaseModel]): The schema extracted from each section.
+        instructions (str): The system instructions of a single-section extraction, e.g. the entity list.
+        max_tokens (int): The budget of the section text of every request, in tokens.
+        max_sections (int): The maximum number of sections per request.
+        max_attempts (int): The number of attempts of a single section before it is reported as failed.
+        max_concurrency (int): The maximum number of requests in flight.
+        ledger (LLMLedger): If given, every request is recorded in it and its token budgets are enforced.
+        """
+        self.llm = llm
+        self.output_class = output_class
+        self.instructions = instructions
+        self.max_tokens = max_tokens
+        self.max_sections = max_sections
+        self.max_attempts = max_attempts
+        self.ledger = ledger
+        self.concurrency = asyncio.Semaphore(max_concurrency)
+        self.chain = batch_prompt | llm.with_structured_output(batch_schema(output_class))
+        self.stats = {"sections": 0, "requests": 0, "splits": 0, "retries": 0, "failed": 0}
+        self.errors: Dict[str, BaseException] = {}
+
+    def _config(self, batch: List[dict]) -> Optional[dict]:
+        if self.ledger is None:
+            return None
+        sources = {section.get("source") for section in batch}
+        return self.ledger.config("batch_extraction", sources.pop() if len(sources) == 1 else None, ",".join(str(section["id"]) for section in batch))
+
+    async def _request(self, batch: List[dict]) -> Dict[str, BaseModel]:
+        # Sections get short positional ids in the prompt, mapped back to the caller ids
+        local_ids = {f"S{i + 1}": section["id"] for i, section in enumerate(batch)}
+        sections = "\n".join(f"<section id=\"{local_id}\">\n{section['text']}\n</section>" for local_id, section in zip(local_ids, batch))
+        async with self.concurrency:
+            self.stats["requests"] += 1
+            response = await self.chain.ainvoke({"instructions": self.instructions, "sections": sections}, config=self._config(batch))
+        return {local_ids[item.section_id]: item.entities for item in response.sections if item.section_id in local_ids}
+
+    async def _extract(self, batch: List[dict], attempt: int = 0) -> Dict[str, BaseModel]:
+        error = None
+        rate_limiter.current_attempt.set(attempt)
+        try:
+            results = await self._request(batch)
+        except BudgetExceededError:
+            raise
+        except Exception as e:
+            results, error = {}, e
+        missing = [section for section in batch if section["id"] not in results]
+        if not missing:
+            return results
+        if len(missing) > 1:
+            # Partial or failed batches are halved, so a single bad section cannot keep failing the others
+            self.stats["splits"] += 1
+            middle = len(missing) // 2
+            for retried in await asyncio.gather(self._extract(missing[:middle]), self._extract(missing[middle:])):
+                results.update(retried)
+            return results
+        if attempt + 1 < self.max_attempts:
+            self.stats["retries"] += 1
+            await asyncio.sleep(2 ** attempt * (0.5 + random.random()))
+            results.update(await self._extract(missing, attempt + 1))
+            return results
+        self.stats["failed"] += 1
+        self.errors[missing[0]["id"]] = error or ValueError("The section is missing from the response.")
+        print(f"Extraction failed for section {missing[0]['id']}: {self.errors[missing[0]['id']]}")
+        return results
+
+    async def aextract(self, sections: List[dict]) -> Dict[str, BaseModel]:
+        """
+        Extracts every section, packing them into as few requests as the token budget allows. Batches are sent concurrently.
+
+        Parameters:
+        sections (List[dict]): The sections, with a unique "id", their "text" and optionally their "source" file. They may come from several documents.
+
+        Returns:
+        Dict[str, BaseModel]: The result of every section by id. Sections that failed after all attempts are left out, with their error in self.errors.
+        self.errors only holds the failures of the last call.
+        """
+        if len({section["id"] for section in sections}) != len(sections):
+            raise ValueError("Section ids must be unique.")
+        self.errors = {}
+        self.stats["sections"] += len(sections)
+        batches = pack_sections(sections, self.max_tokens, self.max_sections, getattr(self.llm, "model_name", None))
+        results = {}
+        for batch_results in await asyncio.gather(*[self._extract(batch) for batch in batches]):
+            results.update(batch_results)
+        return results
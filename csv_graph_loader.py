@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Union
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+from neo4j import Driver, GraphDatabase
+
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_BLOCK_SIZE = 8 << 20
+DEFAULT_ID_PROPERTY = "id"
+KEY_SEPARATOR = "|"
+
+NODE_QUERY = "UNWIND $rows AS row MERGE (n:`{label}` {{`{id_property}`: row.key}}) SET n += row.properties"
+RELATIONSHIP_QUERY = ("UNWIND $rows AS row "
+                      "MERGE (s:`{from_label}` {{`{from_id}`: row.source}}) "
+                      "MERGE (t:`{to_label}` {{`{to_id}`: row.target}}) "
+                      "MERGE (s)-[r:`{type}`]->(t) SET r += row.properties")
+
+
+def load_mapping(path: str) -> dict:
+    """
+    Loads a declarative CSV-to-graph mapping file.
+
+    The mapping is a JSON object with a "tables" list. Every table names a CSV "file" and lists the "nodes" and
+    "relationships" produced by each of its rows. A node has a "label", a "key" (a column name or a list of columns
+    joined into a composite key) and a "properties" object mapping graph properties to columns. A relationship has a
+    "type", "from" and "to" endpoints (each with "label" and "key") and optional "properties".
+
+    Parameters:
+    path (str): The path to the mapping file.
+
+    Returns:
+    dict: The mapping.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        mapping = json.load(f)
+    if not mapping.get("tables"):
+        raise ValueError(f"Mapping {path} does not define any table.")
+    return mapping
+
+
+def _key_columns(key: Union[str, List[str]]) -> List[str]:
+    return [key] if isinstance(key, str) else list(key)
+
+
+def _table_columns(table: dict) -> List[str]:
+    """
+    Collects the CSV columns a table mapping reads, so that only those are parsed.
+    """
+    columns = []
+    for node in table.get("nodes", []):
+        columns.extend(_key_columns(node["key"]))
+        columns.extend(node.get("properties", {}).values())
+    for rel in table.get("relationships", []):
+        columns.extend(_key_columns(rel["from"]["key"]))
+        columns.extend(_key_columns(rel["to"]["key"]))
+        columns.extend(rel.get("properties", {}).values())
+    return list(dict.fromkeys(columns))
+
+
+def iter_csv_batches(path: str, columns: Optional[List[str]] = None, block_size: int = DEFAULT_BLOCK_SIZE) -> Iterator[pa.RecordBatch]:
+    """
+    Streams a CSV file as record batches of whitespace-trimmed string columns, without loading the whole file.
+    Values are kept as strings so zero-padded codes survive untouched; empty values become nulls.
+
+    Parameters:
+    path (str): The path to the CSV file.
+    columns (List[str]): The columns to read. Default is all columns.
+    block_size (int): The number of bytes parsed per batch.
+
+    Returns:
+    Iterator[pa.RecordBatch]: The batches of the file.
+    """
+    if columns is None:
+        columns = pv.open_csv(path, read_options=pv.ReadOptions(block_size=block_size)).schema.names
+    reader = pv.open_csv(path,
+                         read_options=pv.ReadOptions(block_size=block_size),
+                         convert_options=pv.ConvertOptions(include_columns=columns,
+                                                           column_types={column: pa.string() for column in columns},
+                                                           strings_can_be_null=True))
+    for batch in reader:
+        arrays = []
+        for array in batch.columns:
+            trimmed = pc.utf8_trim_whitespace(array)
+            arrays.append(pc.if_else(pc.equal(trimmed, ""), pa.scalar(None, pa.string()), trimmed))
+        yield pa.RecordBatch.from_arrays(arrays, names=batch.schema.names)
+
+
+def _row_key(row: dict, key: Union[str, List[str]]) -> Optional[str]:
+    values = [row.get(column) for column in _key_columns(key)]
+    if any(value is None for value in values):
+        return None
+    return KEY_SEPARATOR.join(values)
+
+
+def _row_properties(row: dict, properties: Dict[str, str]) -> dict:
+    return {name: row[column] for name, column in properties.items() if row.get(column) is not None}
+
+
+class CsvGraphLoader:
+
+    def __init__(self, driver: Driver, database: Optional[str] = None, batch_size: int = DEFAULT_BATCH_SIZE, block_size: int = DEFAULT_BLOCK_SIZE):
+        """
+        Initializes the CsvGraphLoader class.
+
+        Parameters:
+        driver (Driver): The Neo4j driver to write with.
+        database (str): The Neo4j database to write into. Default is the server default database.
+        batch_size (int): The number of rows sent in every UNWIND transaction.
+        block_size (int): The number of CSV bytes parsed per batch.
+        """
+        self.driver = driver
+        self.database = database
+        self.batch_size = batch_size
+        self.block_size = block_size
+
+    def _flush(self, query: str, rows: List[dict]) -> None:
+        if not rows:
+            return
+        with self.driver.session(database=self.database) as session:
+            session.execute_write(lambda tx: tx.run(query, rows=rows).consume())
+        rows.clear()
+
+    def load_table(self, path: str, table: dict) -> Dict[str, int]:
+        """
+        Streams one CSV file into the graph according to its table mapping.
+
+        Parameters:
+        path (str): The path to the CSV file.
+        table (dict): The table mapping.
+
+        Returns:
+        Dict[str, int]: The number of rows read and of node and relationship rows written.
+        """
+        statements = []
+        for node in table.get("nodes", []):
+            query = NODE_QUERY.format(label=node["label"], id_property=node.get("id_property", DEFAULT_ID_PROPERTY))
+            statements.append(("nodes", node, query, []))
+        for rel in table.get("relationships", []):
+            query = RELATIONSHIP_QUERY.format(from_label=rel["from"]["label"],
+                                              from_id=rel["from"].get("id_property", DEFAULT_ID_PROPERTY),
+                                              to_label=rel["to"]["label"],
+                                              to_id=rel["to"].get("id_property", DEFAULT_ID_PROPERTY),
+                                              type=rel["type"])
+            statements.append(("relationships", rel, query, []))
+
+        counts = {"rows": 0, "nodes": 0, "relationships": 0}
+        for batch in iter_csv_batches(path, _table_columns(table), self.block_size):
+            for row in batch.to_pylist():
+                counts["rows"] += 1
+                for kind, spec, query, buffer in statements:
+                    properties = _row_properties(row, spec.get("properties", {}))
+                    if kind == "nodes":
+                        key = _row_key(row, spec["key"])
+                        if key is None:
+                            continue
+                        buffer.append({"key": key, "properties": properties})
+                    else:
+                        source, target = _row_key(row, spec["from"]["key"]), _row_key(row, spec["to"]["key"])
+                        if source is None or target is None:
+                            continue
+                        buffer.append({"source": source, "target": target, "properties": properties})
+                    counts[kind] += 1
+                    if len(buffer) >= self.batch_size:
+                        self._flush(query, buffer)
+        for _, _, query, buffer in statements:
+            self._flush(query, buffer)
+        return counts
+
+    def load(self, mapping: dict, data_directory: str = "") -> None:
+        """
+        Loads every table of a mapping into the graph. Node tables are listed first in the mapping, but endpoints are
+        MERGEd, so relationships never depend on the table order.
+
+        Parameters:
+        mapping (dict): The mapping returned by load_mapping.
+        data_directory (str): The directory containing the CSV files.
+
+        Returns:
+        None
+        """
+        for table in mapping["tables"]:
+            path = os.path.join(data_directory, table["file"])
+            print(f"Loading {path} ...")
+            start = time.perf_counter()
+            counts = self.load_table(path, table)
+            elapsed = time.perf_counter() - start
+            print(f"Loaded {counts['rows']} rows ({counts['nodes']} nodes, {counts['relationships']} relationships) in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream the export_data CSV files into Neo4j.")
+    parser.add_argument("mapping", help="Path to the JSON mapping file.")
+    parser.add_argument("--data-dir", default="export_data", help="Directory containing the CSV files.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    neo4j_driver = GraphDatabase.driver(os.environ["NEO4J_URI"], auth=(os.environ["NEO4J_USERNAME"], os.environ["NEO4J_PASSWORD"]))
+    try:
+        CsvGraphLoader(neo4j_driver, database=os.environ.get("NEO4J_DB_NAME"), batch_size=args.batch_size).load(load_mapping(args.mapping), args.data_dir)
+    finally:
+        neo4j_driver.close()
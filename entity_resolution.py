@@ -0,0 +1,164 @@
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.graphs.graph_document import GraphDocument, Node
+
+from text_vectors import HashedCharNgramVectorizer, normalize_text
+
+DEFAULT_RESOLVED_LABELS = ("Ingrediente", "Tecnica", "Piatto")
+EXACT_SEARCH_LIMIT = 20000
+
+
+class _UnionFind:
+
+    def __init__(self, size: int):
+        self.parent = np.arange(size)
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, a: int, b: int) -> None:
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+
+def _build_index(vectors: np.ndarray) -> faiss.Index:
+    """
+    Builds an inner-product faiss index. Exact search for small inputs, HNSW above EXACT_SEARCH_LIMIT vectors.
+    """
+    dim = vectors.shape[1]
+    if len(vectors) <= EXACT_SEARCH_LIMIT:
+        index = faiss.IndexFlatIP(dim)
+    else:
+        index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efSearch = 64
+    index.add(vectors)
+    return index
+
+
+def resolve_names(names: Iterable[str], threshold: float = 0.85, k: int = 10, n_features: int = 256) -> Dict[str, str]:
+    """
+    Groups spelling, casing and accent variants of the same name and maps each variant to a canonical one.
+    Names sharing the same normalized form are merged directly; the remaining candidates come from a k-nearest-neighbour
+    search over character n-gram TF-IDF vectors, so the cost grows with len(names) * k instead of len(names) ** 2.
+
+    Parameters:
+    names (Iterable[str]): The names to resolve. Repetitions count as votes for the canonical spelling.
+    threshold (float): Minimum cosine similarity for two names to be considered the same entity.
+    k (int): Number of neighbours inspected per name.
+    n_features (int): Dimension of the hashed n-gram vectors.
+
+    Returns:
+    Dict[str, str]: A mapping from every input name to its canonical name.
+    """
+    counts = Counter(name for name in names if name)
+    if not counts:
+        return {}
+    by_key = defaultdict(list)
+    for name in counts:
+        by_key[normalize_text(name)].append(name)
+    keys = list(by_key.keys())
+
+    groups = _UnionFind(len(keys))
+    if len(keys) > 1:
+        vectors = HashedCharNgramVectorizer(n_features=n_features).fit_transform(keys)
+        index = _build_index(vectors)
+        similarities, neighbours = index.search(vectors, min(k + 1, len(keys)))
+        rows, cols = np.nonzero((similarities >= threshold) & (neighbours >= 0))
+        for row, col in zip(rows, neighbours[rows, cols]):
+            if row != col:
+                groups.union(int(row), int(col))
+
+    members = defaultdict(list)
+    for i, key in enumerate(keys):
+        members[groups.find(i)].extend(by_key[key])
+
+    mapping = {}
+    for variants in members.values():
+        # Most frequent spelling wins, ties go to the alphabetically first one to keep runs deterministic
+        canonical = min(variants, key=lambda v: (-counts[v], v))
+        for variant in variants:
+            mapping[variant] = canonical
+    return mapping
+
+
+def resolve_graph_documents(docs: List[GraphDocument],
+                            labels: Optional[Iterable[str]] = DEFAULT_RESOLVED_LABELS,
+                            threshold: float = 0.85,
+                            k: int = 10) -> Tuple[List[GraphDocument], Dict[str, Dict[str, str]]]:
+    """
+    Rewrites node IDs and relationship endpoints of graph documents to canonical IDs, resolving variants per label.
+
+    Parameters:
+    docs (List[GraphDocument]): The graph documents produced by the LLMGraphTransformer. They are modified in place.
+    labels (Iterable[str]): The node labels to resolve. None resolves every label.
+    threshold (float): Minimum cosine similarity for two IDs to be merged.
+    k (int): Number of neighbours inspected per ID.
+
+    Returns:
+    Tuple[List[GraphDocument], Dict[str, Dict[str, str]]]: The rewritten documents and, per label, the variants that were renamed.
+    """
+    labels = set(labels) if labels is not None else None
+    ids_by_label = defaultdict(list)
+    for doc in docs:
+        nodes = list(doc.nodes)
+        for rel in doc.relationships:
+            nodes.extend([rel.source, rel.target])
+        for node in nodes:
+            if labels is None or node.type in labels:
+                ids_by_label[node.type].append(node.id)
+
+    mappings = {label: resolve_names(ids, threshold=threshold, k=k) for label, ids in ids_by_label.items()}
+
+    def canonical(node: Node) -> Node:
+        node.id = mappings.get(node.type, {}).get(node.id, node.id)
+        return node
+
+    for doc in docs:
+        unique_nodes = {}
+        for node in map(canonical, doc.nodes):
+            existing = unique_nodes.setdefault((node.type, node.id), node)
+            if existing is not node:
+                existing.properties = {**node.properties, **existing.properties}
+        doc.nodes = list(unique_nodes.values())
+        unique_relationships = {}
+        for rel in doc.relationships:
+            canonical(rel.source)
+            canonical(rel.target)
+            unique_relationships.setdefault((rel.source.type, rel.source.id, rel.type, rel.target.type, rel.target.id), rel)
+        doc.relationships = list(unique_relationships.values())
+
+    renamed = {label: {variant: name for variant, name in mapping.items() if variant != name} for label, mapping in mappings.items()}
+    print(f"Entity resolution renamed {sum(len(m) for m in renamed.values())} node IDs across {len(renamed)} labels")
+    return docs, renamed
+
+
+def resolve_extracted_entities(containers: List[dict], threshold: float = 0.85, k: int = 10) -> List[dict]:
+    """
+    Canonicalizes dish, ingredient and technique names across EntityContainer dumps produced by estrattore_llm.
+
+    Parameters:
+    containers (List[dict]): EntityContainer objects dumped with model_dump(). They are modified in place.
+    threshold (float): Minimum cosine similarity for two names to be merged.
+    k (int): Number of neighbours inspected per name.
+
+    Returns:
+    List[dict]: The rewritten containers.
+    """
+    dishes = [dish for container in containers for dish in container.get("Dishes", [])]
+    dish_names = resolve_names([d.get("Name", "") for d in dishes], threshold=threshold, k=k)
+    ingredients = resolve_names([i for d in dishes for i in d.get("Ingredients", [])], threshold=threshold, k=k)
+    techniques = resolve_names([t for d in dishes for t in d.get("Techniques", [])], threshold=threshold, k=k)
+    for dish in dishes:
+        dish["Name"] = dish_names.get(dish.get("Name", ""), dish.get("Name", ""))
+        dish["Ingredients"] = list(dict.fromkeys(ingredients.get(i, i) for i in dish.get("Ingredients", [])))
+        dish["Techniques"] = list(dict.fromkeys(techniques.get(t, t) for t in dish.get("Techniques", [])))
+    return containers
@@ -1,17 +1,63 @@
+import asyncio
+import json
 import os.path
-from typing import List, Optional, Union, Tuple
+from typing import Dict, List, Optional, Union, Tuple
+
+import numpy as np
+import urllib3
 
 from langchain_core.documents import Document
 from langchain_core.language_models import BaseChatModel
 from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableSerializable
 from langchain_neo4j.graphs.graph_document import GraphDocument
+from llmsherpa.readers import LayoutPDFReader
 from pydantic import BaseModel, Field
 
 import optimus_prime
 import pdf_loader
+import rate_limiter
+from llm_ledger import LLMLedger
+from model_router import ModelRouter
+from parser_pool import ParserPool
 from pdf_loader import PdfLoader
+from section_dedup import SectionDedupIndex
+from text_vectors import HashedCharNgramVectorizer, kmeans, normalize_text
+from vector_index import SectionVectorIndex
+
+
+summarizer_prompt = ChatPromptTemplate.from_template(
+    "You are a top-tier algorithm able to summarize the text. Be clear and concise when summarizing the text. Extract all the relevant information as they will be used to construct a graph DB."
+    "Here is the text to summarize:"
+    "<document>"
+    "{document}"
+    "</document>"
+    "{additional_prompt}"
+)
+# Summarizer chains by language model and additional prompt, built once per process
+_summarizer_chains: Dict[Tuple[int, str], Tuple[BaseChatModel, RunnableSerializable]] = {}
+
+def summarizer_chain(llm: BaseChatModel, additional_prompt: str = "") -> RunnableSerializable[dict, str]:
+    """
+    Returns the summarization chain of a language model, building it on first use only.
 
+    Parameters:
+    llm (BaseChatModel): The language model.
+    additional_prompt (str): The instructions appended to the summarization prompt.
+
+    Returns:
+    RunnableSerializable[dict, str]: The chain, invoked with the "document" to summarize.
+    """
+    key = (id(llm), additional_prompt)
+    cached = _summarizer_chains.get(key)
+    # The model is kept with the chain, so the id of a collected model cannot return a stale chain
+    if cached is not None and cached[0] is llm:
+        return cached[1]
+    prompt = summarizer_prompt.partial(additional_prompt=additional_prompt) if additional_prompt != "" else summarizer_prompt
+    chain = prompt | llm | StrOutputParser()
+    _summarizer_chains[key] = (llm, chain)
+    return chain
 
 def clean_and_build_documents(documents: List[str],
                               llm: BaseChatModel = None,
@@ -21,12 +67,28 @@ def clean_and_build_documents(documents: List[str],
                               summarize_all: bool = False,
                               summarize_info: bool = False,
                               summarize_paragraphs: bool = False,
-                              additional_prompt: str = "") -> List[Document]:
+                              additional_prompt: str = "",
+                              shared_context: bool = False,
+                              stream: bool = False,
+                              remove_boilerplate: bool = False,
+                              boilerplate_page_fraction: float = pdf_loader.BOILERPLATE_PAGE_FRACTION,
+                              ledger: Optional[LLMLedger] = None,
+                              pdf_reader: Optional[LayoutPDFReader] = None,
+                              http: Optional[urllib3.PoolManager] = None,
+                              parser_pool: Optional[ParserPool] = None) -> List[Document]:
     """
     Load documents into a knowledge graph.
 
     Parameters:
     documents (List[str]): A list of paths of the files to be loaded into the knowledge graph.
+    shared_context (bool): When reorganizing, keep the summarized introduction once per document in metadata["document_context"] instead of copying it into every section.
+    stream (bool): Whether to parse the LLM Sherpa response incrementally, building the hierarchy from the blocks as they are received.
+    remove_boilerplate (bool): Whether to drop running headers, footers and page numbers before building the hierarchy.
+    boilerplate_page_fraction (float): The fraction of the pages a block must recur on to be dropped.
+    ledger (LLMLedger): If given, the summarization calls are recorded in it and subject to its token budgets.
+    pdf_reader (LayoutPDFReader): The LLM Sherpa reader to reuse across documents. Default is a new reader per document.
+    http (urllib3.PoolManager): The connection pool of the streaming parser to reuse across documents. Default is a new pool per document.
+    parser_pool (ParserPool): If given, the PDF files are parsed by the least-loaded of its parser replicas.
 
     Returns:
     List[str]: A list of documents to be loaded into the knowledge graph.
@@ -49,17 +111,41 @@ def clean_and_build_documents(documents: List[str],
                 print(f"Sanitizing PDF: {doc_path} ...")
                 santized_pdf = pdf_loader.sanitize_pdf(doc_path)
                 loader = PdfLoader(
-                    files=[santized_pdf]
+                    files=[santized_pdf],
+                    stream=stream,
+                    reader=pdf_reader,
+                    http=http,
+                    pool=parser_pool
                 )
                 print("Parsing PDF...")
                 pdf_doc = loader.load_pdf_documents()
-                print(f"Parsed PDF: {pdf_doc.json}")
+                if stream:
+                    blocks = pdf_doc
+                else:
+                    print(f"Parsed PDF: {pdf_doc.json}")
+                    blocks = pdf_doc.json
+                if remove_boilerplate:
+                    blocks, report = pdf_loader.remove_repeated_blocks(pdf_loader.BlockTable.from_blocks(blocks), boilerplate_page_fraction)
+                    print(f"Removed {report['blocks_removed']} repeated blocks ({report['tokens_removed']} tokens) over {report['pages']} pages: {report['removed_texts']}")
                 print("Getting document hierarchical representation...")
-                hierarchical_json = pdf_loader.get_hierarchical_json_representation(pdf_doc.json, include_titles)
+                hierarchical_json = pdf_loader.get_hierarchical_json_representation(blocks, include_titles)
                 print(f"Document hierarchical representation: {hierarchical_json}")
+                if reorganize and shared_context:
+                    print("Reorganizing document with shared context...")
+                    document_context, items = reorganize_json_with_shared_context(hierarchical_json, llm, summarize_all, summarize_info, summarize_paragraphs, additional_prompt, ledger, file_name)
+                    report = shared_context_token_report(document_context, items)
+                    print(f"Shared context for {file_name}: {report['sent_tokens']} tokens sent instead of {report['embedded_tokens']}, "
+                          f"of which {report['cacheable_tokens']} in the cacheable prefix of {report['calls']} calls")
+                    converted_docs = pdf_loader.convert_llmsherpa_dict_to_langchain_doc(items, file_name)
+                    # An introduction that was not summarized is extracted as its own item and never sent along with the other ones
+                    if document_context:
+                        for converted_doc in converted_docs:
+                            converted_doc.metadata["document_context"] = document_context
+                    docs_to_load.extend(converted_docs)
+                    continue
                 if reorganize:
                     print("Reorganizing document...")
-                    hierarchical_reorganized_json = reorganize_json(hierarchical_json, llm, summarize_all, summarize_info, summarize_paragraphs, additional_prompt)
+                    hierarchical_reorganized_json = reorganize_json(hierarchical_json, llm, summarize_all, summarize_info, summarize_paragraphs, additional_prompt, ledger, file_name)
                     print("Converting document to Langchain document...")
                     converted_docs = pdf_loader.convert_llmsherpa_dict_to_langchain_doc(hierarchical_reorganized_json, file_name)
                     print(f"Converted docs are: {[doc.model_dump_json() for doc in converted_docs]}")
@@ -73,30 +159,22 @@ def clean_and_build_documents(documents: List[str],
                 raise ValueError(f"Invalid document type for document {doc}. Only PDF documents are supported.")
     return docs_to_load
 
-def reorganize_json(data: dict, llm: BaseChatModel = None, summarize_all: bool = False, summarize_info: bool = False, summarize_paragraphs: bool = False, additional_prompt: str = "") -> list:
+def _reorganize_items(data: dict, llm: BaseChatModel = None, summarize_all: bool = False, summarize_info: bool = False, summarize_paragraphs: bool = False, additional_prompt: str = "",
+                      ledger: Optional[LLMLedger] = None, source: Optional[str] = None) -> Tuple[str, Union[dict, str], list]:
     """
-    Reorganizes a JSON object into a list of dictionaries, each containing a key-value pair from the original object. The first key-value pair is extracted and used as an introduction for each object. Only the first subkey of the first object is used as introduction is used.
+    Splits a JSON object into the introduction and the list of reorganized items, without attaching the introduction to the items.
 
-    Params
-    data: The JSON object to reorganize
-    llm: The language model to use for summarization. Must be a Langchain ChatModel
-    summarize_all: Whether to summarize all the text
-    summarize_info: Whether to summarize the text for information extraction
-    summarize_paragraphs: Whether to summarize the text for paragraph extraction
-
-    Returns: A list of dictionaries, each containing a key-value pair from the original object
+    Returns: The introduction key, the introduction value and the reorganized items
     """
-    summarizer_prompt = ChatPromptTemplate.from_template(
-        "You are a top-tier algorithm able to summarize the text. Be clear and concise when summarizing the text. Extract all the relevant information as they will be used to construct a graph DB."
-        "Here is the text to summarize:"
-        "<document>"
-        "{document}"
-        "</document>"
-        "{additional_prompt}"
-    )
-    if additional_prompt != "":
-        summarizer_prompt = summarizer_prompt.partial(additional_prompt=additional_prompt)
-    summarizer_chain = summarizer_prompt | llm | StrOutputParser()
+    def summarize(document, section: str):
+        if ledger is None:
+            return summarizer_chain(llm, additional_prompt).invoke({"document": document})
+        if not ledger.allows_summarization(source):
+            # Summarization is optional, so an exhausted budget keeps the original text
+            return document
+        chain = summarizer_chain(ledger.select_llm(llm, source), additional_prompt)
+        return chain.invoke({"document": document}, config=ledger.config("summarization", source, section))
+
     # Extract the introduction with the first subkey only
     introduction_key, introduction_value = list(data.items())[0]
     introduction = {introduction_key: {list(introduction_value.items())[0][0]: list(introduction_value.items())[0][1]}}
@@ -106,7 +184,7 @@ def reorganize_json(data: dict, llm: BaseChatModel = None, summarize_all: bool =
         raise ValueError("A language model is required to summarize the text.")
 
     if summarize_info or summarize_all:
-        summarized_info = summarizer_chain.invoke({"document": introduction_value})
+        summarized_info = summarize(introduction_value, introduction_key)
         introduction_value = summarized_info
 
     def recursive_reorganize(data: dict, parent_key: str):
@@ -116,14 +194,16 @@ def reorganize_json(data: dict, llm: BaseChatModel = None, summarize_all: bool =
                 result.extend(recursive_reorganize(value, key))  # Recurse and add the results
             elif isinstance(value, str):
                 if summarize_info or summarize_all:
-                    summarized_text = summarizer_chain.invoke({"document": value})
+                    summarized_text = summarize(value, key)
                     result.append({key: summarized_text})
                 else:
                     result.append({parent_key: value})  # Add the text field with its key
         return result
 
+    return introduction_key, introduction_value, recursive_reorganize(data, introduction_key)
+
+def _attach_introduction(reorganized_data: list, introduction_key: str, introduction_value: Union[dict, str]) -> list:
     # Add the introduction to each reorganized object
-    reorganized_data = recursive_reorganize(data, introduction_key)
     for i, item in enumerate(reorganized_data):
         if type(introduction_value) == dict:
             if any(key in item for key in introduction_value.keys()):
@@ -132,9 +212,76 @@ def reorganize_json(data: dict, llm: BaseChatModel = None, summarize_all: bool =
                 }  # Completely replace the item with the introduction
         else:
             item[introduction_key] = introduction_value # Adding the introduction as part of each object
+    return reorganized_data
+
+def reorganize_json(data: dict, llm: BaseChatModel = None, summarize_all: bool = False, summarize_info: bool = False, summarize_paragraphs: bool = False, additional_prompt: str = "",
+                    ledger: Optional[LLMLedger] = None, source: Optional[str] = None) -> list:
+    """
+    Reorganizes a JSON object into a list of dictionaries, each containing a key-value pair from the original object. The first key-value pair is extracted and used as an introduction for each object. Only the first subkey of the first object is used as introduction is used.
+
+    Params
+    data: The JSON object to reorganize
+    llm: The language model to use for summarization. Must be a Langchain ChatModel
+    summarize_all: Whether to summarize all the text
+    summarize_info: Whether to summarize the text for information extraction
+    summarize_paragraphs: Whether to summarize the text for paragraph extraction
+    ledger: If given, the summarization calls are recorded in it and skipped or degraded according to its token budgets
+    source: The source file, used to account the calls in the ledger
+
+    Returns: A list of dictionaries, each containing a key-value pair from the original object
+    """
+    introduction_key, introduction_value, reorganized_data = _reorganize_items(data, llm, summarize_all, summarize_info, summarize_paragraphs, additional_prompt, ledger, source)
+    reorganized_data = _attach_introduction(reorganized_data, introduction_key, introduction_value)
     print(reorganized_data)
     return reorganized_data
 
+def reorganize_json_with_shared_context(data: dict, llm: BaseChatModel = None, summarize_all: bool = False, summarize_info: bool = False, summarize_paragraphs: bool = False, additional_prompt: str = "",
+                                        ledger: Optional[LLMLedger] = None, source: Optional[str] = None) -> Tuple[Optional[str], list]:
+    """
+    Reorganizes a JSON object like reorganize_json, but returns the introduction once as a shared document context instead of copying it into every item.
+    The context is meant to be sent as a stable prompt prefix (see optimus_prime.create_knowledge_graph_schema), so provider-side prompt caching applies.
+    Like in reorganize_json, an introduction that was not summarized stays a section of its own, and there is no shared context.
+
+    Params
+    data: The JSON object to reorganize
+    llm: The language model to use for summarization. Must be a Langchain ChatModel
+    summarize_all: Whether to summarize all the text
+    summarize_info: Whether to summarize the text for information extraction
+    summarize_paragraphs: Whether to summarize the text for paragraph extraction
+    ledger: If given, the summarization calls are recorded in it and skipped or degraded according to its token budgets
+    source: The source file, used to account the calls in the ledger
+
+    Returns: The document context, None when the introduction was not summarized, and the list of reorganized items
+    """
+    introduction_key, introduction_value, reorganized_data = _reorganize_items(data, llm, summarize_all, summarize_info, summarize_paragraphs, additional_prompt, ledger, source)
+    if type(introduction_value) == dict:
+        # The introduction section is still extracted once, as its own item, and reorganize_json would not embed it in the others
+        return None, _attach_introduction(reorganized_data, introduction_key, introduction_value)
+    document_context = json.dumps({introduction_key: introduction_value}, indent=4, ensure_ascii=False)
+    return document_context, reorganized_data
+
+def shared_context_token_report(document_context: Optional[str], items: list) -> Dict[str, int]:
+    """
+    Compares the tokens sent with the shared context layout with the layout of reorganize_json, where the introduction is embedded in the items.
+    The context is sent with every call, as the system prompt, so the layouts send about as many tokens;
+    the context is the prefix prompt caching can discount, but the discount depends on the provider and is not counted.
+
+    Params
+    document_context: The context returned by reorganize_json_with_shared_context
+    items: The items returned by reorganize_json_with_shared_context
+
+    Returns: The "calls", the tokens of the embedded layout, the tokens sent with the shared layout (every item with the context)
+    and the "cacheable_tokens" of the shared prefix over all calls
+    """
+    item_tokens = sum(rate_limiter.estimate_tokens(json.dumps(item, indent=4, ensure_ascii=False)) for item in items)
+    if not document_context:
+        return {"calls": len(items), "embedded_tokens": item_tokens, "sent_tokens": item_tokens, "cacheable_tokens": 0}
+    introduction_key, introduction_value = next(iter(json.loads(document_context).items()))
+    embedded_items = _attach_introduction([dict(item) for item in items], introduction_key, introduction_value)
+    embedded_tokens = sum(rate_limiter.estimate_tokens(json.dumps(item, indent=4, ensure_ascii=False)) for item in embedded_items)
+    cacheable_tokens = len(items) * rate_limiter.estimate_tokens(document_context)
+    return {"calls": len(items), "embedded_tokens": embedded_tokens, "sent_tokens": item_tokens + cacheable_tokens, "cacheable_tokens": cacheable_tokens}
+
 async def load_documents_into_knowledge_graph(documents: List[str],
                                         llm: BaseChatModel = None,
                                         directory_prefix: str = "",
@@ -147,7 +294,22 @@ async def load_documents_into_knowledge_graph(documents: List[str],
                                         summarize_all: bool = False,
                                         summarize_info: bool = False,
                                         summarize_paragraphs: bool = False,
-                                        additional_prompt: str = "") -> List[GraphDocument]:
+                                        additional_prompt: str = "",
+                                        vector_index: Optional[SectionVectorIndex] = None,
+                                        discover_schema: bool = False,
+                                        schema_clusters: int = 8,
+                                        requests_per_minute: Optional[int] = None,
+                                        tokens_per_minute: Optional[int] = None,
+                                        shared_context: bool = False,
+                                        stream: bool = False,
+                                        remove_boilerplate: bool = False,
+                                        dedup_index: Optional[SectionDedupIndex] = None,
+                                        spool_dir: Optional[str] = None,
+                                        ledger: Optional[LLMLedger] = None,
+                                        router: Optional[ModelRouter] = None,
+                                        pdf_reader: Optional[LayoutPDFReader] = None,
+                                        http: Optional[urllib3.PoolManager] = None,
+                                        parser_pool: Optional[ParserPool] = None) -> List[GraphDocument]:
     """
     Load documents into a knowledge graph.
 
@@ -158,6 +320,21 @@ async def load_documents_into_knowledge_graph(documents: List[str],
     allowed_relationships (List[str]): A list of allowed relationship types.
     node_properties (List[str]): A list of properties for nodes.
     relationship_properties (List[str]): A list of properties for relationships.
+    vector_index (SectionVectorIndex): If given, the section documents are added to it, keyed to the graph nodes extracted from them.
+    discover_schema (bool): Whether to discover the allowed nodes and relationships from a sample of the sections. They are added to the given ones.
+    schema_clusters (int): The number of section clusters, i.e. of LLM calls, used for schema discovery.
+    requests_per_minute (int): The request limit of the LLM account. Together with tokens_per_minute it enables rate-limited conversion.
+    tokens_per_minute (int): The token limit of the LLM account.
+    shared_context (bool): Whether to send the summarized document introduction as a shared, cacheable prompt prefix instead of copying it into every reorganized section.
+    stream (bool): Whether to parse the PDF files incrementally, without holding the full parser response in memory.
+    remove_boilerplate (bool): Whether to drop running headers, footers and page numbers before extraction.
+    dedup_index (SectionDedupIndex): If given, sections that are near-duplicates of already converted ones reuse their graph documents.
+    spool_dir (str): If given, graph documents are persisted there as they are produced, and a re-run reads them back instead of calling the LLM.
+    ledger (LLMLedger): If given, every summarization and conversion call is recorded in it, with its stage, source file and section, and its token budgets are enforced.
+    router (ModelRouter): If given, each section is converted by the cheap or the strong language model of the router, see model_router.
+    pdf_reader (LayoutPDFReader): The LLM Sherpa reader to reuse, e.g. the one kept warm by ingestion_daemon.
+    http (urllib3.PoolManager): The connection pool of the streaming parser to reuse.
+    parser_pool (ParserPool): The parser replicas to spread the PDF files over, see parser_pool.
 
     Returns:
     None
@@ -169,7 +346,9 @@ async def load_documents_into_knowledge_graph(documents: List[str],
         raise ValueError("No documents to load.")
 
     print(f"Cleaning files: {documents}")
-    docs_to_load = clean_and_build_documents(documents=documents,
+    # Parsing, summarization and sanitization block, so they run in a thread and leave the event loop to the other jobs of the caller
+    docs_to_load = await asyncio.to_thread(clean_and_build_documents,
+                                             documents=documents,
                                              llm=llm,
                                              directory_prefix=directory_prefix,
                                              include_titles=include_titles,
@@ -177,16 +356,45 @@ async def load_documents_into_knowledge_graph(documents: List[str],
                                              summarize_all = summarize_all,
                                              summarize_info = summarize_info,
                                              summarize_paragraphs = summarize_paragraphs,
-                                             additional_prompt=additional_prompt)
+                                             additional_prompt=additional_prompt,
+                                             shared_context=shared_context,
+                                             stream=stream,
+                                             remove_boilerplate=remove_boilerplate,
+                                             ledger=ledger,
+                                             pdf_reader=pdf_reader,
+                                             http=http,
+                                             parser_pool=parser_pool)
 
     print(f"Cleaning completed. Documents to be loaded are: {[doc.model_dump_json() for doc in docs_to_load]}")
+    if discover_schema:
+        print("Discovering knowledge graph schema...")
+        discovered_nodes, discovered_relationships = await asyncio.to_thread(discover_er_schema, [doc.page_content for doc in docs_to_load], llm,
+                                                                             n_clusters=schema_clusters)
+        allowed_nodes = list(dict.fromkeys(list(allowed_nodes) + discovered_nodes))
+        if any(isinstance(relationship, tuple) for relationship in allowed_relationships):
+            # LLMGraphTransformer does not accept a mix of typed tuples and plain relationship names
+            print("Typed relationships were given, discovered relationships are not added.")
+        else:
+            allowed_relationships = list(dict.fromkeys(list(allowed_relationships) + discovered_relationships))
     print(f"Loading documents into knowledge graph schema...")
     graph_schema = await optimus_prime.create_knowledge_graph_schema(docs=docs_to_load,
                                                                      llm=llm,
                                                                      allowed_nodes=allowed_nodes,
                                                                      allowed_relationships=allowed_relationships,
                                                                      node_properties=node_properties,
-                                                                     relationship_properties=relationship_properties)
+                                                                     relationship_properties=relationship_properties,
+                                                                     requests_per_minute=requests_per_minute,
+                                                                     tokens_per_minute=tokens_per_minute,
+                                                                     dedup_index=dedup_index,
+                                                                     spool_dir=spool_dir,
+                                                                     ledger=ledger,
+                                                                     router=router)
+    if vector_index is not None:
+        print("Indexing sections...")
+        # Failed conversions are left out of graph_schema, so node IDs are matched back through the source document
+        node_ids = {(graph_doc.source.metadata.get("source"), graph_doc.source.page_content): [node.id for node in graph_doc.nodes] for graph_doc in graph_schema}
+        await asyncio.to_thread(vector_index.add_documents, docs_to_load,
+                                [node_ids.get((doc.metadata.get("source"), doc.page_content), []) for doc in docs_to_load])
     return graph_schema
 
 class ERModel(BaseModel):
@@ -242,7 +450,7 @@ def get_entities_from_document(document: str, llm) -> Union[BaseModel, dict]:
             "</document>"
             "Extract all the relevant information to be sure that the ER model is correctly built and can properly map the document.")
         structured_llm = llm.with_structured_output(ERModel)
-        entities_creation_chain = prompt | structured_llm.invoke({"document": document})
+        entities_creation_chain = prompt | structured_llm
     else:
         json_struct = {field_name: {
             "description": field_info.description,
@@ -260,5 +468,60 @@ def get_entities_from_document(document: str, llm) -> Union[BaseModel, dict]:
             "<format>"
             "{json_struct}"
             "</format>").partial(json_struct=json_struct)
-        entities_creation_chain = prompt | llm.invoke({"document": document}) | JsonOutputParser()
-    return entities_creation_chain
\ No newline at end of file
+        entities_creation_chain = prompt | llm | JsonOutputParser()
+    return entities_creation_chain.invoke({"document": document})
+
+def merge_er_models(models: List[Union[BaseModel, dict]]) -> Tuple[List[str], List[str]]:
+    """
+    Merges several ER models into a single set of allowed nodes and relationships.
+    Entities and relationships differing only by case, accents or punctuation are kept once, with their first spelling.
+
+    Params
+    models: The ER models, as returned by get_entities_from_document
+
+    Returns: The allowed nodes and the allowed relationships
+    """
+    def union(values: List[str]) -> List[str]:
+        merged = {}
+        for value in values:
+            if value and normalize_text(value) not in merged:
+                merged[normalize_text(value)] = value
+        return list(merged.values())
+
+    models = [model.model_dump() if isinstance(model, BaseModel) else model for model in models]
+    allowed_nodes = union([entity for model in models for entity in model.get("entities") or []])
+    allowed_relationships = union([relationship for model in models for relationship in model.get("relationships") or []])
+    return allowed_nodes, allowed_relationships
+
+def discover_er_schema(sections: List[str], llm: BaseChatModel, n_clusters: int = 8, samples_per_cluster: int = 2, max_sample_chars: int = 12000) -> Tuple[List[str], List[str]]:
+    """
+    Discovers the graph schema of a corpus with O(clusters) LLM calls instead of one call per document.
+    Sections are clustered with character n-gram TF-IDF and k-means; only the sections closest to each centroid are sent to the LLM,
+    and the returned ER models are merged.
+
+    Params
+    sections: The text of the sections of the corpus
+    llm: The language model to use for ER model extraction
+    n_clusters: The number of clusters, i.e. the number of LLM calls
+    samples_per_cluster: The number of representative sections sent for each cluster
+    max_sample_chars: The maximum number of characters sent for each cluster
+
+    Returns: The allowed nodes and the allowed relationships, ready for load_documents_into_knowledge_graph
+    """
+    sections = [section for section in sections if section.strip()]
+    if not sections:
+        raise ValueError("No sections to discover the schema from.")
+    vectors = HashedCharNgramVectorizer().fit_transform(sections)
+    labels, centroids = kmeans(vectors, n_clusters)
+    models = []
+    for cluster, centroid in enumerate(centroids):
+        members = np.nonzero(labels == cluster)[0]
+        if len(members) == 0:
+            continue
+        closest = members[np.argsort(-(vectors[members] @ centroid))[:samples_per_cluster]]
+        sample = "\n\n".join(sections[i] for i in closest)[:max_sample_chars]
+        print(f"Discovering schema for cluster {cluster} ({len(members)} sections)...")
+        models.append(get_entities_from_document(sample, llm))
+    allowed_nodes, allowed_relationships = merge_er_models(models)
+    print(f"Discovered schema from {len(models)} LLM calls over {len(sections)} sections: nodes {allowed_nodes}, relationships {allowed_relationships}")
+    return allowed_nodes, allowed_relationships
@@ -0,0 +1,392 @@
+import argparse
+import copy
+import glob
+import json
+import os
+import re
+from collections import defaultdict, deque
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from text_vectors import normalize_text
+
+# Fields of the EntityContainer extracted by estrattore_llm, and the labels neo4j_builder gives them in the graph
+ENTITY_KINDS = ("Restaurant", "Chef", "Planet", "Dish", "Ingredient", "Technique", "License")
+GRAPH_LABELS = {"Ristorante": "Restaurant", "Chef": "Chef", "Pianeta": "Planet", "Piatto": "Dish", "Ingrediente": "Ingredient", "Tecnica": "Technique", "Licenza": "License"}
+# Function words that are capitalised at the start of a sentence without naming anything
+STOPWORDS = frozenset("il lo la i gli le l un una uno di del dello della dei degli delle d da dal dalla dai dalle in nel nella nei nelle con su sul sulla per "
+                      "tra fra e ed o a al alla ai agli alle che questo questa ogni the an of and or with on for to from by this each".split())
+_WORD = re.compile(r"[^\W_]+")
+_WHITESPACE = re.compile(r"\s*")
+
+
+def _tokenize(text: str) -> List[Tuple[str, int, int, bool]]:
+    """
+    Splits a text into normalized words, keeping the character span of each word and whether it is capitalised in the original text.
+    """
+    tokens = []
+    for match in _WORD.finditer(text):
+        word = match.group()
+        for piece in normalize_text(word).split():
+            tokens.append((piece, match.start(), match.end(), word[0].isupper()))
+    return tokens
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton over words: every pattern is a sequence of normalized words, so matches always start and end on word boundaries
+    and a text is scanned once, whatever the number of patterns.
+    """
+
+    def __init__(self):
+        """
+        Initializes the AhoCorasick class with the root state only.
+        """
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.outputs: List[List[Tuple[int, Any]]] = [[]]
+        self.built = True
+
+    def add(self, words: Sequence[str], payload: Any) -> None:
+        state = 0
+        for word in words:
+            next_state = self.goto[state].get(word)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][word] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            state = next_state
+        self.outputs[state].append((len(words), payload))
+        self.built = False
+
+    def build(self) -> None:
+        """
+        Computes the failure links breadth-first, and merges the outputs of every state with those of its failure state.
+        """
+        queue = deque()
+        for state in self.goto[0].values():
+            self.fail[state] = 0
+            queue.append(state)
+        while queue:
+            state = queue.popleft()
+            for word, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(word, 0)
+                self.outputs[next_state] = self.outputs[next_state] + [output for output in self.outputs[self.fail[next_state]]
+                                                                       if output not in self.outputs[next_state]]
+        self.built = True
+
+    def iter_matches(self, words: Sequence[str]) -> Iterator[Tuple[int, int, Any]]:
+        """
+        Finds all the occurrences of the patterns, overlapping ones included.
+
+        Parameters:
+        words (Sequence[str]): The normalized words of the text.
+
+        Returns:
+        Iterator[Tuple[int, int, Any]]: The start and end word index of every occurrence, with the payload of its pattern.
+        """
+        if not self.built:
+            self.build()
+        state = 0
+        for i, word in enumerate(words):
+            while state and word not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(word, 0)
+            for length, payload in self.outputs[state]:
+                yield i - length + 1, i + 1, payload
+
+
+class Gazetteer:
+
+    def __init__(self):
+        """
+        Initializes the Gazetteer class, the dictionary of the entities already extracted from the corpus.
+        Besides the names, it keeps the ingredients and techniques known for every dish, the levels known for every licence,
+        and the capitalised spans known not to be entities.
+        """
+        self.names: Dict[str, Dict[str, str]] = {kind: {} for kind in ENTITY_KINDS}
+        self.dishes: Dict[str, Dict[str, set]] = defaultdict(lambda: {"Ingredients": set(), "Techniques": set()})
+        self.license_levels: Dict[str, set] = defaultdict(set)
+        self.common_spans: set = set()
+        self.automaton: Optional[AhoCorasick] = None
+        self.stats = {"sections": 0, "skipped": 0}
+
+    def add(self, kind: str, name: Optional[str]) -> Optional[str]:
+        """
+        Adds a known entity. The first spelling seen for a normalized name is kept as the canonical one.
+
+        Returns:
+        Optional[str]: The canonical name, or None for empty names.
+        """
+        if kind not in self.names:
+            raise ValueError(f"Unknown entity kind: {kind}. Possible values are {ENTITY_KINDS}.")
+        key = normalize_text(name or "")
+        if not key or key == "unknown":
+            return None
+        if key not in self.names[kind]:
+            self.names[kind][key] = name.strip()
+            self.automaton = None
+        return self.names[kind][key]
+
+    def add_container(self, container: dict) -> None:
+        """
+        Adds the entities of an EntityContainer produced by estrattore_llm, as a dict.
+        """
+        self.add("Restaurant", container.get("Restaurant"))
+        self.add("Planet", container.get("Planet"))
+        chef = container.get("Chef") or {}
+        self.add("Chef", chef.get("Name"))
+        for licence in chef.get("Licenses") or []:
+            if (name := self.add("License", licence.get("Name"))) and licence.get("Level"):
+                self.license_levels[name].add(licence["Level"])
+        for dish in container.get("Dishes") or []:
+            if not (name := self.add("Dish", dish.get("Name"))):
+                continue
+            for field, kind in (("Ingredients", "Ingredient"), ("Techniques", "Technique")):
+                for value in dish.get(field) or []:
+                    if value := self.add(kind, value):
+                        self.dishes[name][field].add(value)
+
+    def add_graph(self, driver, database: str) -> None:
+        """
+        Adds the entities of a graph written by neo4j_builder.
+
+        Parameters:
+        driver: The neo4j driver.
+        database (str): The database name.
+        """
+        with driver.session(database=database) as session:
+            for record in session.run("MATCH (n) WHERE any(label IN labels(n) WHERE label IN $labels) AND n.name IS NOT NULL "
+                                      "RETURN [label IN labels(n) WHERE label IN $labels][0] AS label, n.name AS name, n.level AS level",
+                                      labels=list(GRAPH_LABELS)).data():
+                name = self.add(GRAPH_LABELS[record["label"]], record["name"])
+                if name and record["label"] == "Licenza" and record["level"]:
+                    self.license_levels[name].add(record["level"])
+            for record in session.run("MATCH (p:Piatto)-[r:CONTIENE_INGREDIENTE|APPLICA_TECNICA]->(x) "
+                                      "RETURN p.name AS dish, type(r) AS type, x.name AS name").data():
+                dish = self.add("Dish", record["dish"])
+                kind, field = ("Ingredient", "Ingredients") if record["type"] == "CONTIENE_INGREDIENTE" else ("Technique", "Techniques")
+                if dish and (name := self.add(kind, record["name"])):
+                    self.dishes[dish][field].add(name)
+
+    def _compile(self) -> AhoCorasick:
+        if self.automaton is None:
+            self.automaton = AhoCorasick()
+            for kind, names in self.names.items():
+                for key, name in names.items():
+                    self.automaton.add(key.split(), (kind, name))
+            self.automaton.build()
+        return self.automaton
+
+    def tag(self, text: str) -> dict:
+        """
+        Tags the known entities of a text in a single pass, and finds the capitalised spans that no known entity explains.
+        Overlapping occurrences are resolved leftmost-longest. A capitalised word is unexplained unless it is a function word
+        or is written in lower case elsewhere in the text, and a span of them unless a previous extraction left out the same span (see learn).
+
+        Parameters:
+        text (str): The section text.
+
+        Returns:
+        dict: The "matches", as (kind, canonical name, start, end) character spans, and the "unexplained" spans of text.
+        """
+        tokens = _tokenize(text)
+        words = [token[0] for token in tokens]
+        occurrences = defaultdict(list)
+        for start, end, payload in self._compile().iter_matches(words):
+            occurrences[(start, end)].append(payload)
+
+        matches, covered, position = [], [False] * len(tokens), 0
+        for (start, end), payloads in sorted(occurrences.items(), key=lambda item: (item[0][0], -item[0][1])):
+            if start < position:
+                continue
+            for kind, name in payloads:
+                matches.append((kind, name, tokens[start][1], tokens[end - 1][2]))
+            covered[start:end] = [True] * (end - start)
+            position = end
+
+        lower_case = {word for word, _, _, capitalised in tokens if not capitalised}
+        unexplained, span = [], None
+        for i, (word, start, end, capitalised) in enumerate(tokens):
+            if not covered[i] and capitalised and word not in STOPWORDS and word not in lower_case and not word.isdigit():
+                span = (span[0], end) if span is not None else (start, end)
+                continue
+            # Function words may join the words of a name, e.g. "Carne di Drago"
+            if span is not None and not (word in STOPWORDS and not capitalised and i + 1 < len(tokens) and tokens[i + 1][3]):
+                unexplained.append(text[span[0]:span[1]])
+                span = None
+        if span is not None:
+            unexplained.append(text[span[0]:span[1]])
+        return {"matches": matches, "unexplained": [span for span in unexplained if normalize_text(span) not in self.common_spans]}
+
+    def needs_llm(self, text: str, min_matches: int = 1) -> bool:
+        """
+        Tells whether a section must go through the LLM: it contains unexplained capitalised spans, or fewer than min_matches known entities.
+        """
+        tagged = self.tag(text)
+        return bool(tagged["unexplained"]) or len(tagged["matches"]) < min_matches
+
+    def extract(self, text: str, already_extracted_entities: dict, min_matches: int = 1) -> Optional[dict]:
+        """
+        Extracts the entities of a section without the LLM, when the gazetteer explains all of it.
+        Ingredients and techniques are attributed to the dishes of the section that are known to use them, or to the only dish of the section.
+
+        Parameters:
+        text (str): The section text.
+        already_extracted_entities (dict): The EntityContainer extracted so far from the document, as a dict. It is not modified.
+        min_matches (int): The number of known entities a section needs to skip the LLM.
+
+        Returns:
+        Optional[dict]: The updated EntityContainer dict, or None when the section needs the LLM: it has unexplained spans,
+        ambiguous names, licences of unknown level or ingredients and techniques that cannot be attributed to a dish.
+        """
+        self.stats["sections"] += 1
+        tagged = self.tag(text)
+        if tagged["unexplained"] or len(tagged["matches"]) < min_matches:
+            return None
+        found = defaultdict(list)
+        spans = defaultdict(set)
+        for kind, name, start, end in tagged["matches"]:
+            spans[(start, end)].add(kind)
+            if name not in found[kind]:
+                found[kind].append(name)
+        if any(len(kinds) > 1 for kinds in spans.values()):
+            return None
+
+        result = copy.deepcopy(already_extracted_entities)
+        for kind in ("Restaurant", "Planet"):
+            if found[kind] and not result.get(kind):
+                result[kind] = found[kind][0]
+        chef = result.setdefault("Chef", {"Name": "", "Licenses": []})
+        if found["Chef"] and not chef.get("Name"):
+            chef["Name"] = found["Chef"][0]
+        for name in found["License"]:
+            if len(self.license_levels[name]) != 1:
+                return None
+            licence = {"Name": name, "Level": next(iter(self.license_levels[name]))}
+            if licence not in chef.setdefault("Licenses", []):
+                chef["Licenses"].append(licence)
+
+        dishes = {dish: {"Ingredients": [], "Techniques": []} for dish in found["Dish"]}
+        for field, kind in (("Ingredients", "Ingredient"), ("Techniques", "Technique")):
+            for name in found[kind]:
+                owners = [dish for dish in dishes if name in self.dishes[dish][field]]
+                if not owners and len(dishes) == 1:
+                    owners = list(dishes)
+                if not owners:
+                    return None
+                for dish in owners:
+                    dishes[dish][field].append(name)
+        for dish, values in dishes.items():
+            existing = next((item for item in result.setdefault("Dishes", []) if normalize_text(item.get("Name", "")) == normalize_text(dish)), None)
+            if existing is None:
+                result["Dishes"].append({"Name": dish, **values})
+                continue
+            for field, names in values.items():
+                existing.setdefault(field, []).extend(name for name in names if name not in existing[field])
+        self.stats["skipped"] += 1
+        return result
+
+    def learn(self, text: str, extracted_entities: dict) -> None:
+        """
+        Updates the gazetteer after a section went through the LLM: the extracted entities are added,
+        and the capitalised spans the LLM did not turn into entities are remembered, so they no longer send sections to the LLM.
+        Whole spans are remembered rather than their words, so a new name sharing a word with them, e.g. "Carne di Drago" after "Drago", is still unexplained.
+
+        Parameters:
+        text (str): The section text.
+        extracted_entities (dict): The EntityContainer returned by the LLM for the section, as a dict.
+        """
+        self.add_container(extracted_entities)
+        self.common_spans.update(normalize_text(span) for span in self.tag(text)["unexplained"])
+
+    def __len__(self) -> int:
+        return sum(len(names) for names in self.names.values())
+
+    def save(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        data = {"names": self.names,
+                "dishes": {dish: {field: sorted(values) for field, values in fields.items()} for dish, fields in self.dishes.items()},
+                "license_levels": {name: sorted(levels) for name, levels in self.license_levels.items()},
+                "common_spans": sorted(self.common_spans)}
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "Gazetteer":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        gazetteer = cls()
+        for kind, names in data["names"].items():
+            gazetteer.names[kind].update(names)
+        for dish, fields in data["dishes"].items():
+            for field, values in fields.items():
+                gazetteer.dishes[dish][field].update(values)
+        for name, levels in data["license_levels"].items():
+            gazetteer.license_levels[name].update(levels)
+        # Files saved before spans were learned hold single words, i.e. one-word spans
+        gazetteer.common_spans.update(data.get("common_spans", data.get("common_words", [])))
+        return gazetteer
+
+
+def iter_extraction_outputs(paths: Iterable[str]) -> Iterator[dict]:
+    """
+    Reads the EntityContainer dicts written by estrattore_llm, several JSON objects per file: JSON Lines artifacts or the older metadata files.
+    """
+    decoder = json.JSONDecoder()
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            content = f.read()
+        position = _WHITESPACE.match(content).end()
+        while position < len(content):
+            container, position = decoder.raw_decode(content, position)
+            position = _WHITESPACE.match(content, position).end()
+            yield container
+
+
+def build_gazetteer(output_paths: Iterable[str] = (), driver=None, database: Optional[str] = None) -> Gazetteer:
+    """
+    Builds a gazetteer from previous extraction outputs and, if a driver is given, from the graph.
+
+    Parameters:
+    output_paths (Iterable[str]): The metadata files written by estrattore_llm.
+    driver: The neo4j driver. Default is not to read the graph.
+    database (str): The database name.
+
+    Returns:
+    Gazetteer: The gazetteer.
+    """
+    gazetteer = Gazetteer()
+    for container in iter_extraction_outputs(output_paths):
+        gazetteer.add_container(container)
+    if driver is not None:
+        gazetteer.add_graph(driver, database)
+    return gazetteer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the gazetteer of known entities from extraction outputs and the Neo4j graph.")
+    parser.add_argument("gazetteer", help="Path of the gazetteer JSON file to write.")
+    parser.add_argument("--outputs", default="output/entities/*.jsonl", help="Glob of the extraction outputs.")
+    parser.add_argument("--database", help="Also read the entities of this Neo4j database, using NEO4J_URI, NEO4J_USERNAME and NEO4J_PASSWORD.")
+    args = parser.parse_args()
+
+    neo4j_driver = None
+    if args.database:
+        from neo4j import GraphDatabase
+
+        neo4j_driver = GraphDatabase.driver(os.environ["NEO4J_URI"], auth=(os.environ["NEO4J_USERNAME"], os.environ["NEO4J_PASSWORD"]))
+    built = build_gazetteer(sorted(glob.glob(args.outputs)), neo4j_driver, args.database)
+    if neo4j_driver is not None:
+        neo4j_driver.close()
+    built.save(args.gazetteer)
+    print(f"Gazetteer with {len(built)} entities: {({kind: len(names) for kind, names in built.names.items()})}")
@@ -0,0 +1,149 @@
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from langchain_community.graphs.graph_document import GraphDocument
+from langchain_neo4j import Neo4jGraph
+
+from graph_schema import MERGE_KEY_PROPERTY
+from text_vectors import normalize_text
+
+DEFAULT_WRITE_BATCH_SIZE = 1000
+
+# Nodes are MERGEd on their normalized key, so every spelling of an id lands on the same node whatever the order and batching of the input;
+# the id is only displayed, and set when the node is created
+NODE_QUERY = (f"UNWIND $rows AS row MERGE (n:`{{label}}` {{{{{MERGE_KEY_PROPERTY}: row.merge_key}}}}) "
+              "ON CREATE SET n.id = row.id SET n += row.properties")
+RELATIONSHIP_QUERY = ("UNWIND $rows AS row "
+                      f"MERGE (s:`{{source_label}}` {{{{{MERGE_KEY_PROPERTY}: row.source}}}}) ON CREATE SET s.id = row.source_id "
+                      f"MERGE (t:`{{target_label}}` {{{{{MERGE_KEY_PROPERTY}: row.target}}}}) ON CREATE SET t.id = row.target_id "
+                      "MERGE (s)-[r:`{type}`]->(t) SET r += row.properties")
+
+
+def _node_key(label: str, node_id) -> Tuple[str, str]:
+    # Ids made only of punctuation normalize to an empty string, so they are kept verbatim
+    return label, normalize_text(node_id) or str(node_id)
+
+
+def _add_node(nodes: Dict[Tuple[str, str], dict], label: str, node_id) -> dict:
+    key = _node_key(label, node_id)
+    entry = nodes.setdefault(key, {"label": label, "id": node_id, "key": key[1], "properties": {}})
+    # The displayed spelling is the smallest one, not the first one seen, so it does not depend on the input order
+    if str(node_id) < str(entry["id"]):
+        entry["id"] = node_id
+    return entry
+
+
+def _merge_properties(target: dict, properties: dict) -> None:
+    # The first non-empty value of a property wins, later occurrences only fill missing ones
+    for name, value in (properties or {}).items():
+        if value is not None and value != "" and target.get(name) in (None, ""):
+            target[name] = value
+
+
+def _escape(name: str) -> str:
+    return str(name).replace("`", "")
+
+
+class ConsolidatedGraph:
+
+    def __init__(self):
+        """
+        Initializes the ConsolidatedGraph class, holding one entry per distinct node and relationship of a batch of graph documents.
+        """
+        self.nodes: Dict[Tuple[str, str], dict] = {}
+        self.relationships: Dict[Tuple[str, Tuple[str, str], Tuple[str, str]], dict] = {}
+        self.stats = {"nodes_in": 0, "relationships_in": 0}
+
+    def add(self, graph_doc: GraphDocument) -> None:
+        for node in graph_doc.nodes:
+            self.stats["nodes_in"] += 1
+            _merge_properties(_add_node(self.nodes, node.type, node.id)["properties"], node.properties)
+        for rel in graph_doc.relationships:
+            self.stats["relationships_in"] += 1
+            source_key, target_key = _node_key(rel.source.type, rel.source.id), _node_key(rel.target.type, rel.target.id)
+            # Endpoints missing from the node list of their document are still created once
+            _add_node(self.nodes, rel.source.type, rel.source.id)
+            _add_node(self.nodes, rel.target.type, rel.target.id)
+            entry = self.relationships.setdefault((rel.type, source_key, target_key), {"type": rel.type, "properties": {}})
+            _merge_properties(entry["properties"], rel.properties)
+
+    def report(self) -> Dict[str, int]:
+        """
+        Returns the number of input and distinct elements and of duplicates eliminated.
+        """
+        return {**self.stats,
+                "nodes_out": len(self.nodes),
+                "relationships_out": len(self.relationships),
+                "duplicate_nodes": self.stats["nodes_in"] - len(self.nodes),
+                "duplicate_relationships": self.stats["relationships_in"] - len(self.relationships)}
+
+    def node_batches(self) -> Dict[str, List[dict]]:
+        """
+        Groups the node rows by label, since labels cannot be parameters of a Cypher query.
+        """
+        batches = defaultdict(list)
+        for entry in self.nodes.values():
+            batches[entry["label"]].append({"merge_key": entry["key"], "id": entry["id"], "properties": entry["properties"]})
+        return batches
+
+    def relationship_batches(self) -> Dict[Tuple[str, str, str], List[dict]]:
+        """
+        Groups the relationship rows by type and endpoint labels. Endpoints refer to the merge key of their consolidated node.
+        """
+        batches = defaultdict(list)
+        for (rel_type, source_key, target_key), entry in self.relationships.items():
+            source, target = self.nodes[source_key], self.nodes[target_key]
+            batches[(rel_type, source["label"], target["label"])].append({"source": source["key"], "target": target["key"], "source_id": source["id"],
+                                                                          "target_id": target["id"], "properties": entry["properties"]})
+        return batches
+
+
+def consolidate_graph_documents(docs: List[GraphDocument]) -> ConsolidatedGraph:
+    """
+    Builds one deduplicated node set and relationship set across a batch of graph documents.
+    Nodes are keyed by (label, normalized id) and relationships by (type, start node, end node); the properties of the duplicates are merged.
+    The normalized id is written as the merge_key property, which the nodes are MERGEd on.
+
+    Parameters:
+    docs (List[GraphDocument]): The graph documents.
+
+    Returns:
+    ConsolidatedGraph: The distinct nodes and relationships, ready for write_consolidated_graph.
+    """
+    graph = ConsolidatedGraph()
+    for graph_doc in docs:
+        graph.add(graph_doc)
+    return graph
+
+
+def write_consolidated_graph(graph_db: Neo4jGraph, graph: ConsolidatedGraph, batch_size: int = DEFAULT_WRITE_BATCH_SIZE) -> Dict[str, float]:
+    """
+    Writes a consolidated graph with one UNWIND statement per label or relationship type and batch, so every distinct element is MERGEd once.
+    All nodes are written before the relationships.
+
+    Parameters:
+    graph_db (Neo4jGraph): The target graph.
+    graph (ConsolidatedGraph): The graph returned by consolidate_graph_documents.
+    batch_size (int): The number of rows per statement.
+
+    Returns:
+    Dict[str, float]: The number of statements sent and the time spent writing nodes and relationships, in seconds.
+    """
+    timings = {"statements": 0, "nodes_seconds": 0.0, "relationships_seconds": 0.0}
+    start = time.perf_counter()
+    for label, rows in graph.node_batches().items():
+        query = NODE_QUERY.format(label=_escape(label))
+        for offset in range(0, len(rows), batch_size):
+            graph_db.query(query, {"rows": rows[offset:offset + batch_size]})
+            timings["statements"] += 1
+    timings["nodes_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for (rel_type, source_label, target_label), rows in graph.relationship_batches().items():
+        query = RELATIONSHIP_QUERY.format(type=_escape(rel_type), source_label=_escape(source_label), target_label=_escape(target_label))
+        for offset in range(0, len(rows), batch_size):
+            graph_db.query(query, {"rows": rows[offset:offset + batch_size]})
+            timings["statements"] += 1
+    timings["relationships_seconds"] = time.perf_counter() - start
+    return timings
@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from neo4j import Driver, GraphDatabase
+from neo4j.exceptions import Neo4jError
+
+# Graph documents are MERGEd on their normalized id when consolidated (see graph_consolidation), on their raw id otherwise
+MERGE_KEY_PROPERTY = "merge_key"
+DEFAULT_KEY_PROPERTIES = ("id", MERGE_KEY_PROPERTY)
+DEFAULT_AWAIT_SECONDS = 300
+DEFAULT_LATENCY_SAMPLES = 20
+# Index types a MERGE on node properties can seek with
+SEEKABLE_INDEX_TYPES = ("RANGE", "BTREE")
+
+Query = Callable[..., List[dict]]
+KeyNames = Tuple[str, ...]
+
+
+def _escape(name: str) -> str:
+    return str(name).replace("`", "")
+
+
+def _schema_name(label: str, key_names: KeyNames, kind: str) -> str:
+    return re.sub(r"\W", "_", f"{label}_{'_'.join(key_names)}_{kind}")
+
+
+def driver_query(driver: Driver, database: Optional[str] = None) -> Query:
+    """
+    Wraps a Neo4j driver in the query(cypher, params) callable used by GraphSchemaManager, like Neo4jGraph.query.
+    Every statement runs in its own auto-commit transaction, as schema statements require.
+
+    Parameters:
+    driver (Driver): The Neo4j driver.
+    database (str): The Neo4j database. Default is the server default database.
+
+    Returns:
+    Query: The callable, returning the records as dictionaries.
+    """
+    def query(cypher: str, params: Optional[dict] = None) -> List[dict]:
+        with driver.session(database=database) as session:
+            return session.run(cypher, params or {}).data()
+    return query
+
+
+class GraphSchema:
+
+    def __init__(self, node_keys: Dict[str, Sequence[KeyNames]]):
+        """
+        Initializes the GraphSchema class, the key properties every MERGE matches nodes on, by label.
+        Each key gets a uniqueness constraint, whose backing index turns the MERGE from a label scan into an index seek.
+
+        Parameters:
+        node_keys (Dict[str, Sequence[Tuple[str, ...]]]): The keys of every label, e.g. {"Piatto": [("name",)], "Licenza": [("name", "level")]}.
+        """
+        self.node_keys = {label: [tuple(key) for key in keys] for label, keys in node_keys.items()}
+
+    @classmethod
+    def from_graph_params(cls, allowed_nodes: Iterable[str], allowed_relationships: Iterable[Union[str, Tuple[str, str, str]]] = (),
+                          key_properties: Sequence[Union[str, KeyNames]] = DEFAULT_KEY_PROPERTIES,
+                          label_keys: Optional[Dict[str, Sequence[Union[str, KeyNames]]]] = None) -> "GraphSchema":
+        """
+        Derives the schema from the allowed_nodes and allowed_relationships of LLMGraphTransformer, e.g. demo.graph_params.
+        The labels are the allowed nodes plus the endpoints of the (source, type, target) relationships; plain relationship types add no label.
+
+        Parameters:
+        allowed_nodes (Iterable[str]): The node labels.
+        allowed_relationships (Iterable[Union[str, Tuple[str, str, str]]]): The relationship types or triples.
+        key_properties (Sequence[Union[str, Tuple[str, ...]]]): The keys of every label: "id" and "merge_key" for the graph documents of LLMGraphTransformer,
+        "name" for the nodes of neo4j_builder. A tuple is a composite key.
+        label_keys (Dict[str, Sequence[Union[str, Tuple[str, ...]]]]): The keys of the labels that do not use key_properties.
+
+        Returns:
+        GraphSchema: The schema.
+        """
+        labels = list(dict.fromkeys(allowed_nodes))
+        for rel in allowed_relationships:
+            if isinstance(rel, (tuple, list)):
+                labels.extend(label for label in (rel[0], rel[2]) if label not in labels)
+        label_keys = label_keys or {}
+        node_keys = {}
+        for label in labels:
+            keys = label_keys.get(label, key_properties)
+            node_keys[label] = [(key,) if isinstance(key, str) else tuple(key) for key in keys]
+        return cls(node_keys)
+
+    def statements(self) -> List[str]:
+        """
+        Returns the idempotent statements creating the constraints of the schema.
+        """
+        return [self.constraint_statement(label, key) for label, keys in self.node_keys.items() for key in keys]
+
+    @staticmethod
+    def constraint_statement(label: str, key_names: KeyNames) -> str:
+        properties = ", ".join(f"n.`{_escape(name)}`" for name in key_names)
+        properties = f"({properties})" if len(key_names) > 1 else properties
+        return f"CREATE CONSTRAINT `{_schema_name(label, key_names, 'unique')}` IF NOT EXISTS FOR (n:`{_escape(label)}`) REQUIRE {properties} IS UNIQUE"
+
+    @staticmethod
+    def index_statement(label: str, key_names: KeyNames) -> str:
+        properties = ", ".join(f"n.`{_escape(name)}`" for name in key_names)
+        return f"CREATE INDEX `{_schema_name(label, key_names, 'index')}` IF NOT EXISTS FOR (n:`{_escape(label)}`) ON ({properties})"
+
+
+class GraphSchemaManager:
+
+    def __init__(self, query: Query):
+        """
+        Initializes the GraphSchemaManager class, creating the constraints and indexes of a GraphSchema and checking that MERGEs can use them.
+
+        Parameters:
+        query (Query): A query(cypher, params) callable returning the records as dictionaries: Neo4jGraph.query, or driver_query(driver, database).
+        """
+        self.query = query
+
+    def indexes(self) -> List[dict]:
+        """
+        Returns the node property indexes of the database, with their "name", "type", "labelsOrTypes", "properties" and "state".
+        Constraint-backed indexes are included.
+        """
+        return [index for index in self.query("SHOW INDEXES YIELD name, type, entityType, labelsOrTypes, properties, state")
+                if index.get("entityType") == "NODE" and index.get("type") in SEEKABLE_INDEX_TYPES and index.get("labelsOrTypes")]
+
+    def constraints(self) -> List[dict]:
+        """
+        Returns the uniqueness and node key constraints of the database, with their "name", "type", "labelsOrTypes" and "properties".
+        """
+        return [constraint for constraint in self.query("SHOW CONSTRAINTS YIELD name, type, labelsOrTypes, properties")
+                if "UNIQUENESS" in constraint.get("type", "") or "KEY" in constraint.get("type", "")]
+
+    @staticmethod
+    def _covered(label: str, key_names: KeyNames, indexes: List[dict], online_only: bool = True) -> bool:
+        # A MERGE seeks with an index on a subset of its key properties, e.g. an index on name serves MERGE {name, level}
+        return any(index["labelsOrTypes"] == [label] and set(index["properties"]) <= set(key_names) and (index.get("state") == "ONLINE" or not online_only)
+                   for index in indexes)
+
+    def missing_indexes(self, signatures: Iterable[Tuple[str, KeyNames]]) -> List[Tuple[str, KeyNames]]:
+        """
+        Lists the MERGE signatures no online index serves, i.e. the labels whose MERGEs scan every node of the label.
+
+        Parameters:
+        signatures (Iterable[Tuple[str, Tuple[str, ...]]]): The (label, key property names) pairs written, e.g. the keys of GraphBatch.node_groups().
+
+        Returns:
+        List[Tuple[str, Tuple[str, ...]]]: The signatures without an index.
+        """
+        indexes = self.indexes()
+        return [(label, tuple(key_names)) for label, key_names in dict.fromkeys(signatures) if not self._covered(label, tuple(key_names), indexes)]
+
+    def merge_latency(self, schema: GraphSchema, samples: int = DEFAULT_LATENCY_SAMPLES) -> Dict[str, Optional[float]]:
+        """
+        Measures the median latency of a MERGE per label, MERGEing keys already in the graph so nothing is written.
+
+        Parameters:
+        schema (GraphSchema): The labels and keys to measure.
+        samples (int): The number of keys MERGEd per label.
+
+        Returns:
+        Dict[str, Optional[float]]: The median latency by "Label(key)", in milliseconds; None for labels without nodes.
+        """
+        latency = {}
+        for label, keys in schema.node_keys.items():
+            for key_names in keys:
+                returned = ", ".join(f"n.`{_escape(name)}` AS `{_escape(name)}`" for name in key_names)
+                not_null = " AND ".join(f"n.`{_escape(name)}` IS NOT NULL" for name in key_names)
+                rows = self.query(f"MATCH (n:`{_escape(label)}`) WHERE {not_null} RETURN {returned} LIMIT $samples", {"samples": samples})
+                merge = f"MERGE (n:`{_escape(label)}` {{{', '.join(f'`{_escape(name)}`: $row.`{_escape(name)}`' for name in key_names)}}}) RETURN count(n) AS merged"
+                timings = []
+                for i, row in enumerate(rows):
+                    start = time.perf_counter()
+                    self.query(merge, {"row": row})
+                    # The first MERGE also pays for planning the query
+                    if i > 0 or len(rows) == 1:
+                        timings.append((time.perf_counter() - start) * 1000)
+                latency[f"{label}({', '.join(key_names)})"] = statistics.median(timings) if timings else None
+        return latency
+
+    def ensure(self, schema: GraphSchema, await_seconds: int = DEFAULT_AWAIT_SECONDS, measure: bool = False,
+               samples: int = DEFAULT_LATENCY_SAMPLES) -> dict:
+        """
+        Creates the missing constraints of a schema and waits for their indexes to come online. Statements are idempotent, so it can run before every ingestion.
+        When a uniqueness constraint cannot be created, typically because the graph already holds duplicate keys, a plain index is created instead.
+
+        Parameters:
+        schema (GraphSchema): The schema.
+        await_seconds (int): How long to wait for the indexes to come online.
+        measure (bool): Whether to measure the MERGE latency before and after, see merge_latency.
+        samples (int): The number of keys MERGEd per label when measuring.
+
+        Returns:
+        dict: The "created" and "existing" constraints, the "indexes" created as a fallback with their "errors", and the "latency" before and after,
+        by "Label(key)", when measured.
+        """
+        report = {"created": [], "existing": [], "indexes": [], "errors": {}, "latency": {}}
+        before = self.merge_latency(schema, samples) if measure else {}
+        constraints, indexes = self.constraints(), self.indexes()
+        for label, keys in schema.node_keys.items():
+            for key_names in keys:
+                name = f"{label}({', '.join(key_names)})"
+                if any(constraint["labelsOrTypes"] == [label] and tuple(constraint["properties"]) == key_names for constraint in constraints):
+                    report["existing"].append(name)
+                    continue
+                try:
+                    self.query(schema.constraint_statement(label, key_names))
+                    report["created"].append(name)
+                except Neo4jError as e:
+                    report["errors"][name] = e.message or str(e)
+                    if not self._covered(label, key_names, indexes, online_only=False):
+                        self.query(schema.index_statement(label, key_names))
+                    report["indexes"].append(name)
+        self.query("CALL db.awaitIndexes($seconds)", {"seconds": await_seconds})
+        if measure:
+            after = self.merge_latency(schema, samples)
+            report["latency"] = {name: (before.get(name), after.get(name)) for name in after}
+        return report
+
+    @staticmethod
+    def format_report(report: dict) -> str:
+        lines = [f"Constraints: {len(report['created'])} created, {len(report['existing'])} already present, {len(report['indexes'])} replaced by an index"]
+        lines.extend(f"  {name}: {error}" for name, error in report["errors"].items())
+        for name, (before, after) in report["latency"].items():
+            if before is not None and after is not None:
+                lines.append(f"  MERGE {name}: {before:.2f} ms -> {after:.2f} ms")
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the Neo4j constraints and indexes of the node labels of a graph_params file.")
+    parser.add_argument("params", help="JSON file with the allowed_nodes and allowed_relationships, like demo.graph_params.")
+    parser.add_argument("--key", action="append", help="Key property of every label, repeatable. Comma-separated names make a composite key. Default is id.")
+    parser.add_argument("--database", default=os.environ.get("NEO4J_DB_NAME"), help="The Neo4j database.")
+    parser.add_argument("--measure", action="store_true", help="Measure the MERGE latency before and after.")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the statements.")
+    args = parser.parse_args()
+
+    with open(args.params, "r", encoding="utf-8") as f:
+        graph_params = json.load(f)
+    keys = [tuple(key.split(",")) for key in args.key] if args.key else DEFAULT_KEY_PROPERTIES
+    graph_schema = GraphSchema.from_graph_params(graph_params["allowed_nodes"], graph_params.get("allowed_relationships", []), keys)
+    if args.dry_run:
+        print("\n".join(graph_schema.statements()))
+    else:
+        neo4j_driver = GraphDatabase.driver(os.environ["NEO4J_URI"], auth=(os.environ["NEO4J_USERNAME"], os.environ["NEO4J_PASSWORD"]))
+        try:
+            print(GraphSchemaManager.format_report(GraphSchemaManager(driver_query(neo4j_driver, args.database)).ensure(graph_schema, measure=args.measure)))
+        finally:
+            neo4j_driver.close()
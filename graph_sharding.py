@@ -0,0 +1,289 @@
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from neo4j import Driver, GraphDatabase
+from neo4j.exceptions import Neo4jError
+
+from graph_schema import GraphSchema, GraphSchemaManager, driver_query
+from graph_sink import DEFAULT_BATCH_SIZE, GraphBatch, Neo4jGraphSink
+from text_vectors import normalize_text
+
+DEFAULT_CATALOG_PATH = "output/shard_catalog.sqlite"
+DEFAULT_DATABASE_PREFIX = "ingestor"
+DEFAULT_SHARD_KEY = "default"
+DATABASE_WAIT_SECONDS = 60
+# Neo4j database names: ASCII letters, digits, dots and dashes, starting with a letter, at most 63 characters
+_DATABASE_NAME_INVALID = re.compile(r"[^a-z0-9.-]+")
+MAX_DATABASE_NAME_LENGTH = 63
+
+
+def _stable_hash(key: str) -> int:
+    # Python's hash() is salted per process, the placement must not be
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def database_name(prefix: str, key: str) -> str:
+    """
+    Builds a valid Neo4j database name for a shard key, e.g. "ingestor-pandora" for the planet "Pandora".
+    Keys too long for a database name are truncated and suffixed with a hash, so distinct keys keep distinct databases.
+    """
+    slug = _DATABASE_NAME_INVALID.sub("-", normalize_text(key)).strip("-.") or DEFAULT_SHARD_KEY
+    name = f"{prefix}-{slug}"
+    if len(name) > MAX_DATABASE_NAME_LENGTH:
+        suffix = f"{_stable_hash(key):x}"[:8]
+        name = f"{name[:MAX_DATABASE_NAME_LENGTH - len(suffix) - 1].rstrip('-.')}-{suffix}"
+    return name
+
+
+class ShardCatalog:
+
+    def __init__(self, path: str = DEFAULT_CATALOG_PATH):
+        """
+        Initializes the ShardCatalog class, the SQLite record of the shards, of the shard every key is placed on and of where every source landed.
+        Placements are sticky: once a key has a shard, adding servers does not move it.
+
+        Parameters:
+        path (str): The path to the SQLite file. It is created if missing.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS shards (uri TEXT NOT NULL, database TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (uri, database))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS shard_keys (shard_key TEXT PRIMARY KEY, uri TEXT NOT NULL, database TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS placements ("
+                                "source TEXT NOT NULL, shard_key TEXT NOT NULL, uri TEXT NOT NULL, database TEXT NOT NULL, written_at REAL NOT NULL, "
+                                "nodes INTEGER NOT NULL DEFAULT 0, relationships INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (source, uri, database))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS placements_shard ON placements (uri, database)")
+        self.connection.commit()
+
+    def shard_of(self, key: str) -> Optional[Tuple[str, str]]:
+        """
+        Returns the (uri, database) shard of a key, or None if the key was never placed.
+        """
+        row = self.connection.execute("SELECT uri, database FROM shard_keys WHERE shard_key = ?", (key,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def place(self, key: str, uri: str, database: str) -> Tuple[str, str]:
+        """
+        Places a key on a shard, unless it already has one. Returns the shard of the key.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO shard_keys (shard_key, uri, database) VALUES (?, ?, ?)", (key, uri, database))
+            self.connection.execute("INSERT OR IGNORE INTO shards (uri, database, created_at) VALUES (?, ?, ?)", (uri, database, time.time()))
+        return self.shard_of(key)
+
+    def record(self, source: str, key: str, uri: str, database: str, nodes: int, relationships: int) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("INSERT INTO placements (source, shard_key, uri, database, written_at, nodes, relationships) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                                    "ON CONFLICT (source, uri, database) DO UPDATE SET shard_key = excluded.shard_key, written_at = excluded.written_at, "
+                                    "nodes = excluded.nodes, relationships = excluded.relationships",
+                                    (source, key, uri, database, time.time(), nodes, relationships))
+
+    def where(self, source: str) -> List[dict]:
+        """
+        Returns the shards a source was written to, with its shard key and the nodes and relationships of its batch.
+        """
+        rows = self.connection.execute("SELECT shard_key, uri, database, written_at, nodes, relationships FROM placements WHERE source = ? ORDER BY written_at",
+                                       (source,)).fetchall()
+        return [{"shard_key": row[0], "uri": row[1], "database": row[2], "written_at": row[3], "nodes": row[4], "relationships": row[5]} for row in rows]
+
+    def shards(self) -> List[dict]:
+        """
+        Returns every shard with its number of keys and sources.
+        """
+        rows = self.connection.execute("SELECT s.uri, s.database, "
+                                       "(SELECT COUNT(*) FROM shard_keys k WHERE k.uri = s.uri AND k.database = s.database), "
+                                       "(SELECT COUNT(*) FROM placements p WHERE p.uri = s.uri AND p.database = s.database) "
+                                       "FROM shards s ORDER BY s.uri, s.database").fetchall()
+        return [{"uri": row[0], "database": row[1], "keys": row[2], "sources": row[3]} for row in rows]
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def servers_from_env() -> List[dict]:
+    """
+    Reads the Neo4j servers of the shards: NEO4J_SHARD_URIS, a comma-separated list of URIs, or NEO4J_URI, with NEO4J_USERNAME and NEO4J_PASSWORD for all of them.
+    """
+    uris = [uri.strip() for uri in os.environ.get("NEO4J_SHARD_URIS", os.environ.get("NEO4J_URI", "")).split(",") if uri.strip()]
+    if not uris:
+        raise ValueError("Neo4j URL not provided.")
+    return [{"uri": uri, "username": os.environ["NEO4J_USERNAME"], "password": os.environ["NEO4J_PASSWORD"]} for uri in uris]
+
+
+class ShardedGraphWriter:
+
+    def __init__(self, servers: Optional[List[dict]] = None, catalog: Optional[ShardCatalog] = None, database_prefix: str = DEFAULT_DATABASE_PREFIX,
+                 max_shards: Optional[int] = None, schema: Optional[GraphSchema] = None, max_workers: Optional[int] = None, batch_size: int = DEFAULT_BATCH_SIZE):
+        """
+        Initializes the ShardedGraphWriter class, routing items to one of several Neo4j databases or servers by a shard key
+        (e.g. planet, restaurant or source collection) and writing the shards in parallel, each with its own locks and transaction log.
+        Shards are created on demand. New keys are placed on a server by a stable hash of the key, and the catalog keeps them there.
+
+        Parameters:
+        servers (List[dict]): The servers, each with its "uri", "username" and "password". A server with a "database" is a single shard,
+        e.g. a Neo4j Community server, which has one database only. Default is servers_from_env().
+        catalog (ShardCatalog): The catalog of shards and placements. Default is a catalog at DEFAULT_CATALOG_PATH.
+        database_prefix (str): The prefix of the database names of the shards.
+        max_shards (int): If given, keys are hashed into this many databases ("ingestor-0", "ingestor-1", ...), instead of one database per key.
+        schema (GraphSchema): If given, its constraints and indexes are created in every new shard.
+        max_workers (int): The number of shards written at the same time. Default is one thread per shard of the write.
+        batch_size (int): The number of rows per statement.
+        """
+        self.servers = servers or servers_from_env()
+        self.catalog = catalog or ShardCatalog()
+        self.database_prefix = database_prefix
+        self.max_shards = max_shards
+        self.schema = schema
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.drivers: Dict[str, Driver] = {}
+        self.sinks: Dict[Tuple[str, str], Neo4jGraphSink] = {}
+        self.ready = set()
+        self.lock = threading.Lock()
+
+    def _driver(self, uri: str) -> Driver:
+        if uri not in self.drivers:
+            server = next((server for server in self.servers if server["uri"] == uri), None)
+            if server is None:
+                raise ValueError(f"The catalog places shards on {uri}, which is not among the configured servers.")
+            self.drivers[uri] = GraphDatabase.driver(uri, auth=(server["username"], server["password"]))
+        return self.drivers[uri]
+
+    def _new_shard(self, key: str) -> Tuple[str, str]:
+        bucket = _stable_hash(key) % self.max_shards if self.max_shards else None
+        server = self.servers[(bucket if bucket is not None else _stable_hash(key)) % len(self.servers)]
+        if server.get("database"):
+            return server["uri"], server["database"]
+        if bucket is not None:
+            return server["uri"], f"{self.database_prefix}-{bucket}"
+        return server["uri"], database_name(self.database_prefix, key)
+
+    def _create_database(self, uri: str, database: str) -> None:
+        try:
+            with self._driver(uri).session(database="system") as session:
+                session.run(f"CREATE DATABASE `{database}` IF NOT EXISTS WAIT {DATABASE_WAIT_SECONDS} SECONDS").consume()
+        except Neo4jError as e:
+            raise ValueError(f"Cannot create the shard database {database} on {uri}: {e.message}. Servers without multiple databases, like Neo4j Community, "
+                             "must be given with their \"database\", one shard per server.") from e
+        print(f"Created shard {database} on {uri}")
+
+    def shard_for(self, key: Optional[str]) -> Tuple[str, str]:
+        """
+        Returns the (uri, database) shard of a key, placing the key and creating its database on first use.
+
+        Parameters:
+        key (str): The shard key. Items without a key go to the DEFAULT_SHARD_KEY shard.
+
+        Returns:
+        Tuple[str, str]: The URI of the server and the database.
+        """
+        key = str(key) if key not in (None, "") else DEFAULT_SHARD_KEY
+        shard = self.catalog.shard_of(key) or self._new_shard(key)
+        self._prepare(shard)
+        # The key is placed only once its database exists, so a failed creation does not leave it pinned to a missing shard
+        placed = self.catalog.place(key, *shard)
+        if placed != shard:
+            # Another writer placed the key meanwhile
+            self._prepare(placed)
+        return placed
+
+    def _prepare(self, shard: Tuple[str, str]) -> None:
+        with self.lock:
+            if shard not in self.ready:
+                uri, database = shard
+                if not any(server["uri"] == uri and server.get("database") for server in self.servers):
+                    self._create_database(uri, database)
+                if self.schema is not None:
+                    print(GraphSchemaManager.format_report(GraphSchemaManager(driver_query(self._driver(uri), database)).ensure(self.schema)))
+                self.sinks[shard] = Neo4jGraphSink(self._driver(uri), database, self.batch_size)
+                self.ready.add(shard)
+
+    def write(self, items: Iterable[Any], key: Callable[[Any], Optional[str]], to_batch: Callable[[List[Any]], GraphBatch],
+              source: Optional[Callable[[Any], Optional[str]]] = None) -> dict:
+        """
+        Groups items by shard, builds one batch per shard and writes the shards in parallel. Every source is recorded in the catalog.
+
+        Parameters:
+        items (Iterable[Any]): The items, e.g. the extracted menus or graph documents.
+        key (Callable[[Any], Optional[str]]): Returns the shard key of an item.
+        to_batch (Callable[[List[Any]], GraphBatch]): Builds the batch of the items of a shard.
+        source (Callable[[Any], Optional[str]]): Returns the source of an item, for the catalog. Default is the shard key.
+
+        Returns:
+        dict: The "shards" written, with their nodes, relationships and seconds, and the "seconds" of the whole write.
+        """
+        start = time.perf_counter()
+        groups: Dict[Tuple[str, str], List[Tuple[str, Any]]] = {}
+        for item in items:
+            item_key = key(item)
+            item_key = str(item_key) if item_key not in (None, "") else DEFAULT_SHARD_KEY
+            groups.setdefault(self.shard_for(item_key), []).append((item_key, item))
+
+        def write_shard(shard: Tuple[str, str], keyed_items: List[Tuple[str, Any]]) -> dict:
+            shard_start = time.perf_counter()
+            batch = to_batch([item for _, item in keyed_items])
+            self.sinks[shard].write_batch(batch)
+            # Every source is recorded with the nodes and relationships of its own items, not of the whole shard
+            sources: Dict[Tuple[str, str], List[Any]] = {}
+            for item_key, item in keyed_items:
+                item_source = source(item) if source is not None else None
+                sources.setdefault((item_source or item_key, item_key), []).append(item)
+            for (item_source, item_key), source_items in sources.items():
+                source_batch = batch if len(sources) == 1 else to_batch(source_items)
+                self.catalog.record(item_source, item_key, shard[0], shard[1], len(source_batch.nodes), len(source_batch.relationships))
+            return {"uri": shard[0], "database": shard[1], "items": len(keyed_items), "nodes": len(batch.nodes), "relationships": len(batch.relationships),
+                    "seconds": time.perf_counter() - shard_start}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers or max(len(groups), 1)) as executor:
+            futures = [executor.submit(write_shard, shard, keyed_items) for shard, keyed_items in groups.items()]
+            shards = [future.result() for future in futures]
+        return {"shards": shards, "seconds": time.perf_counter() - start}
+
+    @staticmethod
+    def format_report(report: dict) -> str:
+        lines = [f"Wrote {len(report['shards'])} shards in {report['seconds']:.2f}s"]
+        lines.extend(f"  {shard['database']} on {shard['uri']}: {shard['items']} items, {shard['nodes']} nodes and {shard['relationships']} relationships "
+                     f"in {shard['seconds']:.2f}s" for shard in report["shards"])
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        for driver in self.drivers.values():
+            driver.close()
+        self.drivers, self.sinks, self.ready = {}, {}, set()
+        self.catalog.close()
+
+    def __enter__(self) -> "ShardedGraphWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the shards of the catalog and where the sources landed.")
+    parser.add_argument("catalog", nargs="?", default=DEFAULT_CATALOG_PATH, help="The catalog file.")
+    parser.add_argument("--source", help="Only show the shards of this source.")
+    args = parser.parse_args()
+
+    shard_catalog = ShardCatalog(args.catalog)
+    try:
+        if args.source:
+            for placement in shard_catalog.where(args.source):
+                print(f"{args.source} [{placement['shard_key']}] -> {placement['database']} on {placement['uri']}: "
+                      f"{placement['nodes']} nodes, {placement['relationships']} relationships")
+        else:
+            for shard in shard_catalog.shards():
+                print(f"{shard['database']} on {shard['uri']}: {shard['keys']} keys, {shard['sources']} sources")
+    finally:
+        shard_catalog.close()
@@ -0,0 +1,340 @@
+import json
+import os
+import sqlite3
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from neo4j import Driver, GraphDatabase
+
+from graph_consolidation import ConsolidatedGraph
+from graph_schema import MERGE_KEY_PROPERTY, GraphSchemaManager, driver_query
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_SINK = "neo4j"
+SQLITE_PREFIX = "sqlite:"
+
+Key = Tuple[Tuple[str, object], ...]
+
+
+def _key(values: dict) -> Key:
+    return tuple(sorted(values.items()))
+
+
+class GraphBatch:
+
+    def __init__(self):
+        """
+        Initializes the GraphBatch class, an in-memory set of nodes and relationships to write with a GraphSink.
+        Nodes are identified by their label and key properties; adding the same node or relationship twice merges its properties.
+        """
+        self.nodes: Dict[Tuple[str, Key], dict] = {}
+        self.relationships: Dict[Tuple[str, str, Key, str, Key], dict] = {}
+
+    def add_node(self, label: str, key: dict, properties: Optional[dict] = None) -> None:
+        """
+        Adds a node. Nodes with a null key property are skipped, as Neo4j cannot MERGE on null.
+
+        Parameters:
+        label (str): The node label.
+        key (dict): The properties identifying the node, e.g. {"name": "Pandora"}.
+        properties (dict): The other properties.
+        """
+        if any(value is None for value in key.values()):
+            return
+        self.nodes.setdefault((label, _key(key)), {}).update(properties or {})
+
+    def add_relationship(self, rel_type: str, source_label: str, source_key: dict, target_label: str, target_key: dict, properties: Optional[dict] = None) -> None:
+        """
+        Adds a relationship. Its endpoints are created if they were not added as nodes.
+
+        Parameters:
+        rel_type (str): The relationship type.
+        source_label (str): The label of the start node.
+        source_key (dict): The key properties of the start node.
+        target_label (str): The label of the end node.
+        target_key (dict): The key properties of the end node.
+        properties (dict): The relationship properties.
+        """
+        if any(value is None for value in (*source_key.values(), *target_key.values())):
+            return
+        self.add_node(source_label, source_key)
+        self.add_node(target_label, target_key)
+        self.relationships.setdefault((rel_type, source_label, _key(source_key), target_label, _key(target_key)), {}).update(properties or {})
+
+    @classmethod
+    def from_consolidated(cls, graph: ConsolidatedGraph, id_property: str = "id") -> "GraphBatch":
+        """
+        Converts a consolidated batch of graph documents. Nodes are keyed by their normalized id, the merge_key property,
+        so every spelling of an id lands on the same node across batches; the id itself is a property.
+        """
+        batch = cls()
+        for entry in graph.nodes.values():
+            batch.add_node(entry["label"], {MERGE_KEY_PROPERTY: entry["key"]}, {**entry["properties"], id_property: entry["id"]})
+        for (rel_type, source_key, target_key), entry in graph.relationships.items():
+            source, target = graph.nodes[source_key], graph.nodes[target_key]
+            batch.add_relationship(rel_type, source["label"], {MERGE_KEY_PROPERTY: source["key"]}, target["label"], {MERGE_KEY_PROPERTY: target["key"]},
+                                   entry["properties"])
+        return batch
+
+    @classmethod
+    def from_graph_documents(cls, docs: list, id_property: str = "id") -> "GraphBatch":
+        """
+        Consolidates graph documents (see graph_consolidation) into a batch.
+        """
+        consolidated = ConsolidatedGraph()
+        for graph_doc in docs:
+            consolidated.add(graph_doc)
+        return cls.from_consolidated(consolidated, id_property)
+
+    def node_groups(self) -> Dict[Tuple[str, Tuple[str, ...]], List[dict]]:
+        """
+        Groups the node rows by label and key property names, i.e. by the statement that writes them.
+        """
+        groups = defaultdict(list)
+        for (label, key), properties in self.nodes.items():
+            groups[(label, tuple(name for name, _ in key))].append({"key": dict(key), "properties": properties})
+        return groups
+
+    def relationship_groups(self) -> Dict[Tuple[str, str, Tuple[str, ...], str, Tuple[str, ...]], List[dict]]:
+        groups = defaultdict(list)
+        for (rel_type, source_label, source_key, target_label, target_key), properties in self.relationships.items():
+            signature = (rel_type, source_label, tuple(name for name, _ in source_key), target_label, tuple(name for name, _ in target_key))
+            groups[signature].append({"source": dict(source_key), "target": dict(target_key), "properties": properties})
+        return groups
+
+
+class GraphSink:
+    """
+    Base class of the graph write targets. Subclasses implement _write_nodes and _write_relationships; the time spent in them is measured here,
+    so the cost of the database client can be told apart from the extraction.
+    """
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.stats = {"nodes": 0, "relationships": 0, "statements": 0, "write_seconds": 0.0}
+
+    def _write_nodes(self, label: str, key_names: Tuple[str, ...], rows: List[dict]) -> None:
+        raise NotImplementedError
+
+    def _write_relationships(self, rel_type: str, source_label: str, source_key_names: Tuple[str, ...],
+                             target_label: str, target_key_names: Tuple[str, ...], rows: List[dict]) -> None:
+        raise NotImplementedError
+
+    def write_batch(self, batch: GraphBatch) -> None:
+        """
+        Writes a batch, all the nodes first and then the relationships.
+
+        Parameters:
+        batch (GraphBatch): The nodes and relationships to write.
+
+        Returns:
+        None
+        """
+        start = time.perf_counter()
+        for (label, key_names), rows in batch.node_groups().items():
+            for offset in range(0, len(rows), self.batch_size):
+                self._write_nodes(label, key_names, rows[offset:offset + self.batch_size])
+                self.stats["statements"] += 1
+            self.stats["nodes"] += len(rows)
+        for signature, rows in batch.relationship_groups().items():
+            for offset in range(0, len(rows), self.batch_size):
+                self._write_relationships(*signature, rows[offset:offset + self.batch_size])
+                self.stats["statements"] += 1
+            self.stats["relationships"] += len(rows)
+        self.stats["write_seconds"] += time.perf_counter() - start
+
+    def write_graph_documents(self, docs: list, id_property: str = "id") -> None:
+        """
+        Consolidates graph documents (see graph_consolidation) and writes them.
+
+        Parameters:
+        docs (list[GraphDocument]): The graph documents.
+        id_property (str): The node property holding the node id.
+
+        Returns:
+        None
+        """
+        self.write_batch(GraphBatch.from_graph_documents(docs, id_property))
+
+    def report(self) -> str:
+        return (f"{type(self).__name__}: {self.stats['nodes']} nodes and {self.stats['relationships']} relationships "
+                f"in {self.stats['statements']} statements, {self.stats['write_seconds']:.2f}s spent writing")
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "GraphSink":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _cypher_map(names: Tuple[str, ...], variable: str) -> str:
+    return "{" + ", ".join(f"`{name}`: {variable}.`{name}`" for name in names) + "}"
+
+
+def _escape(name: str) -> str:
+    return str(name).replace("`", "")
+
+
+class Neo4jGraphSink(GraphSink):
+
+    def __init__(self, driver: Driver, database: Optional[str] = None, batch_size: int = DEFAULT_BATCH_SIZE, close_driver: bool = False, check_indexes: bool = True):
+        """
+        Initializes the Neo4jGraphSink class, writing with one UNWIND MERGE statement per label or relationship type and batch.
+
+        Parameters:
+        driver (Driver): The Neo4j driver.
+        database (str): The Neo4j database. Default is the server default database.
+        batch_size (int): The number of rows per statement.
+        close_driver (bool): Whether close() also closes the driver.
+        check_indexes (bool): Whether to report the labels written without an index on their key, whose MERGEs scan every node of the label.
+        See graph_schema to create the constraints.
+        """
+        super().__init__(batch_size)
+        self.driver = driver
+        self.database = database
+        self.close_driver = close_driver
+        self.check_indexes = check_indexes
+        self.checked_signatures = set()
+        self.missing_indexes: List[Tuple[str, Tuple[str, ...]]] = []
+
+    def _run(self, query: str, rows: List[dict]) -> None:
+        with self.driver.session(database=self.database) as session:
+            session.execute_write(lambda tx: tx.run(query, rows=rows).consume())
+
+    def write_batch(self, batch: GraphBatch) -> None:
+        if self.check_indexes:
+            signatures = [signature for signature in batch.node_groups() if signature not in self.checked_signatures]
+            if signatures:
+                missing = GraphSchemaManager(driver_query(self.driver, self.database)).missing_indexes(signatures)
+                for label, key_names in missing:
+                    print(f"No index for MERGE on :{label}({', '.join(key_names)}), every write scans all the {label} nodes.")
+                self.missing_indexes.extend(missing)
+                self.checked_signatures.update(signatures)
+        super().write_batch(batch)
+
+    def report(self) -> str:
+        report = super().report()
+        if self.missing_indexes:
+            report += f", {len(self.missing_indexes)} labels without an index: " + ", ".join(f"{label}({', '.join(key_names)})" for label, key_names in self.missing_indexes)
+        return report
+
+    def _write_nodes(self, label, key_names, rows):
+        self._run(f"UNWIND $rows AS row MERGE (n:`{_escape(label)}` {_cypher_map(key_names, 'row.key')}) SET n += row.properties", rows)
+
+    def _write_relationships(self, rel_type, source_label, source_key_names, target_label, target_key_names, rows):
+        self._run("UNWIND $rows AS row "
+                  f"MERGE (s:`{_escape(source_label)}` {_cypher_map(source_key_names, 'row.source')}) "
+                  f"MERGE (t:`{_escape(target_label)}` {_cypher_map(target_key_names, 'row.target')}) "
+                  f"MERGE (s)-[r:`{_escape(rel_type)}`]->(t) SET r += row.properties", rows)
+
+    def close(self) -> None:
+        if self.close_driver:
+            self.driver.close()
+
+
+class SQLiteGraphSink(GraphSink):
+
+    def __init__(self, path: str, batch_size: int = DEFAULT_BATCH_SIZE):
+        """
+        Initializes the SQLiteGraphSink class, an embedded graph store for local runs and write-path benchmarks.
+        Nodes are unique on (label, key) and relationships on (type, endpoints); properties are merged like Cypher SET +=.
+
+        Parameters:
+        path (str): The path to the SQLite file, or ":memory:".
+        batch_size (int): The number of rows per transaction.
+        """
+        super().__init__(batch_size)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS nodes (
+                label TEXT NOT NULL, key TEXT NOT NULL, properties TEXT NOT NULL DEFAULT '{}',
+                PRIMARY KEY (label, key));
+            CREATE INDEX IF NOT EXISTS nodes_key ON nodes (key);
+            CREATE TABLE IF NOT EXISTS relationships (
+                type TEXT NOT NULL, source_label TEXT NOT NULL, source_key TEXT NOT NULL,
+                target_label TEXT NOT NULL, target_key TEXT NOT NULL, properties TEXT NOT NULL DEFAULT '{}',
+                PRIMARY KEY (source_label, source_key, type, target_label, target_key));
+            CREATE INDEX IF NOT EXISTS relationships_target ON relationships (target_label, target_key, type);
+            CREATE INDEX IF NOT EXISTS relationships_type ON relationships (type);
+        """)
+
+    @staticmethod
+    def _dumps(value: dict) -> str:
+        return json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+
+    def _write_nodes(self, label, key_names, rows):
+        with self.connection:
+            self.connection.executemany("INSERT INTO nodes (label, key, properties) VALUES (?, ?, ?) "
+                                        "ON CONFLICT (label, key) DO UPDATE SET properties = json_patch(nodes.properties, excluded.properties)",
+                                        [(label, self._dumps(row["key"]), self._dumps(row["properties"])) for row in rows])
+
+    def _write_relationships(self, rel_type, source_label, source_key_names, target_label, target_key_names, rows):
+        with self.connection:
+            # Endpoints are created like the MERGEs of the Neo4j sink
+            self.connection.executemany("INSERT OR IGNORE INTO nodes (label, key) VALUES (?, ?)",
+                                        [(label, self._dumps(row[side])) for row in rows
+                                         for label, side in ((source_label, "source"), (target_label, "target"))])
+            self.connection.executemany("INSERT INTO relationships (type, source_label, source_key, target_label, target_key, properties) VALUES (?, ?, ?, ?, ?, ?) "
+                                        "ON CONFLICT (source_label, source_key, type, target_label, target_key) "
+                                        "DO UPDATE SET properties = json_patch(relationships.properties, excluded.properties)",
+                                        [(rel_type, source_label, self._dumps(row["source"]), target_label, self._dumps(row["target"]), self._dumps(row["properties"]))
+                                         for row in rows])
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def ensure_database(driver: Driver, database: str) -> None:
+    """
+    Creates a Neo4j database if it does not exist yet, and waits for it to come online.
+    """
+    with driver.session(database="system") as session:
+        if session.run("SHOW DATABASES YIELD name WHERE name = $name RETURN name", name=database).single() is None:
+            print(f"Database {database} not found, creating a new one...")
+            session.run(f"CREATE DATABASE `{database}` WAIT").consume()
+
+
+def get_graph_sink(config: Optional[str] = None, database: Optional[str] = None, batch_size: int = DEFAULT_BATCH_SIZE, url: Optional[str] = None,
+                   username: Optional[str] = None, password: Optional[str] = None, create_database: bool = False) -> GraphSink:
+    """
+    Creates the graph sink selected by configuration: "neo4j" connects to Neo4j, by default with the NEO4J_URI, NEO4J_USERNAME and NEO4J_PASSWORD
+    environment variables, "sqlite:<path>" opens an embedded SQLite graph.
+
+    Parameters:
+    config (str): The sink configuration. Default is the GRAPH_SINK environment variable, or "neo4j".
+    database (str): The Neo4j database. Default is the NEO4J_DB_NAME environment variable.
+    batch_size (int): The number of rows per statement.
+    url (str): The URL of the Neo4j server. Default is the NEO4J_URI environment variable.
+    username (str): The Neo4j username. Default is the NEO4J_USERNAME environment variable.
+    password (str): The Neo4j password. Default is the NEO4J_PASSWORD environment variable.
+    create_database (bool): Whether to create the Neo4j database if it does not exist, like optimus_prime.connect_knowledge_graph.
+
+    Returns:
+    GraphSink: The sink. Close it when done.
+    """
+    config = config or os.environ.get("GRAPH_SINK", DEFAULT_SINK)
+    if config.startswith(SQLITE_PREFIX):
+        return SQLiteGraphSink(config[len(SQLITE_PREFIX):], batch_size)
+    if config == "neo4j":
+        if not (url := url or os.environ.get("NEO4J_URI")):
+            raise ValueError("Neo4j URL not provided.")
+        if not (username := username or os.environ.get("NEO4J_USERNAME")):
+            raise ValueError("Neo4j username not provided.")
+        if not (password := password or os.environ.get("NEO4J_PASSWORD")):
+            raise ValueError("Neo4j password not provided.")
+        database = database or os.environ.get("NEO4J_DB_NAME")
+        driver = GraphDatabase.driver(url, auth=(username, password))
+        if create_database and database:
+            try:
+                ensure_database(driver, database)
+            except Exception:
+                driver.close()
+                raise
+        return Neo4jGraphSink(driver, database, batch_size, close_driver=True)
+    raise ValueError(f"Unsupported graph sink: {config}. Use \"neo4j\" or \"sqlite:<path>\".")
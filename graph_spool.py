@@ -0,0 +1,219 @@
+import argparse
+import gzip
+import hashlib
+import os
+import time
+from typing import Iterator, List, Optional
+
+import orjson
+from langchain_community.graphs.graph_document import GraphDocument, Node, Relationship
+from langchain_core.documents import Document
+
+from graph_sink import get_graph_sink
+
+SPOOL_SUFFIX = ".json.gz"
+DEFAULT_REPLAY_BATCH_SIZE = 500
+
+
+def graph_document_to_dict(graph_doc: GraphDocument) -> dict:
+    """
+    Serializes the nodes and relationships of a graph document to a JSON-compatible dict. The source document is not included.
+
+    Parameters:
+    graph_doc (GraphDocument): The graph document.
+
+    Returns:
+    dict: The "nodes" and "relationships" of the graph document.
+    """
+    return {
+        "nodes": [{"id": node.id, "type": node.type, "properties": node.properties} for node in graph_doc.nodes],
+        "relationships": [{"source": {"id": rel.source.id, "type": rel.source.type},
+                           "target": {"id": rel.target.id, "type": rel.target.type},
+                           "type": rel.type,
+                           "properties": rel.properties} for rel in graph_doc.relationships],
+    }
+
+
+def graph_document_from_dict(data: dict, source: Document) -> GraphDocument:
+    """
+    Rebuilds a graph document serialized with graph_document_to_dict.
+
+    Parameters:
+    data (dict): The serialized nodes and relationships.
+    source (Document): The source document to attach.
+
+    Returns:
+    GraphDocument: The graph document.
+    """
+    nodes = [Node(id=node["id"], type=node["type"], properties=node.get("properties") or {}) for node in data.get("nodes", [])]
+    relationships = [Relationship(source=Node(id=rel["source"]["id"], type=rel["source"]["type"]),
+                                  target=Node(id=rel["target"]["id"], type=rel["target"]["type"]),
+                                  type=rel["type"],
+                                  properties=rel.get("properties") or {}) for rel in data.get("relationships", [])]
+    return GraphDocument(nodes=nodes, relationships=relationships, source=source)
+
+
+def section_key(doc: Document) -> str:
+    """
+    Returns the content address of a source section: a hash of its source file, its document context and its text.
+
+    Parameters:
+    doc (Document): The source section.
+
+    Returns:
+    str: The hexadecimal key.
+    """
+    content = f"{doc.metadata.get('source', '')}\0{doc.metadata.get('document_context') or ''}\0{doc.page_content}".encode("utf-8")
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def extraction_fingerprint(settings: dict) -> str:
+    """
+    Returns a hash of the settings graph documents are extracted with, e.g. the allowed nodes and relationships, the properties and the model.
+
+    Parameters:
+    settings (dict): The extraction settings, JSON-serializable.
+
+    Returns:
+    str: The hexadecimal fingerprint.
+    """
+    return hashlib.blake2b(orjson.dumps(settings, option=orjson.OPT_SORT_KEYS, default=str), digest_size=16).hexdigest()
+
+
+class GraphSpool:
+
+    def __init__(self, directory: str, fingerprint: Optional[str] = None):
+        """
+        Initializes the GraphSpool class, a durable local copy of the graph documents produced by the LLM.
+        Every graph document is stored with its source section as gzip-compressed orjson, in a file named after the section key,
+        so re-running the same section overwrites its entry instead of duplicating it.
+
+        Parameters:
+        directory (str): The spool directory. It is created if missing.
+        fingerprint (str): The extraction_fingerprint of the current settings. It is stored with every entry, and get ignores
+        the entries extracted with other settings, so changing the schema or the model does not return stale graphs.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fingerprint = fingerprint
+
+    def _path(self, key: str) -> str:
+        # Two-level fan-out keeps directories small with hundreds of thousands of sections
+        return os.path.join(self.directory, key[:2], f"{key}{SPOOL_SUFFIX}")
+
+    def write(self, graph_doc: GraphDocument) -> str:
+        """
+        Persists a graph document. The file is written next to its final path and renamed, so a crash never leaves a partial entry.
+
+        Parameters:
+        graph_doc (GraphDocument): The graph document, with its source section.
+
+        Returns:
+        str: The section key.
+        """
+        key = section_key(graph_doc.source)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        record = {
+            "key": key,
+            "fingerprint": self.fingerprint,
+            "source": {"page_content": graph_doc.source.page_content, "metadata": graph_doc.source.metadata},
+            "graph": graph_document_to_dict(graph_doc),
+        }
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wb", compresslevel=6) as f:
+            f.write(orjson.dumps(record))
+        os.replace(tmp_path, path)
+        return key
+
+    def get(self, doc: Document) -> Optional[GraphDocument]:
+        """
+        Returns the spooled graph document of a source section, or None if the section was never converted, or was converted with other settings.
+        """
+        path = self._path(section_key(doc))
+        if not os.path.exists(path):
+            return None
+        record = self._load(path)
+        if self.fingerprint is not None and record.get("fingerprint") != self.fingerprint:
+            return None
+        return self._to_graph_document(record)
+
+    @staticmethod
+    def _load(path: str) -> dict:
+        with gzip.open(path, "rb") as f:
+            return orjson.loads(f.read())
+
+    @staticmethod
+    def _to_graph_document(record: dict) -> GraphDocument:
+        source = Document(page_content=record["source"]["page_content"], metadata=record["source"]["metadata"])
+        return graph_document_from_dict(record["graph"], source)
+
+    def _read(self, path: str) -> GraphDocument:
+        return self._to_graph_document(self._load(path))
+
+    def keys(self) -> List[str]:
+        """
+        Returns the keys of all spooled sections, sorted.
+        """
+        keys = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir():
+                keys.extend(name[:-len(SPOOL_SUFFIX)] for name in os.listdir(entry.path) if name.endswith(SPOOL_SUFFIX))
+        return sorted(keys)
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __iter__(self) -> Iterator[GraphDocument]:
+        """
+        Streams the spooled graph documents, one file at a time.
+        """
+        for key in self.keys():
+            yield self._read(self._path(key))
+
+    def iter_batches(self, batch_size: int = DEFAULT_REPLAY_BATCH_SIZE) -> Iterator[List[GraphDocument]]:
+        batch = []
+        for graph_doc in self:
+            batch.append(graph_doc)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def replay(spool_directory: str, batch_size: int = DEFAULT_REPLAY_BATCH_SIZE, kg_db_name: Optional[str] = None) -> int:
+    """
+    Writes the content of a spool into a Neo4j database, or the graph sink selected by the GRAPH_SINK environment variable, without calling the LLM again.
+    Every batch is consolidated, so each distinct node and relationship is written once with UNWIND statements.
+
+    Parameters:
+    spool_directory (str): The spool directory.
+    batch_size (int): The number of graph documents written per call.
+    kg_db_name (str): The target database, created if missing. Default is the NEO4J_DB_NAME environment variable.
+
+    Returns:
+    int: The number of graph documents written.
+    """
+    # The database is passed to the sink rather than set in NEO4J_DB_NAME, which would redirect every later write of the process
+    graph_sink = get_graph_sink(database=kg_db_name, create_database=True)
+    written = 0
+    start = time.perf_counter()
+    try:
+        for batch in GraphSpool(spool_directory).iter_batches(batch_size):
+            graph_sink.write_graph_documents(batch)
+            written += len(batch)
+            print(f"Replayed {written} graph documents ({written / (time.perf_counter() - start):.0f}/s)")
+    finally:
+        graph_sink.close()
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay spooled graph documents into Neo4j without re-running the LLM.")
+    parser.add_argument("spool_directory", help="Directory of the spool written by create_knowledge_graph_schema.")
+    parser.add_argument("--database", help="Target database. Default is NEO4J_DB_NAME.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_REPLAY_BATCH_SIZE)
+    args = parser.parse_args()
+
+    replay(args.spool_directory, args.batch_size, args.database)
@@ -0,0 +1,363 @@
+import argparse
+import asyncio
+import json
+import os
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Union
+
+import urllib3
+from langchain_core.language_models import BaseChatModel
+from llmsherpa.readers import LayoutPDFReader
+
+import galactus
+import optimus_prime
+from graph_schema import GraphSchema, GraphSchemaManager, driver_query
+from graph_sink import GraphSink, Neo4jGraphSink, get_graph_sink
+from llm_ledger import LLMLedger
+from parser_pool import ParserPool
+from pdf_loader import LLMSHERPA_API_URL
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 1
+DEFAULT_HTTP_POOL_SIZE = 8
+# Options of galactus.load_documents_into_knowledge_graph a job can set
+JOB_OPTIONS = ("include_titles", "reorganize", "summarize_all", "summarize_info", "summarize_paragraphs", "additional_prompt", "shared_context",
+               "stream", "remove_boilerplate", "node_properties", "relationship_properties")
+FINISHED_STATUSES = ("done", "failed")
+# Finished jobs are forgotten after DEFAULT_JOB_TTL seconds, or when more than DEFAULT_MAX_FINISHED_JOBS are kept
+DEFAULT_JOB_TTL = 3600.0
+DEFAULT_MAX_FINISHED_JOBS = 1000
+
+
+class IngestionDaemon:
+
+    def __init__(self, llm: BaseChatModel, graph_params: dict, sink: Optional[GraphSink] = None, llmsherpa_api_url: Union[str, List[str]] = LLMSHERPA_API_URL,
+                 ledger: Optional[LLMLedger] = None, workers: int = DEFAULT_WORKERS, http_pool_size: int = DEFAULT_HTTP_POOL_SIZE,
+                 requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None, job_defaults: Optional[dict] = None,
+                 job_ttl: float = DEFAULT_JOB_TTL, max_finished_jobs: int = DEFAULT_MAX_FINISHED_JOBS):
+        """
+        Initializes the IngestionDaemon class, a resident ingestion worker keeping the parser connection pool, the language model,
+        the compiled chains and the graph sink warm across jobs, so the latency of a small document is the parsing and extraction only.
+        Jobs are queued and run by a single event loop, the one the asynchronous clients of the language model are bound to.
+
+        Parameters:
+        llm (BaseChatModel): The language model.
+        graph_params (dict): The "allowed_nodes" and "allowed_relationships" of the extraction, like demo.graph_params.
+        sink (GraphSink): The graph write target. Default is the one selected by the GRAPH_SINK environment variable.
+        llmsherpa_api_url (Union[str, List[str]]): The API URL for the LLM Sherpa service, or the URLs of several replicas.
+        Replicas are health checked and the documents of all jobs are spread over them, see parser_pool.
+        ledger (LLMLedger): If given, every LLM call of every job is recorded in it.
+        workers (int): The number of jobs run concurrently.
+        http_pool_size (int): The number of connections kept open to the parser.
+        requests_per_minute (int): The request limit of the LLM account, see galactus.load_documents_into_knowledge_graph.
+        tokens_per_minute (int): The token limit of the LLM account.
+        job_defaults (dict): The default options of the jobs, see JOB_OPTIONS.
+        job_ttl (float): The seconds a finished job stays available to GET /jobs and wait.
+        max_finished_jobs (int): The number of finished jobs kept at most, the oldest are forgotten first.
+        """
+        self.llm = llm
+        self.graph_params = graph_params
+        self.ledger = ledger
+        self.workers = workers
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.job_defaults = job_defaults or {}
+        self.job_ttl = job_ttl
+        self.max_finished_jobs = max_finished_jobs
+        self.http = urllib3.PoolManager(maxsize=http_pool_size)
+        urls = [llmsherpa_api_url] if isinstance(llmsherpa_api_url, str) else list(llmsherpa_api_url)
+        self.parser_pool = ParserPool(urls, http=self.http) if len(urls) > 1 else None
+        self.reader = LayoutPDFReader(urls[0])
+        # The reader and the streaming parser share the same connections
+        self.reader.api_connection = self.http
+        self.sink = sink or get_graph_sink()
+        self.schema = GraphSchema.from_graph_params(graph_params["allowed_nodes"], graph_params.get("allowed_relationships", []))
+        self.jobs: Dict[str, dict] = {}
+        self.stats = {"submitted": 0, "done": 0, "failed": 0, "run_seconds": 0.0}
+        self.started_at = None
+        self.loop = asyncio.new_event_loop()
+        self.queue: Optional[asyncio.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._finished: Dict[str, threading.Event] = {}
+        # The jobs are updated by the workers and read by the HTTP threads, so both hold this lock and readers get copies
+        self._jobs_lock = threading.Lock()
+        # Sinks are not meant for concurrent batches, so jobs write one at a time
+        self._write_lock = threading.Lock()
+
+    def warm_up(self) -> None:
+        """
+        Prepares what every job would otherwise build: the graph constraints and the summarization and graph extraction chains.
+        """
+        if isinstance(self.sink, Neo4jGraphSink):
+            self.sink.driver.verify_connectivity()
+            print(GraphSchemaManager.format_report(GraphSchemaManager(driver_query(self.sink.driver, self.sink.database)).ensure(self.schema)))
+        galactus.summarizer_chain(self.llm, self.job_defaults.get("additional_prompt", ""))
+        optimus_prime.graph_transformer(self.llm, self.graph_params["allowed_nodes"], self.graph_params.get("allowed_relationships", []),
+                                        self.job_defaults.get("node_properties", False), self.job_defaults.get("relationship_properties", False))
+
+    def start(self) -> None:
+        """
+        Warms up the resources and starts the event loop of the workers in a background thread.
+        """
+        self.warm_up()
+        if self.parser_pool is not None:
+            self.parser_pool.start_health_checks()
+        ready = threading.Event()
+
+        def run_loop():
+            asyncio.set_event_loop(self.loop)
+            self.queue = asyncio.Queue()
+            for _ in range(self.workers):
+                self.loop.create_task(self._worker())
+            ready.set()
+            self.loop.run_forever()
+
+        self._thread = threading.Thread(target=run_loop, name="ingestion-workers", daemon=True)
+        self._thread.start()
+        ready.wait()
+        self.started_at = time.time()
+
+    def submit(self, files: List[str], directory_prefix: str = "", options: Optional[dict] = None) -> dict:
+        """
+        Queues an ingestion job.
+
+        Parameters:
+        files (List[str]): The PDF files, relative to directory_prefix.
+        directory_prefix (str): The directory of the files.
+        options (dict): The options of the job, see JOB_OPTIONS.
+
+        Returns:
+        dict: The job, with its "id" and "status".
+        """
+        if not files:
+            raise ValueError("No files to ingest.")
+        unknown = set(options or {}) - set(JOB_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unsupported job options: {sorted(unknown)}. Possible values are {JOB_OPTIONS}.")
+        missing = [file for file in files if not os.path.isfile(os.path.join(directory_prefix, file))]
+        if missing:
+            raise ValueError(f"Files not found: {missing}")
+        job = {"id": uuid.uuid4().hex, "files": list(files), "directory_prefix": directory_prefix, "options": dict(options or {}), "status": "queued",
+               "submitted_at": time.time(), "started_at": None, "finished_at": None, "queue_seconds": None, "run_seconds": None,
+               "documents": None, "nodes": None, "relationships": None, "error": None}
+        with self._jobs_lock:
+            self._evict_jobs()
+            self.jobs[job["id"]] = job
+            self._finished[job["id"]] = threading.Event()
+            self.stats["submitted"] += 1
+            snapshot = dict(job)
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, job)
+        return snapshot
+
+    def _evict_jobs(self) -> None:
+        """
+        Forgets the finished jobs older than job_ttl, and the oldest ones beyond max_finished_jobs. The caller holds _jobs_lock.
+        """
+        finished = sorted((job for job_id, job in self.jobs.items() if (event := self._finished.get(job_id)) is not None and event.is_set()),
+                          key=lambda job: job["finished_at"])
+        expired = [job for job in finished if time.time() - job["finished_at"] > self.job_ttl]
+        kept = [job for job in finished if job not in expired]
+        expired += kept[:max(len(kept) - self.max_finished_jobs, 0)]
+        for job in expired:
+            self.jobs.pop(job["id"], None)
+            self._finished.pop(job["id"], None)
+
+    def wait(self, job_id: str, timeout: Optional[float] = None) -> dict:
+        """
+        Waits for a job to finish, or for the timeout to expire, and returns a copy of it.
+        """
+        with self._jobs_lock:
+            job, finished = self.jobs.get(job_id), self._finished.get(job_id)
+        if job is None or finished is None:
+            raise KeyError(job_id)
+        finished.wait(timeout)
+        with self._jobs_lock:
+            return dict(job)
+
+    def job(self, job_id: str) -> Optional[dict]:
+        """
+        Returns a copy of a job, or None if it is unknown or was forgotten.
+        """
+        with self._jobs_lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def list_jobs(self) -> List[dict]:
+        """
+        Returns a copy of all the jobs, so they can be serialized while the workers update them.
+        """
+        with self._jobs_lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def status(self) -> dict:
+        with self._jobs_lock:
+            statuses = [job["status"] for job in self.jobs.values()]
+            stats = dict(self.stats)
+        return {"status": "ok", "uptime_seconds": round(time.time() - self.started_at, 1) if self.started_at else 0.0,
+                "queued": statuses.count("queued"), "running": statuses.count("running"), **stats, "sink": self.sink.report(),
+                **({"parser": self.parser_pool.report()} if self.parser_pool is not None else {})}
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, job: dict) -> None:
+        with self._jobs_lock:
+            job["status"], job["started_at"] = "running", time.time()
+            job["queue_seconds"] = round(job["started_at"] - job["submitted_at"], 3)
+        options = {"node_properties": False, "relationship_properties": False, **self.job_defaults, **job["options"]}
+        try:
+            graph_docs = await galactus.load_documents_into_knowledge_graph(job["files"],
+                                                                            llm=self.llm,
+                                                                            directory_prefix=job["directory_prefix"],
+                                                                            allowed_nodes=self.graph_params["allowed_nodes"],
+                                                                            allowed_relationships=self.graph_params.get("allowed_relationships", []),
+                                                                            requests_per_minute=self.requests_per_minute,
+                                                                            tokens_per_minute=self.tokens_per_minute,
+                                                                            ledger=self.ledger,
+                                                                            pdf_reader=self.reader,
+                                                                            http=self.http,
+                                                                            parser_pool=self.parser_pool,
+                                                                            **options)
+            # The write blocks on the database, so it leaves the event loop free for the other jobs
+            await asyncio.to_thread(self._write, graph_docs)
+            result = {"documents": len(graph_docs), "nodes": sum(len(graph_doc.nodes) for graph_doc in graph_docs),
+                      "relationships": sum(len(graph_doc.relationships) for graph_doc in graph_docs), "status": "done"}
+        except Exception as e:
+            result = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+            print(f"Job {job['id']} failed: {result['error']}")
+        with self._jobs_lock:
+            job.update(result)
+            job["finished_at"] = time.time()
+            job["run_seconds"] = round(job["finished_at"] - job["started_at"], 3)
+            self.stats[job["status"]] += 1
+            self.stats["run_seconds"] += job["run_seconds"]
+            self._finished[job["id"]].set()
+            self._evict_jobs()
+
+    def _write(self, graph_docs: list) -> None:
+        with self._write_lock:
+            optimus_prime.create_knowledge_graph(graph_docs, sink=self.sink)
+
+    def stop(self) -> None:
+        """
+        Stops the workers, dropping the queued jobs, and closes the sink and the parser connections.
+        """
+        if self._thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+        self.sink.close()
+        if self.parser_pool is not None:
+            self.parser_pool.close()
+        self.http.clear()
+
+
+class _IngestionHandler(BaseHTTPRequestHandler):
+    daemon: IngestionDaemon = None
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else "unix"
+
+    def _send(self, status: int, body) -> None:
+        payload = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self) -> None:
+        path = self.path.rstrip("/")
+        if path == "/health":
+            return self._send(200, self.daemon.status())
+        if path == "/jobs":
+            return self._send(200, self.daemon.list_jobs())
+        if path.startswith("/jobs/") and (job := self.daemon.job(path[len("/jobs/"):])):
+            return self._send(200, job)
+        self._send(404, {"error": f"Not found: {self.path}"})
+
+    def do_POST(self) -> None:
+        if self.path.rstrip("/") != "/jobs":
+            return self._send(404, {"error": f"Not found: {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = self.daemon.submit(request.get("files", []), request.get("directory_prefix", ""), request.get("options"))
+        except (ValueError, AttributeError) as e:
+            return self._send(400, {"error": str(e)})
+        if request.get("wait"):
+            job = self.daemon.wait(job["id"], request.get("timeout"))
+            return self._send(200 if job["status"] in FINISHED_STATUSES else 202, job)
+        self._send(202, job)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(daemon: IngestionDaemon, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, socket_path: Optional[str] = None) -> None:
+    """
+    Starts the daemon and serves its HTTP API until interrupted: POST /jobs with the "files", their "directory_prefix", the job "options"
+    and "wait" to answer when the job is finished; GET /jobs/<id> for a job, GET /jobs for all of them and GET /health for the daemon status.
+
+    Parameters:
+    daemon (IngestionDaemon): The daemon.
+    host (str): The address to listen on.
+    port (int): The port to listen on.
+    socket_path (str): If given, the API listens on this Unix socket instead of host and port.
+
+    Returns:
+    None
+    """
+    handler = type("IngestionHandler", (_IngestionHandler,), {"daemon": daemon})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, handler)
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+    daemon.start()
+    print(f"Ingestion daemon listening on {socket_path or f'http://{host}:{port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.stop()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the resident ingestion worker and its local HTTP API.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="The address to listen on.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="The port to listen on.")
+    parser.add_argument("--socket", help="Listen on this Unix socket instead.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="The number of jobs run concurrently.")
+    parser.add_argument("--graph-params", help="JSON file with the allowed_nodes and allowed_relationships. Default is the demo graph_params.")
+    parser.add_argument("--parser-url", nargs="+", default=[LLMSHERPA_API_URL], help="The API URLs of the LLM Sherpa replicas.")
+    parser.add_argument("--reorganize", action="store_true", help="Reorganize the documents by default, like the demo.")
+    args = parser.parse_args()
+
+    # Imported once here: the demo model and schema stay loaded for the life of the process
+    from resources.demo.llm import llm as demo_llm
+    from resources.demo.graph_constructor import graph_params as demo_graph_params, additional_prompt as demo_additional_prompt
+
+    params = demo_graph_params
+    if args.graph_params:
+        with open(args.graph_params, "r", encoding="utf-8") as f:
+            params = json.load(f)
+    serve(IngestionDaemon(demo_llm, params, llmsherpa_api_url=args.parser_url, workers=args.workers,
+                          job_defaults={"reorganize": args.reorganize, "additional_prompt": demo_additional_prompt}),
+          args.host, args.port, args.socket)
@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+import pyarrow.compute as pc
+
+from csv_graph_loader import iter_csv_batches
+from sketches import HyperLogLog, MinHash, containment, hash_values
+
+DEFAULT_NUM_PERM = 128
+DEFAULT_HLL_PRECISION = 12
+MIN_DISTINCT = 20
+MIN_CONTAINMENT = 0.8
+MIN_KEY_UNIQUENESS = 0.9
+MIN_KEY_COVERAGE = 0.99
+_TABLE_PREFIX = re.compile(r"^\d+_")
+
+
+class ColumnProfile:
+
+    def __init__(self, table: str, column: str, num_perm: int = DEFAULT_NUM_PERM, p: int = DEFAULT_HLL_PRECISION):
+        """
+        Initializes the ColumnProfile class, holding the sketches of one CSV column.
+
+        Parameters:
+        table (str): The CSV file name.
+        column (str): The column name.
+        num_perm (int): The number of MinHash permutations.
+        p (int): The HyperLogLog precision.
+        """
+        self.table = table
+        self.column = column
+        self.rows = 0
+        self.table_rows = 0
+        self.minhash = MinHash(num_perm)
+        self.hll = HyperLogLog(p)
+
+    def update(self, values: List[str], non_null: int, batch_rows: int) -> None:
+        hashes = hash_values(values)
+        self.minhash.update(hashes)
+        self.hll.update(hashes)
+        self.rows += non_null
+        self.table_rows += batch_rows
+
+    @property
+    def distinct(self) -> float:
+        return self.hll.count()
+
+    @property
+    def uniqueness(self) -> float:
+        # HLL can slightly overshoot the exact count, hence the cap
+        return min(1.0, self.distinct / self.rows) if self.rows else 0.0
+
+    @property
+    def coverage(self) -> float:
+        return self.rows / self.table_rows if self.table_rows else 0.0
+
+
+def profile_tables(csv_directory: str, num_perm: int = DEFAULT_NUM_PERM, p: int = DEFAULT_HLL_PRECISION) -> List[ColumnProfile]:
+    """
+    Builds MinHash and HyperLogLog sketches of every column of every CSV file, in a single streaming pass per file.
+
+    Parameters:
+    csv_directory (str): The directory containing the CSV files.
+    num_perm (int): The number of MinHash permutations.
+    p (int): The HyperLogLog precision.
+
+    Returns:
+    List[ColumnProfile]: The column profiles.
+    """
+    profiles = []
+    for filename in sorted(os.listdir(csv_directory)):
+        if not filename.endswith(".csv"):
+            continue
+        print(f"Profiling {filename} ...")
+        table_profiles = {}
+        for batch in iter_csv_batches(os.path.join(csv_directory, filename)):
+            for name, array in zip(batch.schema.names, batch.columns):
+                profile = table_profiles.setdefault(name, ColumnProfile(filename, name, num_perm, p))
+                # Sketches only need each distinct value once per batch
+                profile.update(pc.unique(array).drop_null().to_pylist(), len(array) - array.null_count, len(array))
+        profiles.extend(table_profiles.values())
+    return profiles
+
+
+def rank_foreign_keys(profiles: List[ColumnProfile], min_distinct: int = MIN_DISTINCT, min_containment: float = MIN_CONTAINMENT,
+                      min_key_uniqueness: float = MIN_KEY_UNIQUENESS) -> List[dict]:
+    """
+    Estimates containment between every pair of columns of different tables and ranks the likely foreign keys,
+    i.e. columns whose values are (almost) all found in a near-unique column of another table.
+
+    Parameters:
+    profiles (List[ColumnProfile]): The column profiles returned by profile_tables.
+    min_distinct (int): Columns with fewer distinct values (flags, codes, constants) are ignored.
+    min_containment (float): The minimum estimated containment of a candidate.
+    min_key_uniqueness (float): The minimum distinct/rows ratio of the referenced column.
+
+    Returns:
+    List[dict]: The candidates, best first.
+    """
+    profiles = [p for p in profiles if p.distinct >= min_distinct and not p.minhash.is_empty()]
+    if not profiles:
+        return []
+    signatures = np.stack([p.minhash.signature for p in profiles])
+    distinct = np.array([p.distinct for p in profiles])
+    uniqueness = np.array([p.uniqueness for p in profiles])
+    tables = np.array([p.table for p in profiles])
+    candidates = []
+    for i, profile in enumerate(profiles):
+        jaccard = (signatures == signatures[i]).mean(axis=1)
+        for j in np.nonzero((jaccard > 0) & (tables != profile.table) & (uniqueness >= min_key_uniqueness))[0]:
+            referenced = profiles[j]
+            score = containment(float(jaccard[j]), distinct[i], distinct[j])
+            if score >= min_containment:
+                candidates.append({
+                    "from_table": profile.table,
+                    "from_column": profile.column,
+                    "to_table": referenced.table,
+                    "to_column": referenced.column,
+                    "containment": round(score, 3),
+                    "jaccard": round(float(jaccard[j]), 3),
+                    "from_distinct": int(distinct[i]),
+                    "to_distinct": int(distinct[j]),
+                    "to_uniqueness": round(float(uniqueness[j]), 3),
+                })
+    candidates.sort(key=lambda c: (c["containment"], c["to_uniqueness"], c["from_column"] == c["to_column"]), reverse=True)
+    return candidates
+
+
+def _label(table: str) -> str:
+    return _TABLE_PREFIX.sub("", os.path.splitext(table)[0])
+
+
+def propose_mapping(profiles: List[ColumnProfile], candidates: List[dict], min_distinct: int = MIN_DISTINCT,
+                    min_key_uniqueness: float = MIN_KEY_UNIQUENESS) -> dict:
+    """
+    Turns the ranked candidates into a mapping in the csv_graph_loader format. Every table becomes a node keyed by its
+    most unique, fully populated column, and the best candidate between two tables becomes a relationship.
+    Between two one-to-one tables only the first direction found is kept.
+
+    Parameters:
+    profiles (List[ColumnProfile]): The column profiles returned by profile_tables.
+    candidates (List[dict]): The candidates returned by rank_foreign_keys.
+    min_distinct (int): The minimum number of distinct values for a column to be used as node key.
+    min_key_uniqueness (float): The minimum distinct/rows ratio for a column to be used as node key.
+
+    Returns:
+    dict: The proposed mapping, to be reviewed before loading.
+    """
+    keys: Dict[str, Optional[ColumnProfile]] = {}
+    for profile in profiles:
+        if profile.distinct < min_distinct or profile.uniqueness < min_key_uniqueness or profile.coverage < MIN_KEY_COVERAGE:
+            continue
+        current = keys.get(profile.table)
+        rank = (profile.column.startswith("id_"), profile.uniqueness)
+        if current is None or rank > (current.column.startswith("id_"), current.uniqueness):
+            keys[profile.table] = profile
+
+    tables = {}
+    linked = set()
+    for candidate in candidates:
+        source_key, target_key = keys.get(candidate["from_table"]), keys.get(candidate["to_table"])
+        if source_key is None or target_key is None or target_key.column != candidate["to_column"]:
+            continue
+        pair = frozenset((candidate["from_table"], candidate["to_table"]))
+        if pair in linked:
+            continue
+        linked.add(pair)
+        table = tables.setdefault(candidate["from_table"], {
+            "file": candidate["from_table"],
+            "nodes": [{"label": _label(candidate["from_table"]), "key": source_key.column, "properties": {}}],
+            "relationships": [],
+        })
+        table["relationships"].append({
+            "type": candidate["from_column"].upper(),
+            "from": {"label": _label(candidate["from_table"]), "key": source_key.column},
+            "to": {"label": _label(candidate["to_table"]), "key": candidate["from_column"]},
+            "containment": candidate["containment"],
+        })
+    return {"tables": list(tables.values())}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Discover join keys across the export_data tables.")
+    parser.add_argument("csv_directory", nargs="?", default="export_data")
+    parser.add_argument("--output", default="export_data/proposed_mapping.json")
+    parser.add_argument("--min-containment", type=float, default=MIN_CONTAINMENT)
+    args = parser.parse_args()
+
+    column_profiles = profile_tables(args.csv_directory)
+    ranked = rank_foreign_keys(column_profiles, min_containment=args.min_containment)
+    for c in ranked:
+        print(f"{c['containment']:.2f}  {c['from_table']}.{c['from_column']} -> {c['to_table']}.{c['to_column']}")
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(propose_mapping(column_profiles, ranked), f, ensure_ascii=False, indent=4)
+    print(f"Proposed mapping written to {args.output}")
@@ -0,0 +1,216 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models import BaseChatModel
+from langchain_core.outputs import LLMResult
+
+from rate_limiter import current_attempt
+
+DEFAULT_LEDGER_PATH = "output/llm_ledger.sqlite"
+BUDGET_ACTIONS = ("degrade", "skip_summarization", "stop")
+
+
+class BudgetExceededError(RuntimeError):
+    """
+    Raised before an LLM call when a token budget with the "stop" action is exhausted.
+    """
+
+
+class LedgerStore:
+
+    def __init__(self, path: str = DEFAULT_LEDGER_PATH):
+        """
+        Initializes the LedgerStore class, the SQLite table of all recorded LLM calls.
+
+        Parameters:
+        path (str): The path to the SQLite file. It is created if missing.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS llm_calls ("
+                                "id INTEGER PRIMARY KEY, run_id TEXT NOT NULL, started_at REAL NOT NULL, stage TEXT, source TEXT, section TEXT, model TEXT, "
+                                "prompt_tokens INTEGER NOT NULL DEFAULT 0, completion_tokens INTEGER NOT NULL DEFAULT 0, latency_ms REAL, "
+                                "retries INTEGER NOT NULL DEFAULT 0, error TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS llm_calls_run ON llm_calls (run_id)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS llm_calls_source ON llm_calls (source)")
+        self.connection.commit()
+
+    def record(self, call: dict) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("INSERT INTO llm_calls (run_id, started_at, stage, source, section, model, prompt_tokens, completion_tokens, latency_ms, retries, error) "
+                                    "VALUES (:run_id, :started_at, :stage, :source, :section, :model, :prompt_tokens, :completion_tokens, :latency_ms, :retries, :error)",
+                                    call)
+
+    def report(self, group_by: str, run_id: Optional[str] = None, limit: int = 20) -> List[dict]:
+        """
+        Ranks the groups of calls by total tokens.
+
+        Parameters:
+        group_by (str): The column to group by: "source", "stage", "section" or "model".
+        run_id (str): Only report the calls of this run. Default is all runs.
+        limit (int): The number of groups to return.
+
+        Returns:
+        List[dict]: The costliest groups with their calls, tokens, average latency, retries and errors.
+        """
+        if group_by not in ("source", "stage", "section", "model"):
+            raise ValueError(f"Unsupported grouping: {group_by}")
+        where, params = ("WHERE run_id = ?", [run_id]) if run_id else ("", [])
+        rows = self.connection.execute(f"SELECT {group_by}, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), AVG(latency_ms), SUM(retries), COUNT(error) "
+                                       f"FROM llm_calls {where} GROUP BY {group_by} ORDER BY SUM(prompt_tokens + completion_tokens) DESC LIMIT ?",
+                                       params + [limit]).fetchall()
+        return [{group_by: row[0], "calls": row[1], "prompt_tokens": row[2], "completion_tokens": row[3], "avg_latency_ms": row[4] or 0.0,
+                 "retries": row[5], "errors": row[6]} for row in rows]
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def _token_usage(response: LLMResult) -> Dict[str, int]:
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage:
+        return {"prompt_tokens": usage.get("prompt_tokens", 0), "completion_tokens": usage.get("completion_tokens", 0)}
+    # Providers without llm_output report usage on the generated messages
+    prompt_tokens = completion_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+            prompt_tokens += metadata.get("input_tokens", 0)
+            completion_tokens += metadata.get("output_tokens", 0)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+
+
+class LLMLedger(BaseCallbackHandler):
+    """
+    LangChain callback handler recording every LLM call in a LedgerStore and enforcing token budgets.
+    Stage, source file and section are read from the run metadata, e.g. config={"callbacks": [ledger], "metadata": ledger.metadata("extraction", source, section)}.
+    """
+
+    # Budgets must be able to stop a call, and the counters are updated synchronously even in async chains
+    raise_error = True
+    run_inline = True
+
+    def __init__(self, store: Optional[LedgerStore] = None, max_run_tokens: Optional[int] = None, max_document_tokens: Optional[int] = None,
+                 budget_action: str = "stop", fallback_llm: Optional[BaseChatModel] = None, run_id: Optional[str] = None):
+        """
+        Initializes the LLMLedger class.
+
+        Parameters:
+        store (LedgerStore): The store of the calls. Default is a store at DEFAULT_LEDGER_PATH.
+        max_run_tokens (int): The token budget of the whole run. Default is no budget.
+        max_document_tokens (int): The token budget of every source file. Default is no budget.
+        budget_action (str): What happens once a budget is exhausted: "degrade" switches to fallback_llm, "skip_summarization" disables the
+        optional summarization calls, "stop" raises BudgetExceededError before any further call.
+        fallback_llm (BaseChatModel): The cheaper model used by the "degrade" action.
+        run_id (str): The identifier of the run. Default is a new one.
+        """
+        super().__init__()
+        if budget_action not in BUDGET_ACTIONS:
+            raise ValueError(f"Unsupported budget action: {budget_action}. Possible values are {BUDGET_ACTIONS}.")
+        if budget_action == "degrade" and fallback_llm is None:
+            raise ValueError("A fallback model is required for the degrade budget action.")
+        self.store = store or LedgerStore()
+        self.max_run_tokens = max_run_tokens
+        self.max_document_tokens = max_document_tokens
+        self.budget_action = budget_action
+        self.fallback_llm = fallback_llm
+        self.run_id = run_id or uuid.uuid4().hex
+        self.run_tokens = 0
+        self.document_tokens: Dict[str, int] = defaultdict(int)
+        self.pending: Dict[UUID, dict] = {}
+
+    @staticmethod
+    def metadata(stage: str, source: Optional[str] = None, section: Optional[str] = None) -> dict:
+        return {"ledger_stage": stage, "ledger_source": source, "ledger_section": section}
+
+    def config(self, stage: str, source: Optional[str] = None, section: Optional[str] = None) -> dict:
+        """
+        Returns the runnable config attaching the ledger to a call, e.g. chain.invoke(inputs, config=ledger.config("summarization", source)).
+        """
+        return {"callbacks": [self], "metadata": self.metadata(stage, source, section)}
+
+    def exhausted(self, source: Optional[str] = None) -> bool:
+        """
+        Tells whether the run budget, or the budget of a source file, is exhausted.
+        """
+        if self.max_run_tokens is not None and self.run_tokens >= self.max_run_tokens:
+            return True
+        return self.max_document_tokens is not None and source is not None and self.document_tokens[source] >= self.max_document_tokens
+
+    def allows_summarization(self, source: Optional[str] = None) -> bool:
+        return not (self.budget_action == "skip_summarization" and self.exhausted(source))
+
+    def select_llm(self, llm: BaseChatModel, source: Optional[str] = None) -> BaseChatModel:
+        """
+        Returns the model to use for a source file: the fallback model once its budget is exhausted with the "degrade" action, llm otherwise.
+        """
+        if self.budget_action == "degrade" and self.exhausted(source):
+            return self.fallback_llm
+        return llm
+
+    def _start(self, serialized: Dict[str, Any], run_id: UUID, metadata: Optional[Dict[str, Any]], kwargs: dict) -> None:
+        metadata = metadata or {}
+        source = metadata.get("ledger_source")
+        if self.budget_action == "stop" and self.exhausted(source):
+            raise BudgetExceededError(f"Token budget exhausted for run {self.run_id}" + (f" on {source}" if source else ""))
+        invocation = kwargs.get("invocation_params") or {}
+        model = invocation.get("model_name") or invocation.get("model") or ((serialized or {}).get("kwargs") or {}).get("model_name")
+        self.pending[run_id] = {"run_id": self.run_id, "started_at": time.time(), "start": time.perf_counter(),
+                                "stage": metadata.get("ledger_stage"), "source": source, "section": metadata.get("ledger_section"), "model": model,
+                                # Retried calls are new runs, the retry loop tells which attempt this is
+                                "retries": current_attempt.get()}
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, parent_run_id: Optional[UUID] = None,
+                     tags: Optional[List[str]] = None, metadata: Optional[Dict[str, Any]] = None, **kwargs: Any) -> None:
+        self._start(serialized, run_id, metadata, kwargs)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, parent_run_id: Optional[UUID] = None,
+                            tags: Optional[List[str]] = None, metadata: Optional[Dict[str, Any]] = None, **kwargs: Any) -> None:
+        self._start(serialized, run_id, metadata, kwargs)
+
+    def _finish(self, run_id: UUID, usage: Dict[str, int], error: Optional[str] = None) -> None:
+        call = self.pending.pop(run_id, None)
+        if call is None:
+            return
+        tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+        self.run_tokens += tokens
+        if call["source"] is not None:
+            self.document_tokens[call["source"]] += tokens
+        call.update(usage, latency_ms=(time.perf_counter() - call.pop("start")) * 1000, error=error)
+        self.store.record(call)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        self._finish(run_id, _token_usage(response))
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        self._finish(run_id, {"prompt_tokens": 0, "completion_tokens": 0}, error=f"{type(error).__name__}: {error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rank the costliest documents and stages recorded in the LLM ledger.")
+    parser.add_argument("ledger", nargs="?", default=DEFAULT_LEDGER_PATH, help="Path to the ledger SQLite file.")
+    parser.add_argument("--run", help="Only report this run id.")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    ledger_store = LedgerStore(args.ledger)
+    for grouping in ("stage", "source"):
+        print(f"\nCostliest by {grouping}:")
+        print(f"{'tokens':>10} {'prompt':>10} {'output':>10} {'calls':>6} {'avg ms':>8} {'retries':>7} {'errors':>6}  {grouping}")
+        for entry in ledger_store.report(grouping, args.run, args.top):
+            total = entry["prompt_tokens"] + entry["completion_tokens"]
+            print(f"{total:>10} {entry['prompt_tokens']:>10} {entry['completion_tokens']:>10} {entry['calls']:>6} {entry['avg_latency_ms']:>8.0f} "
+                  f"{entry['retries']:>7} {entry['errors']:>6}  {entry[grouping]}")
+    ledger_store.close()
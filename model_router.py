@@ -0,0 +1,270 @@
+import time
+from collections import Counter, defaultdict, deque
+from typing import Any, Awaitable, Callable, Dict, Generator, Iterable, List, Optional, Tuple, Type, TypeVar
+
+import rate_limiter
+from artifact_io import ArtifactWriter
+from gazetteer import Gazetteer
+
+ROUTES = ("cheap", "strong", "escalated")
+DEFAULT_MAX_CHEAP_TOKENS = 1200
+DEFAULT_MAX_TABLE_DENSITY = 0.3
+DEFAULT_MIN_COVERAGE = 0.5
+DEFAULT_MIN_CONTENT_TOKENS = 20
+# Latencies kept per route for the percentiles
+LATENCY_WINDOW = 1000
+
+T = TypeVar("T")
+
+
+def section_features(text: str, gazetteer: Optional[Gazetteer] = None, model_name: Optional[str] = None) -> Dict[str, float]:
+    """
+    Computes the cheap features the routing decision is based on.
+
+    Parameters:
+    text (str): The section text, as built by pdf_loader.build_flat_json.
+    gazetteer (Gazetteer): If given, the known entities are tagged to measure the coverage.
+    model_name (str): The model whose tokenizer is used for the estimate.
+
+    Returns:
+    Dict[str, float]: The "tokens"; the "table_density" and "list_density", the fractions of the lines that are table rows ("a | b") or list items ("- a");
+    the "known" and "unexplained" entity spans found by the gazetteer and their "coverage", 1.0 when the text has no candidate entity.
+    """
+    lines = [line for line in text.splitlines() if line.strip()]
+    features = {"tokens": rate_limiter.estimate_tokens(text, model_name),
+                "table_density": sum(" | " in line for line in lines) / len(lines) if lines else 0.0,
+                "list_density": sum(line.lstrip().startswith("- ") for line in lines) / len(lines) if lines else 0.0,
+                "known": 0, "unexplained": 0, "coverage": 1.0}
+    if gazetteer is not None:
+        tags = gazetteer.tag(text)
+        features["known"], features["unexplained"] = len(tags["matches"]), len(tags["unexplained"])
+        candidates = features["known"] + features["unexplained"]
+        features["coverage"] = features["known"] / candidates if candidates else 1.0
+    return features
+
+
+def is_empty_result(result: Any) -> bool:
+    """
+    Tells whether a structured output holds nothing: None, a graph document without nodes, or a model or dict whose values are all empty.
+    """
+    if result is None:
+        return True
+    if hasattr(result, "nodes"):
+        return not result.nodes
+    if hasattr(result, "model_dump"):
+        result = result.model_dump()
+    if isinstance(result, dict):
+        return all(is_empty_result(value) for value in result.values())
+    if isinstance(result, (list, tuple, str)):
+        return len(result) == 0
+    return False
+
+
+class RoutingPolicy:
+
+    def __init__(self, max_cheap_tokens: int = DEFAULT_MAX_CHEAP_TOKENS, max_table_density: float = DEFAULT_MAX_TABLE_DENSITY,
+                 min_coverage: float = DEFAULT_MIN_COVERAGE, min_content_tokens: int = DEFAULT_MIN_CONTENT_TOKENS):
+        """
+        Initializes the RoutingPolicy class, the thresholds sending a section to the strong model.
+        Short lists of mostly known entities go to the cheap model; long sections, dense tables and sections full of unknown names go to the strong one.
+
+        Parameters:
+        max_cheap_tokens (int): Sections longer than this go to the strong model.
+        max_table_density (float): Sections with a larger fraction of table rows go to the strong model.
+        min_coverage (float): Sections whose candidate entities are less known than this go to the strong model. Only applies with a gazetteer.
+        min_content_tokens (int): Below this, an empty result of the cheap model is accepted as complete.
+        """
+        self.max_cheap_tokens = max_cheap_tokens
+        self.max_table_density = max_table_density
+        self.min_coverage = min_coverage
+        self.min_content_tokens = min_content_tokens
+
+    def choose(self, features: Dict[str, float]) -> Tuple[str, str]:
+        """
+        Returns the route of a section, "cheap" or "strong", and the reason for it.
+        """
+        if features["tokens"] > self.max_cheap_tokens:
+            return "strong", "tokens"
+        if features["table_density"] > self.max_table_density:
+            return "strong", "tables"
+        if features["coverage"] < self.min_coverage:
+            return "strong", "coverage"
+        return "cheap", "features"
+
+    def looks_incomplete(self, result: Any, features: Dict[str, float]) -> bool:
+        """
+        The default completeness check: an empty result for a section with content or with known entities.
+        """
+        return is_empty_result(result) and (features["tokens"] >= self.min_content_tokens or features["known"] > 0)
+
+
+class ModelRouter:
+
+    def __init__(self, cheap: Any, strong: Any, policy: Optional[RoutingPolicy] = None, gazetteer: Optional[Gazetteer] = None,
+                 is_incomplete: Optional[Callable[[Any, Dict[str, float]], bool]] = None, fatal_errors: Tuple[Type[BaseException], ...] = (),
+                 model_name: Optional[str] = None, log: Optional[ArtifactWriter] = None):
+        """
+        Initializes the ModelRouter class, picking a cheap or a strong model per section and escalating to the strong one
+        only when the structured output of the cheap one fails validation or looks incomplete.
+        The models are opaque to the router: they can be chains, language models or graph transformers, and the caller says how to call them.
+
+        Parameters:
+        cheap (Any): The cheap model or chain.
+        strong (Any): The strong model or chain.
+        policy (RoutingPolicy): The routing thresholds. Default is RoutingPolicy().
+        gazetteer (Gazetteer): If given, the coverage of the known entities is one of the routing features.
+        is_incomplete (Callable[[Any, Dict[str, float]], bool]): Tells whether a result of the cheap model is incomplete. Default is policy.looks_incomplete.
+        fatal_errors (Tuple[Type[BaseException], ...]): The errors that are raised instead of escalating, e.g. llm_ledger.BudgetExceededError.
+        model_name (str): The model whose tokenizer is used for the token estimate.
+        log (ArtifactWriter): If given, every decision is written to it with its features, latency and outcome, to tune the thresholds.
+        """
+        self.cheap = cheap
+        self.strong = strong
+        self.policy = policy or RoutingPolicy()
+        self.gazetteer = gazetteer
+        self.is_incomplete = is_incomplete or self.policy.looks_incomplete
+        self.fatal_errors = fatal_errors
+        self.model_name = model_name
+        self.log = log
+        self.stats = {route: {"calls": 0, "successes": 0, "failures": 0, "seconds": 0.0} for route in ROUTES}
+        self.reasons = Counter()
+        self.escalations = Counter()
+        self.latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+
+    def features(self, text: str) -> Dict[str, float]:
+        return section_features(text, self.gazetteer, self.model_name)
+
+    def route(self, text: str, features: Optional[Dict[str, float]] = None) -> Tuple[str, Dict[str, float]]:
+        """
+        Returns the route of a section, "cheap" or "strong", with its features. The reason is counted in self.reasons.
+        """
+        features = features or self.features(text)
+        route, reason = self.policy.choose(features)
+        self.reasons[reason] += 1
+        return route, features
+
+    def partition(self, sections: Iterable[dict]) -> Tuple[List[dict], List[dict], Dict[str, Dict[str, float]]]:
+        """
+        Splits sections with an "id" and a "text" between the models, e.g. to send each group to its own batch_extraction.BatchExtractor.
+
+        Returns:
+        Tuple[List[dict], List[dict], Dict[str, Dict[str, float]]]: The cheap sections, the strong sections and the features by section id.
+        """
+        cheap, strong, features = [], [], {}
+        for section in sections:
+            route, features[section["id"]] = self.route(section["text"])
+            (cheap if route == "cheap" else strong).append(section)
+        return cheap, strong, features
+
+    def observe(self, route: str, seconds: float, success: bool, features: Optional[Dict[str, float]] = None, escalation: Optional[str] = None) -> None:
+        """
+        Records the outcome of a call on a route. Callers that batch sections record each section with its share of the batch time.
+        """
+        stats = self.stats[route]
+        stats["calls"] += 1
+        stats["successes" if success else "failures"] += 1
+        stats["seconds"] += seconds
+        self.latencies[route].append(seconds)
+        if escalation is not None:
+            self.escalations[escalation] += 1
+        if self.log is not None:
+            self.log.write({"route": route, "success": success, "seconds": round(seconds, 4), "escalation": escalation, **(features or {})})
+
+    def _escalation(self, error: Optional[BaseException], result: Any, features: Dict[str, float], is_incomplete: Callable[[Any, Dict[str, float]], bool]) -> Optional[str]:
+        if error is not None:
+            return "invalid"
+        if is_incomplete(result, features):
+            return "incomplete"
+        return None
+
+    def _calls(self, text: str, allow_strong: bool, is_incomplete: Optional[Callable[[Any, Dict[str, float]], bool]]) -> Generator[Any, Tuple[Any, Optional[BaseException]], None]:
+        """
+        Yields the models to call for a section, in order, and is sent the (result, error) of every call. Shared by run and arun,
+        it makes the routing and escalation decisions and records the outcome of every route.
+        """
+        route, features = self.route(text)
+        start = time.perf_counter()
+        if route == "strong" and allow_strong:
+            result, error = yield self.strong
+            self.observe("strong", time.perf_counter() - start, error is None, features)
+            return
+        result, error = yield self.cheap
+        if error is not None and (not isinstance(error, Exception) or isinstance(error, self.fatal_errors)):
+            return
+        if error is not None and not allow_strong:
+            self.observe("cheap", time.perf_counter() - start, False, features)
+            return
+        escalation = self._escalation(error, result, features, is_incomplete or self.is_incomplete) if allow_strong else None
+        if escalation is None:
+            self.observe("cheap", time.perf_counter() - start, True, features)
+            return
+        result, error = yield self.strong
+        self.observe("escalated", time.perf_counter() - start, error is None, features, escalation)
+
+    async def arun(self, text: str, call: Callable[[Any], Awaitable[T]], allow_strong: bool = True,
+                   is_incomplete: Optional[Callable[[Any, Dict[str, float]], bool]] = None) -> T:
+        """
+        Runs a section on the model it is routed to, escalating from the cheap to the strong model when needed.
+
+        Parameters:
+        text (str): The section text the features are computed on.
+        call (Callable[[Any], Awaitable[T]]): Calls a model, e.g. lambda chain: chain.ainvoke(inputs, config=config).
+        allow_strong (bool): Whether the strong model may be used, e.g. False once the ledger budget of the document is exhausted.
+        The cheap result is then returned as is.
+        is_incomplete (Callable[[Any, Dict[str, float]], bool]): The completeness check of this call. Default is the one of the router.
+
+        Returns:
+        T: The result of the last model called.
+        """
+        calls = self._calls(text, allow_strong, is_incomplete)
+        model = next(calls)
+        while True:
+            result, error = None, None
+            try:
+                result = await call(model)
+            except BaseException as e:
+                error = e
+            try:
+                model = calls.send((result, error))
+            except StopIteration:
+                if error is not None:
+                    raise error
+                return result
+
+    def run(self, text: str, call: Callable[[Any], T], allow_strong: bool = True, is_incomplete: Optional[Callable[[Any, Dict[str, float]], bool]] = None) -> T:
+        """
+        The synchronous version of arun, with call returning the result directly, e.g. lambda chain: chain.invoke(inputs, config=config).
+        """
+        calls = self._calls(text, allow_strong, is_incomplete)
+        model = next(calls)
+        while True:
+            result, error = None, None
+            try:
+                result = call(model)
+            except BaseException as e:
+                error = e
+            try:
+                model = calls.send((result, error))
+            except StopIteration:
+                if error is not None:
+                    raise error
+                return result
+
+    def report(self) -> str:
+        """
+        Summarizes the calls, success rate and latency percentiles of every route, and why sections went to the strong model.
+        """
+        lines = []
+        for route in ROUTES:
+            stats = self.stats[route]
+            if not stats["calls"]:
+                continue
+            latencies = sorted(self.latencies[route])
+            p50, p95 = latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            lines.append(f"{route}: {stats['calls']} calls, {stats['successes'] / stats['calls']:.0%} successful, "
+                         f"mean {stats['seconds'] / stats['calls']:.2f}s, p50 {p50:.2f}s, p95 {p95:.2f}s")
+        total = sum(stats["calls"] for stats in self.stats.values())
+        if total:
+            lines.append(f"Routing reasons: {dict(self.reasons)}, escalations: {dict(self.escalations)} "
+                         f"({sum(self.escalations.values()) / total:.0%} of the sections)")
+        return "\n".join(lines)
@@ -1,6 +1,8 @@
+import asyncio
 import json
 import os
-from typing import List, Type, Union, Optional
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Type, Union
 
 from langchain_community.graphs.graph_document import GraphDocument
 from langchain_core.documents import Document
@@ -13,11 +15,217 @@ from langchain_neo4j import Neo4jGraph
 from neo4j.exceptions import ClientError
 from pydantic import BaseModel
 
+import entity_resolution
+import graph_consolidation
+import rate_limiter
+from graph_schema import MERGE_KEY_PROPERTY, GraphSchema, GraphSchemaManager, driver_query
+from graph_sharding import ShardedGraphWriter
+from graph_sink import GraphBatch, GraphSink, Neo4jGraphSink, get_graph_sink
+from graph_spool import GraphSpool, extraction_fingerprint, graph_document_from_dict, graph_document_to_dict
+from llm_ledger import BudgetExceededError, LLMLedger
+from model_router import ModelRouter
+from section_dedup import SectionDedupIndex
+
 CREATE_DB_QUERY = "CREATE DATABASE {kg_db_name}"
+DOCUMENT_CONTEXT_INSTRUCTIONS = ("The text to analyze is a section of a larger document. "
+                                 "Use the following document introduction only as context to resolve references, do not extract it again:\n"
+                                 "<document_context>\n{document_context}\n</document_context>")
+
+# Transformers built by graph_transformer, reused across calls in long-lived processes such as ingestion_daemon
+TRANSFORMER_CACHE_SIZE = 64
+_transformer_cache: "OrderedDict[tuple, Tuple[BaseChatModel, LLMGraphTransformer]]" = OrderedDict()
+
+def _hashable(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+def document_context_instructions(document_context: Optional[str]) -> str:
+    """
+    Returns the additional instructions sharing a document context with the graph transformer, or "" without a context.
+    The instructions become part of a prompt template, so the braces of the context (e.g. a JSON introduction) are escaped.
+    """
+    if not document_context:
+        return ""
+    return DOCUMENT_CONTEXT_INSTRUCTIONS.format(document_context=document_context.replace("{", "{{").replace("}", "}}"))
+
+def graph_transformer(llm: BaseChatModel, allowed_nodes: List[str], allowed_relationships: List[str], node_properties: List[str], relationship_properties: List[str], additional_instructions: str = "") -> LLMGraphTransformer:
+    """
+    Returns the LLMGraphTransformer of a language model and schema, building it on first use only.
+    The most recent TRANSFORMER_CACHE_SIZE transformers are kept.
+    """
+    key = (id(llm), _hashable(allowed_nodes), _hashable(allowed_relationships), _hashable(node_properties), _hashable(relationship_properties), additional_instructions)
+    cached = _transformer_cache.get(key)
+    if cached is not None and cached[0] is llm:
+        _transformer_cache.move_to_end(key)
+        return cached[1]
+    transformer = LLMGraphTransformer(llm=llm,
+                                      allowed_nodes=allowed_nodes,
+                                      allowed_relationships=allowed_relationships,
+                                      node_properties=node_properties,
+                                      relationship_properties=relationship_properties,
+                                      additional_instructions=additional_instructions)
+    _transformer_cache[key] = (llm, transformer)
+    # Every shared document context makes its own transformer, so only the most recent ones are kept
+    while len(_transformer_cache) > TRANSFORMER_CACHE_SIZE:
+        _transformer_cache.popitem(last=False)
+    return transformer
+
+def _graph_transformers(docs: list[Document], llm: BaseChatModel, allowed_nodes: List[str], allowed_relationships: List[str], node_properties: List[str], relationship_properties: List[str]) -> Dict[Optional[str], LLMGraphTransformer]:
+    """
+    Builds one LLMGraphTransformer per distinct metadata["document_context"] of the documents.
+    The context goes into the system prompt, so every section of a document shares the same prompt prefix and provider-side prompt caching applies.
+    """
+    transformers = {}
+    for doc in docs:
+        document_context = doc.metadata.get("document_context")
+        if document_context in transformers:
+            continue
+        additional_instructions = document_context_instructions(document_context)
+        transformers[document_context] = graph_transformer(llm, allowed_nodes, allowed_relationships, node_properties, relationship_properties, additional_instructions)
+    return transformers
+
+def _ledger_transformer_selector(docs: list[Document], llm: BaseChatModel, transformers: Dict[Optional[str], LLMGraphTransformer], ledger: Optional[LLMLedger],
+                                 allowed_nodes: List[str], allowed_relationships: List[str], node_properties: List[str], relationship_properties: List[str]) -> Callable[[Document], Tuple[LLMGraphTransformer, Optional[dict]]]:
+    """
+    Returns a function giving the transformer and the runnable config of a document: the config records the call in the ledger,
+    and the transformers of the fallback model are used once the ledger budget of the document is exhausted with the "degrade" action.
+    """
+    fallback_transformers = {}
+    if ledger is not None and ledger.fallback_llm is not None:
+        fallback_transformers = _graph_transformers(docs, ledger.fallback_llm, allowed_nodes, allowed_relationships, node_properties, relationship_properties)
+
+    def select(doc: Document) -> Tuple[LLMGraphTransformer, Optional[dict]]:
+        document_context = doc.metadata.get("document_context")
+        if ledger is None:
+            return transformers[document_context], None
+        source = doc.metadata.get("source")
+        selected = fallback_transformers if ledger.select_llm(llm, source) is not llm else transformers
+        return selected[document_context], ledger.config("graph_transformer", source, doc.metadata.get("section_title"))
+
+    return select
+
+def _routed_converter(router: ModelRouter, ledger: Optional[LLMLedger], allowed_nodes: List[str], allowed_relationships: List[str], node_properties: List[str], relationship_properties: List[str]) -> Callable[[Document], Awaitable[GraphDocument]]:
+    """
+    Returns a function converting a document with the model the router picks for it; the router models are language models.
+    An empty graph from the cheap model is escalated to the strong one, unless the ledger budget of the document is exhausted.
+    """
+    async def convert(doc: Document) -> GraphDocument:
+        document_context = doc.metadata.get("document_context")
+        additional_instructions = document_context_instructions(document_context)
+        source = doc.metadata.get("source")
+        config = ledger.config("graph_transformer", source, doc.metadata.get("section_title")) if ledger is not None else None
+        allow_strong = ledger is None or ledger.select_llm(router.strong, source) is router.strong
+        return await router.arun(doc.page_content,
+                                 lambda model: graph_transformer(model, allowed_nodes, allowed_relationships, node_properties, relationship_properties, additional_instructions).aprocess_response(doc, config=config),
+                                 allow_strong=allow_strong)
+
+    return convert
+
+async def stream_knowledge_graph_schema(docs: list[Document], llm: BaseChatModel, allowed_nodes: List[str], allowed_relationships: List[str], node_properties: List[str], relationship_properties: List[str], requests_per_minute: int, tokens_per_minute: int, max_retries: int = 5, ledger: Optional[LLMLedger] = None, router: Optional[ModelRouter] = None) -> AsyncIterator[Tuple[int, GraphDocument]]:
+    """
+    Converts documents into graph documents under request and token rate limits, yielding each graph document as soon as it is ready.
+    Token costs are estimated with tiktoken; the limiter backs off on rate-limit errors and failed documents are retried individually.
+
+    Parameters:
+    docs (list[Document]): A list of Document objects to be converted.
+    llm: The language model to use for conversion.
+    allowed_nodes (List[str]): A list of allowed node types.
+    allowed_relationships (List[str]): A list of allowed relationship types.
+    node_properties (List[str]): A list of properties for nodes.
+    relationship_properties (List[str]): A list of properties for relationships.
+    requests_per_minute (int): The request limit of the LLM account.
+    tokens_per_minute (int): The token limit of the LLM account.
+    max_retries (int): The number of retries per document.
+    ledger (LLMLedger): If given, every call is recorded in it and its token budgets are enforced. Documents stopped by the budget are not retried.
+    router (ModelRouter): If given, every document is converted by the cheap or the strong language model of the router instead of llm,
+    escalating to the strong one when the cheap one fails or returns an empty graph.
 
-async def create_knowledge_graph_schema(docs: list[Document], llm: BaseChatModel, allowed_nodes: List[str], allowed_relationships: List[str], node_properties: List[str], relationship_properties: List[str]) -> list[GraphDocument]:
+    Returns:
+    AsyncIterator[Tuple[int, GraphDocument]]: The index of each converted document in docs, with its graph document, in completion order.
+    """
+    transformers = _graph_transformers(docs, llm, allowed_nodes, allowed_relationships, node_properties, relationship_properties)
+    select_transformer = _ledger_transformer_selector(docs, llm, transformers, ledger, allowed_nodes, allowed_relationships, node_properties, relationship_properties)
+    model_name = getattr(llm, "model_name", None)
+    limiter = rate_limiter.AdaptiveRateLimiter(requests_per_minute, tokens_per_minute)
+
+    def cost(doc: Document) -> int:
+        # Cached prefixes still count against the account token limit
+        document_context = doc.metadata.get("document_context") or ""
+        return (rate_limiter.estimate_tokens(doc.page_content, model_name) + rate_limiter.estimate_tokens(document_context, model_name)
+                + rate_limiter.PROMPT_OVERHEAD_TOKENS + rate_limiter.COMPLETION_TOKENS_ESTIMATE)
+
+    convert = _routed_converter(router, ledger, allowed_nodes, allowed_relationships, node_properties, relationship_properties) if router is not None else None
+
+    async def process(doc: Document) -> GraphDocument:
+        if convert is not None:
+            return await convert(doc)
+        graph_transformer, config = select_transformer(doc)
+        return await graph_transformer.aprocess_response(doc, config=config)
+
+    async for index, graph_doc, error in rate_limiter.map_with_rate_limit(docs, process, cost, limiter, max_retries=max_retries, fatal_errors=(BudgetExceededError,)):
+        if error is not None:
+            print(f"Conversion failed for document {index} ({docs[index].metadata.get('source')}): {error}")
+            continue
+        yield index, graph_doc
+
+async def _convert_documents(docs: list[Document], llm: BaseChatModel, allowed_nodes: List[str], allowed_relationships: List[str], node_properties: List[str], relationship_properties: List[str], requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None, spool: Optional[GraphSpool] = None, ledger: Optional[LLMLedger] = None, router: Optional[ModelRouter] = None) -> Dict[int, GraphDocument]:
+    converted = {}
+    if requests_per_minute and tokens_per_minute:
+        async for index, graph_doc in stream_knowledge_graph_schema(docs, llm, allowed_nodes, allowed_relationships, node_properties, relationship_properties,
+                                                                    requests_per_minute, tokens_per_minute, ledger=ledger, router=router):
+            converted[index] = graph_doc
+            if spool is not None:
+                spool.write(graph_doc)
+        return converted
+    if router is not None:
+        convert = _routed_converter(router, ledger, allowed_nodes, allowed_relationships, node_properties, relationship_properties)
+        graph_docs = await asyncio.gather(*[convert(doc) for doc in docs], return_exceptions=True)
+        for index, graph_doc in enumerate(graph_docs):
+            if isinstance(graph_doc, BudgetExceededError):
+                raise graph_doc
+            if isinstance(graph_doc, BaseException):
+                print(f"Conversion failed for document {index} ({docs[index].metadata.get('source')}): {graph_doc}")
+                continue
+            converted[index] = graph_doc
+            if spool is not None:
+                spool.write(graph_doc)
+        print(router.report())
+        return converted
+    # Documents sharing a context are converted together, with the context as common prompt prefix
+    transformers = _graph_transformers(docs, llm, allowed_nodes, allowed_relationships, node_properties, relationship_properties)
+    select_transformer = _ledger_transformer_selector(docs, llm, transformers, ledger, allowed_nodes, allowed_relationships, node_properties, relationship_properties)
+    for document_context, graph_transformer in transformers.items():
+        indexes = [index for index, doc in enumerate(docs) if doc.metadata.get("document_context") == document_context]
+        if ledger is None:
+            graph_docs = await graph_transformer.aconvert_to_graph_documents([docs[index] for index in indexes])
+        else:
+            # Every document gets its own config, so the ledger knows the source file and section of each call
+            selections = [select_transformer(docs[index]) for index in indexes]
+            graph_docs = await asyncio.gather(*[transformer.aprocess_response(docs[index], config=config) for index, (transformer, config) in zip(indexes, selections)],
+                                              return_exceptions=True)
+        errors = []
+        for index, graph_doc in zip(indexes, graph_docs):
+            if isinstance(graph_doc, BaseException):
+                errors.append(graph_doc)
+                continue
+            converted[index] = graph_doc
+            if spool is not None:
+                spool.write(graph_doc)
+        # The conversions already paid for are spooled before a budget or conversion error stops the run
+        if errors:
+            raise next((error for error in errors if isinstance(error, BudgetExceededError)), errors[0])
+    return converted
+
+def _model_id(model) -> str:
+    # Chains and transformers do not expose a model name, their language model does
+    model = getattr(model, "llm", None) or getattr(model, "bound", None) or model
+    return str(getattr(model, "model_name", None) or getattr(model, "model", None) or type(model).__name__)
+
+async def create_knowledge_graph_schema(docs: list[Document], llm: BaseChatModel, allowed_nodes: List[str], allowed_relationships: List[str], node_properties: List[str], relationship_properties: List[str], resolve_entities: bool = False, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None, dedup_index: Optional[SectionDedupIndex] = None, spool_dir: Optional[str] = None, ledger: Optional[LLMLedger] = None, router: Optional[ModelRouter] = None) -> list[GraphDocument]:
     """
     Converts a list of documents into graph documents using a language model.
+    Documents carrying a metadata["document_context"] are converted with that context as a shared prompt prefix.
 
     Parameters:
     docs (list[Document]): A list of Document objects to be converted.
@@ -26,30 +234,92 @@ async def create_knowledge_graph_schema(docs: list[Document], llm: BaseChatModel
     allowed_relationships (List[str]): A list of allowed relationship types.
     node_properties (List[str]): A list of properties for nodes.
     relationship_properties (List[str]): A list of properties for relationships.
+    resolve_entities (bool): Whether to merge spelling, casing and accent variants of the same node before returning. Default is False.
+    requests_per_minute (int): If given together with tokens_per_minute, documents are converted under these rate limits (see stream_knowledge_graph_schema).
+    tokens_per_minute (int): The token limit of the LLM account.
+    dedup_index (SectionDedupIndex): If given, documents that are near-duplicates of sections converted in this or previous runs reuse their graph documents,
+    and only their new sentences are sent to the LLM. Every converted document is added to the index.
+    spool_dir (str): If given, every graph document is persisted there as soon as it is produced (see graph_spool), and documents already
+    in the spool are read back instead of being converted again, so an interrupted or failed run resumes without paying for the LLM twice.
+    ledger (LLMLedger): If given, every LLM call is recorded in it with the source file and section of its document, and its token budgets are enforced.
+    router (ModelRouter): If given, every document is converted by the cheap or the strong language model of the router, picked from the features
+    of the section, and escalated to the strong one when the cheap one fails or returns an empty graph (see model_router).
 
     Returns:
-    list[GraphDocument]: A list of GraphDocument objects representing the knowledge graph schema.
+    list[GraphDocument]: A list of GraphDocument objects representing the knowledge graph schema. Documents whose conversion failed are left out.
     """
-    graph_transformer = LLMGraphTransformer(llm=llm,
-                                            allowed_nodes=allowed_nodes,
-                                            allowed_relationships=allowed_relationships,
-                                            node_properties=node_properties,
-                                            relationship_properties=relationship_properties)
-    return await graph_transformer.aconvert_to_graph_documents(docs)
+    # A re-run with another schema or model must not read back the graphs extracted with the old ones
+    fingerprint = extraction_fingerprint({"allowed_nodes": allowed_nodes, "allowed_relationships": allowed_relationships, "node_properties": node_properties,
+                                          "relationship_properties": relationship_properties,
+                                          "models": [_model_id(model) for model in ((router.cheap, router.strong) if router is not None else (llm,))]})
+    spool = GraphSpool(spool_dir, fingerprint) if spool_dir else None
+    results = {}
+    pending = []
+    for index, doc in enumerate(docs):
+        spooled = spool.get(doc) if spool is not None else None
+        if spooled is not None:
+            results[index] = spooled
+        else:
+            pending.append(index)
+    if spool is not None:
+        print(f"Read {len(results)} graph documents from the spool, {len(pending)} documents left to convert")
 
-def create_knowledge_graph(docs: list[GraphDocument], kg_url: Optional[str] = None, kg_username: Optional[str] = None, kg_password: Optional[str] = None, kg_db_name: Optional[str] = None) -> None:
+    if dedup_index is None:
+        converted = await _convert_documents([docs[index] for index in pending], llm, allowed_nodes, allowed_relationships, node_properties, relationship_properties,
+                                             requests_per_minute, tokens_per_minute, spool, ledger, router)
+        for position, graph_doc in converted.items():
+            results[pending[position]] = graph_doc
+    else:
+        to_convert, matches = [], []
+        reused = 0
+        for index in pending:
+            doc = docs[index]
+            match = dedup_index.lookup(doc.page_content)
+            if match is not None and match["removed_sentences"]:
+                # The graph of the match may come from sentences this section no longer has
+                match = None
+            if match is not None and match["result"] is not None and not match["new_sentences"]:
+                results[index] = graph_document_from_dict(match["result"], doc)
+                reused += 1
+                if spool is not None:
+                    spool.write(results[index])
+                continue
+            if match is not None and match["result"] is not None:
+                # Only the sentences missing from the matching section are sent to the LLM
+                to_convert.append(Document(page_content="\n".join(match["new_sentences"]), metadata=doc.metadata))
+            else:
+                match = None
+                to_convert.append(doc)
+            matches.append((index, match))
+        print(f"Reusing {reused} near-duplicate sections, converting {len(to_convert)} sections ({sum(match is not None for _, match in matches)} partially)")
+        converted = await _convert_documents(to_convert, llm, allowed_nodes, allowed_relationships, node_properties, relationship_properties,
+                                             requests_per_minute, tokens_per_minute, ledger=ledger, router=router)
+        for position, graph_doc in converted.items():
+            index, match = matches[position]
+            result = graph_document_to_dict(graph_doc)
+            if match is not None:
+                result = {key: match["result"].get(key, []) + value for key, value in result.items()}
+            dedup_index.add(docs[index].page_content, docs[index].metadata.get("source", ""), result)
+            results[index] = graph_document_from_dict(result, docs[index])
+            if spool is not None:
+                spool.write(results[index])
+    graph_docs = [results[index] for index in sorted(results)]
+    if resolve_entities:
+        graph_docs, _ = entity_resolution.resolve_graph_documents(graph_docs)
+    return graph_docs
+
+def connect_knowledge_graph(kg_url: Optional[str] = None, kg_username: Optional[str] = None, kg_password: Optional[str] = None, kg_db_name: Optional[str] = None) -> Neo4jGraph:
     """
-    Creates a knowledge graph in a Neo4j database from a list of graph documents.
+    Connects to a Neo4j database, creating it if it does not exist. Environment variables take precedence over the parameters.
 
     Parameters:
-    docs (list[GraphDocument]): A list of GraphDocument objects to be added to the knowledge graph.
     kg_url: The URL of the Neo4j database.
     kg_username: The username for the Neo4j database.
     kg_password: The password for the Neo4j database.
     kg_db_name: The name of the Neo4j database.
 
     Returns:
-    None
+    Neo4jGraph: The connected graph.
     """
     if not (kg_url := os.environ.get("NEO4J_URI", kg_url)):
         raise ValueError("Neo4j URL not provided.")
@@ -68,6 +338,68 @@ def create_knowledge_graph(docs: list[GraphDocument], kg_url: Optional[str] = No
         base_graph_db = Neo4jGraph(url=kg_url, username=kg_username, password=kg_password)
         base_graph_db.query(CREATE_DB_QUERY.format(kg_db_name=kg_db_name))
         graph_db = Neo4jGraph(url=kg_url, username=kg_username, password=kg_password, database=kg_db_name)
+    return graph_db
+
+def create_knowledge_graph(docs: list[GraphDocument], kg_url: Optional[str] = None, kg_username: Optional[str] = None, kg_password: Optional[str] = None, kg_db_name: Optional[str] = None, consolidate: bool = False, sink: Optional[GraphSink] = None, schema: Optional[GraphSchema] = None, sharding: Optional[ShardedGraphWriter] = None, shard_key: Optional[str] = None) -> None:
+    """
+    Creates a knowledge graph in a Neo4j database from a list of graph documents.
+
+    Parameters:
+    docs (list[GraphDocument]): A list of GraphDocument objects to be added to the knowledge graph.
+    kg_url: The URL of the Neo4j database.
+    kg_username: The username for the Neo4j database.
+    kg_password: The password for the Neo4j database.
+    kg_db_name: The name of the Neo4j database.
+    consolidate (bool): Whether to deduplicate nodes and relationships across the documents and write each distinct element once,
+    with batched UNWIND statements, instead of MERGEing every occurrence. Default is False.
+    sink (GraphSink): The target to write to instead of Neo4jGraph. Default is the one selected by the GRAPH_SINK environment variable, if set,
+    which connects with the kg_* parameters and creates the database if missing. Sinks always consolidate.
+    schema (GraphSchema): If given, its constraints and indexes are created before writing, e.g. GraphSchema.from_graph_params with the
+    allowed nodes and relationships of the extraction. The labels written without an index are reported either way.
+    sharding (ShardedGraphWriter): If given, the documents are written to the shard of their shard_key instead of a single database,
+    the shards in parallel. The schema of the writer is created in every new shard.
+    shard_key (str): The metadata of the source document the shard is chosen by, shared by a collection of documents, e.g. "collection".
+    If not given, the writer must have max_shards, and the source files are hashed into that many databases instead of getting one each.
+
+    Returns:
+    None
+    """
+    if sharding is not None:
+        if shard_key is None and not sharding.max_shards:
+            raise ValueError("Sharding needs a shard_key shared by a collection of documents, or a writer with max_shards: "
+                             "sharding by source file would create a database per file.")
+        report = sharding.write(docs, key=lambda doc: doc.source.metadata.get(shard_key or "source"), to_batch=GraphBatch.from_graph_documents,
+                                source=lambda doc: doc.source.metadata.get("source"))
+        print(ShardedGraphWriter.format_report(report))
+        return
+    if sink is not None or os.environ.get("GRAPH_SINK"):
+        graph_sink = sink or get_graph_sink(database=kg_db_name, url=kg_url, username=kg_username, password=kg_password, create_database=True)
+        try:
+            if schema is not None and isinstance(graph_sink, Neo4jGraphSink):
+                print(GraphSchemaManager.format_report(GraphSchemaManager(driver_query(graph_sink.driver, graph_sink.database)).ensure(schema)))
+            graph_sink.write_graph_documents(docs)
+            print(graph_sink.report())
+        finally:
+            if sink is None:
+                graph_sink.close()
+        return
+    graph_db = connect_knowledge_graph(kg_url, kg_username, kg_password, kg_db_name)
+    schema_manager = GraphSchemaManager(graph_db.query)
+    if schema is not None:
+        print(GraphSchemaManager.format_report(schema_manager.ensure(schema)))
+    # Graph documents are MERGEd on their id, or on their merge key when consolidated
+    key_names = (MERGE_KEY_PROPERTY,) if consolidate else ("id",)
+    signatures = [(node.type, key_names) for doc in docs for node in doc.nodes]
+    signatures += [(node.type, key_names) for doc in docs for rel in doc.relationships for node in (rel.source, rel.target)]
+    for label, _ in schema_manager.missing_indexes(signatures):
+        print(f"No index for MERGE on :{label}({', '.join(key_names)}), every write scans all the {label} nodes.")
+    if consolidate:
+        consolidated = graph_consolidation.consolidate_graph_documents(docs)
+        report = consolidated.report()
+        print(f"Consolidated {report['nodes_in']} nodes into {report['nodes_out']} and {report['relationships_in']} relationships into {report['relationships_out']}")
+        timings = graph_consolidation.write_consolidated_graph(graph_db, consolidated)
+        print(f"Wrote the graph with {timings['statements']} statements in {timings['nodes_seconds'] + timings['relationships_seconds']:.1f}s")
+        return
     graph_db.add_graph_documents(docs)
     return
 
@@ -0,0 +1,341 @@
+import argparse
+import os
+import re
+import shutil
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+DEFAULT_CACHE_DIR = "export_data/parquet"
+PARTITION_COLUMNS = ("compagnia_exp", "data_elaborazione_file")
+JOIN_KEY_COLUMNS = ("id_polizza_exp", "id_sinistro_exp", "id_anagrafica_exp")
+INDEX_DIRECTORY = "_index"
+DECIMAL_TYPE = pa.decimal128(38, 9)
+DICTIONARY_RATIO = 0.5
+DEFAULT_BLOCK_SIZE = 16 << 20
+# Small row groups let a lookup read only the index rows around its keys
+INDEX_ROW_GROUP_SIZE = 64 * 1024
+
+_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+_INTEGER = re.compile(r"^-?\d+$")
+_DECIMAL = re.compile(r"^-?\d+(\.\d+)?$")
+_ZERO_PADDED = re.compile(r"^-?0\d+$")
+
+
+def _normalize_batch(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """
+    Trims the fixed-width padding of every column and turns empty strings into nulls.
+    """
+    arrays = []
+    for array in batch.columns:
+        trimmed = pc.utf8_trim_whitespace(array)
+        arrays.append(pc.if_else(pc.equal(trimmed, ""), pa.scalar(None, pa.string()), trimmed))
+    return pa.RecordBatch.from_arrays(arrays, names=batch.schema.names)
+
+
+def infer_column_type(name: str, values: pa.Array) -> pa.DataType:
+    """
+    Infers the type of a normalized string column from a sample of its values.
+    Zero-padded codes and join keys always stay strings, so that "035" is never read back as 35.
+
+    Parameters:
+    name (str): The column name.
+    values (pa.Array): A sample of the column values, already normalized.
+
+    Returns:
+    pa.DataType: The inferred type.
+    """
+    if name in PARTITION_COLUMNS or name in JOIN_KEY_COLUMNS or name.startswith("id_"):
+        return pa.string()
+    sample = [v for v in values.to_pylist() if v is not None]
+    if not sample:
+        return pa.string()
+    if all(_DATE.match(v) for v in sample):
+        return pa.date32()
+    if any(_ZERO_PADDED.match(v) for v in sample):
+        return pa.string()
+    if all(_INTEGER.match(v) for v in sample):
+        return pa.int64()
+    if all(_DECIMAL.match(v) for v in sample):
+        return DECIMAL_TYPE
+    if len(set(sample)) <= DICTIONARY_RATIO * len(sample):
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+def _widen_type(current: Optional[pa.DataType], inferred: pa.DataType) -> pa.DataType:
+    """
+    Combines the types inferred from two blocks of a column into one that fits both, falling back to string.
+    """
+    if current is None or current == inferred:
+        return inferred
+    if {current, inferred} == {pa.int64(), DECIMAL_TYPE}:
+        return DECIMAL_TYPE
+    return pa.string()
+
+
+def _cast_batch(batch: pa.RecordBatch, schema: pa.Schema) -> pa.RecordBatch:
+    arrays = []
+    for field, array in zip(schema, batch.columns):
+        try:
+            arrays.append(pc.cast(array, field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+            raise ValueError(f"Column {field.name} does not fit the inferred type {field.type}. Pass it in type_overrides.") from e
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _hive_partitioning(dataset_directory: str) -> ds.Partitioning:
+    """
+    Rebuilds the partitioning of a dataset from its directory names. Partition values are declared as strings,
+    otherwise discovery would turn "4" and "2024-07-01" into numbers and dates.
+    """
+    names = []
+    directory = dataset_directory
+    while True:
+        partitions = sorted(entry for entry in os.listdir(directory) if "=" in entry and os.path.isdir(os.path.join(directory, entry)))
+        if not partitions:
+            break
+        names.append(partitions[0].split("=", 1)[0])
+        directory = os.path.join(directory, partitions[0])
+    return ds.partitioning(pa.schema([(name, pa.string()) for name in names]), flavor="hive")
+
+
+def _decode_dictionaries(table: pa.Table) -> pa.Table:
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(i, field.name, pc.cast(table.column(i), field.type.value_type))
+    return table
+
+
+def convert_csv(path: str, output_directory: str, type_overrides: Optional[Dict[str, pa.DataType]] = None, block_size: int = DEFAULT_BLOCK_SIZE) -> pa.Schema:
+    """
+    Converts one export_data CSV file into a dictionary-encoded Parquet dataset partitioned by company and export date.
+    The file is streamed twice: column types are inferred from every block, so a zero-padded or non-numeric value late in the file
+    widens its column to string, then the blocks are cast and written. The dataset is written to a temporary directory first,
+    and its partitions replace the existing ones only once the whole file is converted.
+
+    Parameters:
+    path (str): The path to the CSV file.
+    output_directory (str): The directory of the Parquet dataset. Existing partitions are replaced.
+    type_overrides (Dict[str, pa.DataType]): Types to use instead of the inferred ones.
+    block_size (int): The number of CSV bytes parsed per batch.
+
+    Returns:
+    pa.Schema: The schema of the written dataset.
+    """
+    header = pv.open_csv(path, read_options=pv.ReadOptions(block_size=block_size)).schema.names
+
+    def batches() -> Iterator[pa.RecordBatch]:
+        reader = pv.open_csv(path,
+                             read_options=pv.ReadOptions(block_size=block_size),
+                             convert_options=pv.ConvertOptions(column_types={column: pa.string() for column in header},
+                                                               strings_can_be_null=True))
+        return (_normalize_batch(batch) for batch in reader)
+
+    type_overrides = type_overrides or {}
+    types: Dict[str, Optional[pa.DataType]] = {name: None for name in header}
+    empty = True
+    for batch in batches():
+        empty = False
+        for name in header:
+            column = batch.column(name)
+            # Blocks where the column is empty say nothing about its type
+            if name not in type_overrides and column.null_count < len(column):
+                types[name] = _widen_type(types[name], infer_column_type(name, column))
+    if empty:
+        raise ValueError(f"{path} is empty.")
+    schema = pa.schema([(name, type_overrides.get(name) or types[name] or pa.string()) for name in header])
+
+    partition_columns = [column for column in PARTITION_COLUMNS if column in header]
+    tmp_directory = f"{output_directory.rstrip(os.sep)}.tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    try:
+        ds.write_dataset((_cast_batch(batch, schema) for batch in batches()),
+                         base_dir=tmp_directory,
+                         schema=schema,
+                         format="parquet",
+                         partitioning=ds.partitioning(pa.schema([schema.field(c) for c in partition_columns]), flavor="hive") if partition_columns else None,
+                         file_options=ds.ParquetFileFormat().make_write_options(use_dictionary=True, compression="zstd"))
+        _replace_partitions(tmp_directory, output_directory)
+    finally:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    return schema
+
+
+def _replace_partitions(source_directory: str, output_directory: str) -> None:
+    """
+    Moves the partitions of a freshly written dataset into place, replacing the same partitions of the existing dataset and keeping the others.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    for directory, subdirectories, files in os.walk(source_directory):
+        if not files:
+            continue
+        relative = os.path.relpath(directory, source_directory)
+        target = os.path.normpath(os.path.join(output_directory, relative))
+        if relative == os.curdir:
+            # Unpartitioned dataset: its data files are replaced, the index directory is rebuilt afterwards
+            for entry in os.listdir(target):
+                if not entry.startswith("_") and os.path.isfile(os.path.join(target, entry)):
+                    os.remove(os.path.join(target, entry))
+            for file in files:
+                os.replace(os.path.join(directory, file), os.path.join(target, file))
+            continue
+        shutil.rmtree(target, ignore_errors=True)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(directory, target)
+        subdirectories.clear()
+
+
+def build_index(dataset_directory: str, column: str) -> str:
+    """
+    Builds a sidecar index of a join-key column, mapping every key to the file, row group and row holding it.
+
+    Parameters:
+    dataset_directory (str): The directory of a Parquet dataset written by convert_csv.
+    column (str): The join-key column.
+
+    Returns:
+    str: The path of the index file.
+    """
+    keys, files, row_groups, rows = [], [], [], []
+    for fragment in ds.dataset(dataset_directory, format="parquet", partitioning=_hive_partitioning(dataset_directory)).get_fragments():
+        parquet_file = pq.ParquetFile(fragment.path)
+        relative_path = os.path.relpath(fragment.path, dataset_directory)
+        for row_group in range(parquet_file.num_row_groups):
+            values = parquet_file.read_row_group(row_group, columns=[column]).column(0)
+            valid = pc.is_valid(values).to_numpy(zero_copy_only=False)
+            positions = np.nonzero(valid)[0]
+            keys.append(pc.drop_null(values).combine_chunks())
+            files.append(pa.array([relative_path] * len(positions), pa.string()).dictionary_encode())
+            row_groups.append(np.full(len(positions), row_group, dtype=np.int32))
+            rows.append(positions.astype(np.int32))
+    index = pa.table({
+        "key": pa.chunked_array(keys, pa.string()),
+        "file": pa.chunked_array(files, pa.dictionary(pa.int32(), pa.string())),
+        "row_group": pa.array(np.concatenate(row_groups) if row_groups else [], pa.int32()),
+        "row": pa.array(np.concatenate(rows) if rows else [], pa.int32()),
+    }).sort_by("key")
+    index_path = os.path.join(dataset_directory, INDEX_DIRECTORY, f"{column}.parquet")
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    pq.write_table(index, index_path, row_group_size=INDEX_ROW_GROUP_SIZE)
+    return index_path
+
+
+class ParquetCache:
+
+    def __init__(self, cache_directory: str = DEFAULT_CACHE_DIR):
+        """
+        Initializes the ParquetCache class.
+
+        Parameters:
+        cache_directory (str): The directory holding one Parquet dataset per export_data table.
+        """
+        self.cache_directory = cache_directory
+
+    def build(self, csv_directory: str, type_overrides: Optional[Dict[str, pa.DataType]] = None) -> None:
+        """
+        Converts every CSV file of a directory and indexes the join keys found in it.
+
+        Parameters:
+        csv_directory (str): The directory containing the export_data CSV files.
+        type_overrides (Dict[str, pa.DataType]): Types to use instead of the inferred ones.
+
+        Returns:
+        None
+        """
+        for filename in sorted(os.listdir(csv_directory)):
+            if not filename.endswith(".csv"):
+                continue
+            table_name = os.path.splitext(filename)[0]
+            print(f"Converting {filename} ...")
+            schema = convert_csv(os.path.join(csv_directory, filename), self.path(table_name), type_overrides)
+            for column in JOIN_KEY_COLUMNS:
+                if column in schema.names:
+                    build_index(self.path(table_name), column)
+
+    def path(self, table_name: str) -> str:
+        return os.path.join(self.cache_directory, table_name)
+
+    def dataset(self, table_name: str) -> ds.Dataset:
+        """
+        Opens the Parquet dataset of a table. Index files are skipped because their directory starts with an underscore.
+        """
+        return ds.dataset(self.path(table_name), format="parquet", partitioning=_hive_partitioning(self.path(table_name)))
+
+    def _positions(self, table_name: str, column: str, values: List[str]) -> List[Tuple[str, int, int]]:
+        """
+        Returns the (file, row group, row) positions of the given keys. The index is sorted by key, so the filter only reads
+        the index row groups whose key range may hold them.
+        """
+        index_path = os.path.join(self.path(table_name), INDEX_DIRECTORY, f"{column}.parquet")
+        if not os.path.exists(index_path):
+            raise ValueError(f"No index on {column} for table {table_name}.")
+        if not values:
+            return []
+        index = pq.read_table(index_path, columns=["file", "row_group", "row"], filters=[("key", "in", list(set(values)))])
+        return list(zip(index.column("file").to_pylist(), index.column("row_group").to_pylist(), index.column("row").to_pylist()))
+
+    def lookup(self, table_name: str, column: str, values: List[str], columns: Optional[List[str]] = None) -> pa.Table:
+        """
+        Reads the rows whose join key is one of the given values, touching only the row groups that hold them.
+
+        Parameters:
+        table_name (str): The table name, e.g. "050_Sinistri".
+        column (str): The indexed join-key column.
+        values (List[str]): The key values to look up.
+        columns (List[str]): The columns to return. Default is all columns.
+
+        Returns:
+        pa.Table: The matching rows.
+        """
+        by_row_group = defaultdict(list)
+        for file, row_group, row in self._positions(table_name, column, values):
+            by_row_group[(file, row_group)].append(row)
+        parts = []
+        for (file, row_group), rows in by_row_group.items():
+            parquet_file = pq.ParquetFile(os.path.join(self.path(table_name), file))
+            file_columns = None if columns is None else [c for c in columns if c in parquet_file.schema_arrow.names]
+            part = parquet_file.read_row_group(row_group, columns=file_columns).take(pa.array(rows, pa.int32()))
+            # Partition columns live in the directory names, not in the files
+            for directory in os.path.dirname(file).split(os.sep):
+                name, _, value = directory.partition("=")
+                if value and (columns is None or name in columns):
+                    part = part.append_column(name, pa.array([value] * part.num_rows, pa.string()))
+            parts.append(part)
+        if not parts:
+            empty = self.dataset(table_name).schema.empty_table()
+            return empty if columns is None else empty.select(columns)
+        return pa.concat_tables(parts, promote_options="default")
+
+    def join(self, left: pa.Table, right_table_name: str, key: str, right_columns: Optional[List[str]] = None) -> pa.Table:
+        """
+        Joins a table with another cached table, fetching only the right-hand rows whose key appears on the left.
+
+        Parameters:
+        left (pa.Table): The left-hand rows, e.g. the result of lookup.
+        right_table_name (str): The table to join with.
+        key (str): The indexed join-key column, present in both tables.
+        right_columns (List[str]): The right-hand columns to return. The key is always included.
+
+        Returns:
+        pa.Table: The inner join of the two tables.
+        """
+        if right_columns is not None and key not in right_columns:
+            right_columns = [key] + right_columns
+        keys = pc.unique(left.column(key)).drop_null().to_pylist()
+        right = self.lookup(right_table_name, key, keys, right_columns)
+        return _decode_dictionaries(left).join(_decode_dictionaries(right), keys=key, join_type="inner", right_suffix="_right")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the export_data CSV files into an indexed Parquet cache.")
+    parser.add_argument("csv_directory", nargs="?", default="export_data")
+    parser.add_argument("--output", default=DEFAULT_CACHE_DIR)
+    args = parser.parse_args()
+    ParquetCache(args.output).build(args.csv_directory)
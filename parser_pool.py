@@ -0,0 +1,340 @@
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Optional, Set, TypeVar
+from urllib.parse import urlsplit
+
+import urllib3
+
+FAILURE_THRESHOLD = 3
+RESET_SECONDS = 30.0
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+HEALTH_INTERVAL = 10.0
+HEALTH_TIMEOUT = 2.0
+
+T = TypeVar("T")
+
+
+class ParserResponseError(ValueError):
+
+    def __init__(self, message: str, status: int):
+        """
+        Initializes the ParserResponseError class, a parser answering with an error status.
+
+        Parameters:
+        message (str): The error message.
+        status (int): The HTTP status of the answer.
+        """
+        super().__init__(message)
+        self.status = status
+
+
+def is_replica_failure(error: BaseException) -> bool:
+    """
+    Tells failures of a replica (connection errors, timeouts and 5xx answers) from errors about the document, such as a 4xx answer
+    or a response that is not the expected JSON. Only the former count against the replica and are retried on another one.
+    """
+    if isinstance(error, ParserResponseError):
+        return error.status >= 500
+    return isinstance(error, (urllib3.exceptions.HTTPError, ConnectionError, TimeoutError))
+
+
+class ParserReplica:
+
+    def __init__(self, url: str):
+        """
+        Initializes the ParserReplica class, the load, circuit breaker and latency state of one parser endpoint.
+
+        Parameters:
+        url (str): The API URL of the replica, e.g. "http://localhost:5010/api/parseDocument?renderFormat=all".
+        """
+        self.url = url
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.healthy = True
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def state(self, now: float) -> str:
+        if self.consecutive_failures == 0 or self.open_until == 0.0:
+            return "closed"
+        return "open" if now < self.open_until else "half-open"
+
+    def available(self, now: float) -> bool:
+        state = self.state(now)
+        # A half-open replica gets a single trial request, its outcome closes or reopens the circuit
+        return self.healthy and (state == "closed" or (state == "half-open" and self.in_flight == 0))
+
+
+class ParserPool:
+
+    def __init__(self, urls: List[str], failure_threshold: int = FAILURE_THRESHOLD, reset_seconds: float = RESET_SECONDS,
+                 hedge: bool = True, hedge_quantile: float = HEDGE_QUANTILE, hedge_min_samples: int = HEDGE_MIN_SAMPLES,
+                 hedge_after: Optional[float] = None, http: Optional[urllib3.PoolManager] = None, health_timeout: float = HEALTH_TIMEOUT,
+                 replica_failure: Callable[[BaseException], bool] = is_replica_failure):
+        """
+        Initializes the ParserPool class, spreading parse requests over several LLM Sherpa (nlm-ingestor) replicas.
+        Every request goes to the least-loaded available replica. A replica failing failure_threshold times in a row, or its health check,
+        is skipped until reset_seconds have passed, then gets one trial request. A request slower than the hedge_quantile of the recent
+        latencies is duplicated to a second replica, and the first response wins.
+
+        Parameters:
+        urls (List[str]): The API URLs of the replicas.
+        failure_threshold (int): The consecutive failures that open the circuit of a replica.
+        reset_seconds (float): How long an open circuit stays open before the trial request.
+        hedge (bool): Whether to duplicate slow requests to a second replica. Default is True.
+        hedge_quantile (float): The latency quantile after which a request is hedged. Default is the p95.
+        hedge_min_samples (int): The number of latencies needed before the quantile is trusted. Until then requests are not hedged.
+        hedge_after (float): If given, requests are hedged after this many seconds instead of the quantile.
+        http (urllib3.PoolManager): The connection pool of the health checks. Default is a new pool.
+        health_timeout (float): The timeout of a health check, in seconds.
+        replica_failure (Callable[[BaseException], bool]): Whether an error is a failure of the replica. Other errors are about the document:
+        they are raised at once, without failing over. Default is is_replica_failure.
+        """
+        if not urls:
+            raise ValueError("At least one parser URL is required.")
+        self.replicas = [ParserReplica(url) for url in dict.fromkeys(urls)]
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.hedge = hedge and len(self.replicas) > 1
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_after = hedge_after
+        self.http = http or urllib3.PoolManager()
+        self._owns_http = http is None
+        self.health_timeout = health_timeout
+        self.replica_failure = replica_failure
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.stats = {"requests": 0, "failovers": 0, "hedged": 0, "hedges_won": 0}
+        self.lock = threading.Lock()
+        # Two attempts per replica at most: the request and a hedge of another one
+        self.executor = ThreadPoolExecutor(max_workers=max(2 * len(self.replicas), 4), thread_name_prefix="parser-pool")
+        self._health_stop = threading.Event()
+        self._health_thread: Optional[threading.Thread] = None
+
+    @property
+    def urls(self) -> List[str]:
+        return [replica.url for replica in self.replicas]
+
+    def _acquire(self, exclude: Set[str] = frozenset()) -> Optional[ParserReplica]:
+        with self.lock:
+            now = time.monotonic()
+            candidates = [replica for replica in self.replicas if replica.url not in exclude and replica.available(now)]
+            if not candidates:
+                return None
+            replica = min(candidates, key=lambda r: (r.in_flight, statistics.fmean(r.latencies) if r.latencies else 0.0))
+            replica.in_flight += 1
+            replica.requests += 1
+            return replica
+
+    def _release(self, replica: ParserReplica, seconds: float, error: Optional[BaseException]) -> None:
+        with self.lock:
+            replica.in_flight -= 1
+            if error is None or not self.replica_failure(error):
+                # The replica answered, even if about a bad document
+                replica.consecutive_failures, replica.open_until = 0, 0.0
+                if error is None:
+                    replica.latencies.append(seconds)
+                    self.latencies.append(seconds)
+                return
+            replica.failures += 1
+            replica.consecutive_failures += 1
+            if replica.consecutive_failures >= self.failure_threshold:
+                if replica.state(time.monotonic()) != "open":
+                    print(f"Parser {replica.url} failed {replica.consecutive_failures} times, skipping it for {self.reset_seconds:.0f}s")
+                replica.open_until = time.monotonic() + self.reset_seconds
+
+    def _attempt(self, replica: ParserReplica, call: Callable[[str], T]) -> T:
+        start = time.perf_counter()
+        try:
+            result = call(replica.url)
+        except BaseException as e:
+            self._release(replica, time.perf_counter() - start, e)
+            raise
+        self._release(replica, time.perf_counter() - start, None)
+        return result
+
+    def _unavailable(self) -> ValueError:
+        return ValueError(f"No parser replica available: {', '.join(f'{r.url} ({self._describe(r)})' for r in self.replicas)}")
+
+    def _describe(self, replica: ParserReplica) -> str:
+        return replica.state(time.monotonic()) if replica.healthy else "unhealthy"
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        Returns the seconds after which a request is hedged, or None if it is not.
+        """
+        if not self.hedge:
+            return None
+        if self.hedge_after is not None:
+            return self.hedge_after
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return latencies[min(int(self.hedge_quantile * len(latencies)), len(latencies) - 1)]
+
+    def call(self, call: Callable[[str], T]) -> T:
+        """
+        Runs a parse request on the least-loaded replica, hedging it to a second replica when slow and failing over when the replica fails.
+        Errors about the document are raised at once.
+
+        Parameters:
+        call (Callable[[str], T]): The request, given the URL of a replica, e.g. lambda url: LayoutPDFReader(url).read_pdf(file).
+
+        Returns:
+        T: The result of the first successful attempt. The loser of a hedge is left to finish and its result is dropped.
+        """
+        with self.lock:
+            self.stats["requests"] += 1
+        replica = self._acquire()
+        if replica is None:
+            raise self._unavailable()
+        tried = {replica.url}
+        pending: Dict[Future, ParserReplica] = {self.executor.submit(self._attempt, replica, call): replica}
+        hedged = False
+        delay = self.hedge_delay()
+        error: Optional[BaseException] = None
+        while pending:
+            done, _ = wait(pending, timeout=None if hedged or delay is None else delay, return_when=FIRST_COMPLETED)
+            if not done:
+                # The request is slower than the quantile: race it on a second replica
+                hedged = True
+                hedge = self._acquire(tried)
+                if hedge is not None:
+                    tried.add(hedge.url)
+                    pending[self.executor.submit(self._attempt, hedge, call)] = hedge
+                    with self.lock:
+                        self.stats["hedged"] += 1
+                continue
+            for future in done:
+                finished = pending.pop(future)
+                if future.exception() is None:
+                    if hedged and finished is not replica:
+                        with self.lock:
+                            self.stats["hedges_won"] += 1
+                    return future.result()
+                error = future.exception()
+                if not self.replica_failure(error):
+                    raise error
+            if not pending:
+                failover = self._acquire(tried)
+                if failover is not None:
+                    print(f"Parser {finished.url} failed ({type(error).__name__}: {error}), retrying on {failover.url}")
+                    tried.add(failover.url)
+                    pending[self.executor.submit(self._attempt, failover, call)] = failover
+                    with self.lock:
+                        self.stats["failovers"] += 1
+        raise error
+
+    def stream(self, call: Callable[[str], Iterator[T]]) -> Iterator[T]:
+        """
+        Runs a streaming parse request on the least-loaded replica. Streams are not hedged, since their items are consumed as they arrive,
+        but a stream whose replica fails before the first item fails over to another replica.
+
+        Parameters:
+        call (Callable[[str], Iterator[T]]): The request, given the URL of a replica, e.g. lambda url: iter_llmsherpa_blocks(file, url).
+
+        Returns:
+        Iterator[T]: The items of the stream.
+        """
+        with self.lock:
+            self.stats["requests"] += 1
+        tried = set()
+        while True:
+            replica = self._acquire(tried)
+            if replica is None:
+                raise self._unavailable()
+            tried.add(replica.url)
+            start = time.perf_counter()
+            started = False
+            # Stays None when the consumer stops reading early: the replica did not fail
+            error: Optional[BaseException] = None
+            try:
+                for item in call(replica.url):
+                    started = True
+                    yield item
+                return
+            except Exception as e:
+                error = e
+                if started or not self.replica_failure(e) or self._acquire_count(tried) == 0:
+                    raise
+                print(f"Parser {replica.url} failed ({type(e).__name__}: {e}), retrying on another replica")
+                with self.lock:
+                    self.stats["failovers"] += 1
+            finally:
+                self._release(replica, time.perf_counter() - start, error)
+
+    def _acquire_count(self, exclude: Set[str]) -> int:
+        with self.lock:
+            now = time.monotonic()
+            return sum(1 for replica in self.replicas if replica.url not in exclude and replica.available(now))
+
+    def check_health(self) -> Dict[str, bool]:
+        """
+        Checks that every replica answers, whatever the status code of its root page. A replica that does not answer is skipped until it does.
+
+        Returns:
+        Dict[str, bool]: Whether every replica is healthy, by URL.
+        """
+        health = {}
+        for replica in self.replicas:
+            parts = urlsplit(replica.url)
+            try:
+                response = self.http.request("GET", f"{parts.scheme}://{parts.netloc}/", timeout=self.health_timeout, retries=False)
+                healthy = response.status < 500
+            except urllib3.exceptions.HTTPError:
+                healthy = False
+            with self.lock:
+                if replica.healthy and not healthy:
+                    print(f"Parser {replica.url} is not answering, skipping it")
+                elif healthy and not replica.healthy:
+                    print(f"Parser {replica.url} is back")
+                replica.healthy = healthy
+            health[replica.url] = healthy
+        return health
+
+    def start_health_checks(self, interval: float = HEALTH_INTERVAL) -> None:
+        """
+        Checks the health of the replicas every interval seconds in a background thread, until close().
+        """
+        if self._health_thread is not None:
+            return
+
+        def run_checks():
+            while not self._health_stop.is_set():
+                self.check_health()
+                self._health_stop.wait(interval)
+
+        self._health_thread = threading.Thread(target=run_checks, name="parser-health", daemon=True)
+        self._health_thread.start()
+
+    def report(self) -> dict:
+        """
+        Returns the state of the pool: the hedged and failed over requests and, per replica, its circuit, load, failures and latencies.
+        """
+        with self.lock:
+            now = time.monotonic()
+            replicas = []
+            for replica in self.replicas:
+                latencies = sorted(replica.latencies)
+                replicas.append({"url": replica.url, "state": self._describe(replica), "in_flight": replica.in_flight, "requests": replica.requests,
+                                 "failures": replica.failures,
+                                 "p50_seconds": round(latencies[len(latencies) // 2], 3) if latencies else None,
+                                 "p95_seconds": round(latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)], 3) if latencies else None})
+            return {**self.stats, "replicas": replicas}
+
+    def close(self) -> None:
+        self._health_stop.set()
+        if self._health_thread is not None:
+            self._health_thread.join()
+            self._health_thread = None
+        self.executor.shutdown(wait=False)
+        if self._owns_http:
+            self.http.clear()
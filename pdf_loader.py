@@ -1,13 +1,36 @@
+import codecs
 import json
 import os.path
-from typing import Optional, List, Union
+import re
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, List, Tuple, Union
 
+import numpy as np
 import pikepdf
+import urllib3
 from langchain_core.documents import Document as LangchainDocument
 from langchain_community.document_loaders.llmsherpa import LLMSherpaFileLoader
 from llmsherpa.readers import LayoutPDFReader, Document as LLMSherpaDocument
 
+import rate_limiter
+from parser_pool import ParserPool, ParserResponseError
+from sketches import hash_values
+from text_vectors import normalize_text
+
 CLEANED_PDF_PREFIX = "cleaned_resources/"
+FLAT_JSON_SOURCE = "./resources/demo/L infinito in un Boccone_cleaned.pdf"
+DEFAULT_SECTION_KEY = "DefaultSection"
+STREAM_CHUNK_SIZE = 1 << 16
+# Seconds to connect to the parser and between two reads of its answer, so a hung parser fails instead of blocking forever
+PARSE_TIMEOUT = urllib3.Timeout(connect=10.0, read=300.0)
+LLMSHERPA_API_URL = "http://localhost:5010/api/parseDocument?renderFormat=all"
+_WHITESPACE_AND_COMMAS = re.compile(r"[\s,]*")
+_DIGITS = re.compile(r"\d+")
+BOILERPLATE_PAGE_FRACTION = 0.5
+BOILERPLATE_MIN_PAGES = 3
+BOILERPLATE_POSITION_QUANTUM = 10.0
+BOILERPLATE_MASKED_WORDS = 4
+# Running headers and footers sit in the top or bottom band of the page, this fraction of its height
+BOILERPLATE_BAND_FRACTION = 0.15
 
 def convert_llmsherpa_dict_to_langchain_doc(document: Union[dict, List], filename: str) -> List[LangchainDocument]:
     """
@@ -26,7 +49,8 @@ def convert_llmsherpa_dict_to_langchain_doc(document: Union[dict, List], filenam
             langchain_doc = LangchainDocument(
                 page_content=json.dumps(item, indent=4, ensure_ascii=False),
                 metadata={
-                    "source": filename
+                    "source": filename,
+                    "section_title": str(item[0])
                 }
             )
             docs.append(langchain_doc)
@@ -36,7 +60,8 @@ def convert_llmsherpa_dict_to_langchain_doc(document: Union[dict, List], filenam
             langchain_doc = LangchainDocument(
                 page_content=json.dumps(item, indent=4, ensure_ascii=False),
                 metadata={
-                    "source": filename
+                    "source": filename,
+                    "section_title": str(next(iter(item), "")) if isinstance(item, dict) else ""
                 }
             )
             docs.append(langchain_doc)
@@ -93,7 +118,7 @@ def remove_duplicates(data, parent_key=None):
 
     return data
 
-def __build_hierarchy_json(data: dict) -> dict:
+def __build_hierarchy_json(data: Iterable[dict]) -> dict:
     """
     Constructs a nested dictionary from a list of JSON objects.
 
@@ -129,7 +154,7 @@ def __build_hierarchy_json(data: dict) -> dict:
                 parent['text'] = '. '.join(sentences)
     return structure
 
-def __build_hierarchy_json_with_titles(data: dict) -> dict:
+def __build_hierarchy_json_with_titles(data: Iterable[dict]) -> dict:
     """
     Constructs a nested dictionary from a list of JSON objects.
 
@@ -174,22 +199,37 @@ def __build_hierarchy_json_with_titles(data: dict) -> dict:
 
     return remove_duplicates(structure)
 
-def build_flat_json(data: LLMSherpaDocument) -> dict:
+def _flat_section(title: str, section_number: int, page_content: str) -> dict:
+    return {
+        "id": None,
+        "metadata": {
+            "source": FLAT_JSON_SOURCE,
+            "section_number": section_number,
+            "section_title": title
+        },
+        "page_content": page_content,
+        "type": "Document"
+    }
+
+def iter_flat_json(blocks: Iterable[dict], exclude_tables: Union[bool, Callable[[dict, List[str]], bool]] = False) -> Iterator[Tuple[str, dict]]:
     """
-    Constructs a flat dictionary from a list of JSON objects.
+    Builds the flat sections of a document one at a time. A section is yielded as soon as the next one starts,
+    so only the section being built is kept in memory when blocks come from iter_llmsherpa_blocks.
 
     Parameters:
-    data (list): A list of dictionaries containing document elements with levels and tags.
+    blocks (Iterable[dict]): The LLM Sherpa blocks, e.g. LLMSherpaDocument.json or iter_llmsherpa_blocks.
+    exclude_tables (Union[bool, Callable[[dict, List[str]], bool]]): Whether to leave tables, and the list items taken as their header, out of the sections,
+    e.g. because they are extracted with table_extraction. A callable receives the table block and the pending list items and decides per table.
 
     Returns:
-    dict: A flat dictionary representing the document content.
+    Iterator[Tuple[str, dict]]: The key and the content of every section, in document order.
     """
-    result = {}
     current_section_key = None
+    current_section = None
     section_number = 0
     pending_list_items = []  # Hold list items until we flush them (or use them as table headers)
 
-    for block in data.json:
+    for block in blocks:
         tag = block.get('tag', '')
         level = block.get('level', 0)
         # Join the sentences using newline characters to preserve any embedded newlines.
@@ -197,120 +237,357 @@ def build_flat_json(data: LLMSherpaDocument) -> dict:
 
         # If this is a header AND its level is 0 or 1, then start a new section.
         if tag == "header" and level <= 1:
-            # Flush any pending list items if they exist.
-            if pending_list_items and current_section_key is not None:
-                list_text = "\n" + "\n".join(["- " + item for item in pending_list_items])
-                result[current_section_key]["page_content"] += "\n\n" + list_text
-                pending_list_items = []
-            # Create a new section.
-            section_key = block_text.replace(" ", "").replace("\\", "").replace("'", "")
-            result[section_key] = {
-                "id": None,
-                "metadata": {
-                    "source": "./resources/demo/L infinito in un Boccone_cleaned.pdf",
-                    "section_number": section_number,
-                    "section_title": block_text
-                },
-                "page_content": block_text,  # start with the header text
-                "type": "Document"
-            }
-            current_section_key = section_key
+            if current_section is not None:
+                # Flush any pending list items if they exist.
+                if pending_list_items:
+                    current_section["page_content"] += "\n\n" + "\n" + "\n".join(["- " + item for item in pending_list_items])
+                    pending_list_items = []
+                yield current_section_key, current_section
+            # Create a new section, starting with the header text.
+            current_section_key = block_text.replace(" ", "").replace("\\", "").replace("'", "")
+            current_section = _flat_section(block_text, section_number, block_text)
             section_number += 1
+            continue
 
-        # If this is a header with level greater than 1, treat it like a paragraph.
-        elif tag == "header" and level > 1:
-            if current_section_key is not None:
-                result[current_section_key]["page_content"] += "\n\n" + block_text
-            else:
-                # If no section has been created yet, create a default section.
-                default_key = "DefaultSection"
-                if default_key not in result:
-                    result[default_key] = {
-                        "id": None,
-                        "metadata": {
-                            "source": "./resources/demo/L infinito in un Boccone_cleaned.pdf",
-                            "section_number": section_number,
-                            "section_title": default_key
-                        },
-                        "page_content": "",
-                        "type": "Document"
-                    }
-                    current_section_key = default_key
-                    section_number += 1
-                result[current_section_key]["page_content"] += "\n\n" + block_text
-
-        elif tag == "list_item":
+        if tag == "list_item":
             # Save list items for later flush or for use as table header.
             pending_list_items.append(block_text)
+            continue
 
-        elif tag == "table":
+        if tag == "table":
+            if exclude_tables is True or (callable(exclude_tables) and exclude_tables(block, pending_list_items)):
+                pending_list_items = []
+                continue
             table_content = ""
             # If there are pending list items, assume these are column headers.
             if pending_list_items:
-                header_line = " | ".join(pending_list_items)
-                table_content += header_line + "\n"
+                table_content += " | ".join(pending_list_items) + "\n"
                 pending_list_items = []
             # Process table rows if present.
-            if "table_rows" in block:
-                for row in block["table_rows"]:
-                    cells = [cell.get("cell_value", "") for cell in row.get("cells", [])]
-                    row_text = " | ".join(cells)
-                    table_content += row_text + "\n"
+            for row in block.get("table_rows", []):
+                cells = [cell.get("cell_value", "") for cell in row.get("cells", [])]
+                table_content += " | ".join(cells) + "\n"
             # If the table block itself contains text, prepend it.
             if block_text:
                 table_content = block_text + "\n" + table_content
-            if current_section_key is not None:
-                result[current_section_key]["page_content"] += "\n\n" + table_content.strip()
-            else:
-                # Optionally create a default section.
-                default_key = "DefaultSection"
-                if default_key not in result:
-                    result[default_key] = {
-                        "id": None,
-                        "metadata": {
-                            "source": "./resources/demo/L infinito in un Boccone_cleaned.pdf",
-                            "section_number": section_number,
-                            "section_title": default_key
-                        },
-                        "page_content": "",
-                        "type": "Document"
-                    }
-                    current_section_key = default_key
-                    section_number += 1
-                result[current_section_key]["page_content"] += "\n\n" + table_content.strip()
+            block_text = table_content.strip()
+        elif tag != "header" and pending_list_items and current_section is not None:
+            # For any other block (like a para), flush pending list items if any. Headers with level greater than 1 are treated like paragraphs.
+            current_section["page_content"] += "\n\n" + "\n" + "\n".join(["- " + item for item in pending_list_items])
+            pending_list_items = []
+
+        if current_section is None:
+            # If no section has been created yet, create a default section.
+            current_section_key = DEFAULT_SECTION_KEY
+            current_section = _flat_section(DEFAULT_SECTION_KEY, section_number, "")
+            section_number += 1
+        current_section["page_content"] += "\n\n" + block_text
 
-        else:
-            # For any other block (like a para), flush pending list items if any.
-            if pending_list_items and current_section_key is not None:
-                list_text = "\n" + "\n".join(["- " + item for item in pending_list_items])
-                result[current_section_key]["page_content"] += "\n\n" + list_text
-                pending_list_items = []
-            if current_section_key is not None:
-                result[current_section_key]["page_content"] += "\n\n" + block_text
-            else:
-                # Create a default section if needed.
-                default_key = "DefaultSection"
-                if default_key not in result:
-                    result[default_key] = {
-                        "id": None,
-                        "metadata": {
-                            "source": "./resources/demo/L infinito in un Boccone_cleaned.pdf",
-                            "section_number": section_number,
-                            "section_title": default_key
-                        },
-                        "page_content": "",
-                        "type": "Document"
-                    }
-                    current_section_key = default_key
-                    section_number += 1
-                result[current_section_key]["page_content"] += "\n\n" + block_text
-
-    # Flush any remaining list items at the end.
-    if pending_list_items and current_section_key is not None:
-        list_text = "\n" + "\n".join(["- " + item for item in pending_list_items])
-        result[current_section_key]["page_content"] += "\n\n" + list_text
-
-    return result
+    if current_section is not None:
+        # Flush any remaining list items at the end.
+        if pending_list_items:
+            current_section["page_content"] += "\n\n" + "\n" + "\n".join(["- " + item for item in pending_list_items])
+        yield current_section_key, current_section
+
+def build_flat_json(data: Union[LLMSherpaDocument, Iterable[dict]], exclude_tables: Union[bool, Callable[[dict, List[str]], bool]] = False) -> dict:
+    """
+    Constructs a flat dictionary from a list of JSON objects.
+
+    Parameters:
+    data (Union[LLMSherpaDocument, Iterable[dict]]): The parsed document, or an iterator of its blocks as returned by iter_llmsherpa_blocks.
+    exclude_tables (Union[bool, Callable[[dict, List[str]], bool]]): Whether to leave tables out, so only free text is sent to the LLM,
+    e.g. table_extraction.TableMapper.handles to leave out only the mapped tables.
+
+    Returns:
+    dict: A flat dictionary representing the document content.
+    """
+    blocks = data.json if isinstance(data, LLMSherpaDocument) else data
+    return dict(iter_flat_json(blocks, exclude_tables))
+
+class BlockTable:
+    """
+    Columnar view of the LLM Sherpa blocks. Numeric fields are NumPy arrays, tags and block classes are categorical codes and
+    sentences live in a single string pool indexed by offsets, so statistics and filters run as vectorized operations instead of
+    reading one dictionary per block.
+    """
+
+    COLUMNS = ("bbox", "block_class", "block_idx", "level", "page_idx", "tag", "sentences")
+
+    def __init__(self, bbox: np.ndarray, level: np.ndarray, page_idx: np.ndarray, block_idx: np.ndarray,
+                 tag_codes: np.ndarray, tags: List[str], class_codes: np.ndarray, block_classes: List[str],
+                 sentence_start: np.ndarray, sentence_end: np.ndarray, sentence_offsets: np.ndarray, text_pool: str,
+                 extras: List[Optional[dict]]):
+        """
+        Initializes the BlockTable class. Use BlockTable.from_blocks to build one from the LLM Sherpa blocks.
+
+        Parameters:
+        bbox (np.ndarray): The (N, 4) float64 array of block bounding boxes.
+        level (np.ndarray): The hierarchy level of every block.
+        page_idx (np.ndarray): The page index of every block.
+        block_idx (np.ndarray): The LLM Sherpa index of every block.
+        tag_codes (np.ndarray): The index in tags of the tag of every block.
+        tags (List[str]): The tag categories.
+        class_codes (np.ndarray): The index in block_classes of the class of every block.
+        block_classes (List[str]): The block class categories.
+        sentence_start (np.ndarray): The first sentence of every block, as an index in sentence_offsets.
+        sentence_end (np.ndarray): The end of the sentences of every block, as an index in sentence_offsets.
+        sentence_offsets (np.ndarray): The character offset of every sentence in text_pool, plus the end of the pool.
+        text_pool (str): All the sentences, concatenated.
+        extras (List[Optional[dict]]): The remaining fields of every block, e.g. table_rows, or None.
+        """
+        self.bbox = bbox
+        self.level = level
+        self.page_idx = page_idx
+        self.block_idx = block_idx
+        self.tag_codes = tag_codes
+        self.tags = tags
+        self.class_codes = class_codes
+        self.block_classes = block_classes
+        self.sentence_start = sentence_start
+        self.sentence_end = sentence_end
+        self.sentence_offsets = sentence_offsets
+        self.text_pool = text_pool
+        self.extras = extras
+
+    @classmethod
+    def from_blocks(cls, blocks: Union[LLMSherpaDocument, Iterable[dict]]) -> "BlockTable":
+        """
+        Builds a block table in a single pass over the blocks.
+
+        Parameters:
+        blocks (Union[LLMSherpaDocument, Iterable[dict]]): The parsed document, its .json list or the iterator returned by iter_llmsherpa_blocks.
+
+        Returns:
+        BlockTable: The block table.
+        """
+        blocks = blocks.json if isinstance(blocks, LLMSherpaDocument) else blocks
+        bbox, level, page_idx, block_idx, tag_codes, class_codes, sentence_counts, extras = [], [], [], [], [], [], [], []
+        tags, block_classes = {}, {}
+        sentences, sentence_lengths = [], []
+        for block in blocks:
+            bbox.append(block.get("bbox") or (0.0, 0.0, 0.0, 0.0))
+            level.append(block.get("level", 0))
+            page_idx.append(block.get("page_idx", 0))
+            block_idx.append(block.get("block_idx", len(block_idx)))
+            tag_codes.append(tags.setdefault(block.get("tag", ""), len(tags)))
+            class_codes.append(block_classes.setdefault(block.get("block_class", ""), len(block_classes)))
+            block_sentences = block.get("sentences", [])
+            sentences.extend(block_sentences)
+            sentence_lengths.extend(len(sentence) for sentence in block_sentences)
+            sentence_counts.append(len(block_sentences))
+            extras.append({key: value for key, value in block.items() if key not in cls.COLUMNS} or None)
+
+        sentence_end = np.cumsum(np.asarray(sentence_counts, dtype=np.int64))
+        return cls(bbox=np.asarray(bbox, dtype=np.float64).reshape(-1, 4),
+                   level=np.asarray(level, dtype=np.int16),
+                   page_idx=np.asarray(page_idx, dtype=np.int32),
+                   block_idx=np.asarray(block_idx, dtype=np.int64),
+                   tag_codes=np.asarray(tag_codes, dtype=np.int16),
+                   tags=list(tags),
+                   class_codes=np.asarray(class_codes, dtype=np.int16),
+                   block_classes=list(block_classes),
+                   sentence_start=sentence_end - np.asarray(sentence_counts, dtype=np.int64),
+                   sentence_end=sentence_end,
+                   sentence_offsets=np.concatenate(([0], np.cumsum(np.asarray(sentence_lengths, dtype=np.int64)))),
+                   text_pool="".join(sentences),
+                   extras=extras)
+
+    def __len__(self) -> int:
+        return len(self.level)
+
+    def __iter__(self) -> Iterator[dict]:
+        """
+        Yields the blocks as LLM Sherpa dictionaries, so the table can be passed to build_flat_json and get_hierarchical_json_representation.
+        """
+        for i in range(len(self)):
+            yield self.block(i)
+
+    def sentences(self, i: int) -> List[str]:
+        offsets = self.sentence_offsets[self.sentence_start[i]:self.sentence_end[i] + 1].tolist()
+        return [self.text_pool[start:end] for start, end in zip(offsets, offsets[1:])]
+
+    def block(self, i: int) -> dict:
+        block = {
+            "bbox": self.bbox[i].tolist(),
+            "block_class": self.block_classes[self.class_codes[i]],
+            "block_idx": int(self.block_idx[i]),
+            "level": int(self.level[i]),
+            "page_idx": int(self.page_idx[i]),
+            "tag": self.tags[self.tag_codes[i]],
+            "sentences": self.sentences(i),
+        }
+        if self.extras[i]:
+            block.update(self.extras[i])
+        return block
+
+    def to_blocks(self) -> List[dict]:
+        """
+        Converts the table back to the LLMSherpaDocument.json list.
+
+        Returns:
+        List[dict]: The blocks.
+        """
+        return list(self)
+
+    def tag_mask(self, tag: str) -> np.ndarray:
+        """
+        Returns the boolean mask of the blocks with the given tag, e.g. "header", "para", "list_item" or "table".
+        """
+        if tag not in self.tags:
+            return np.zeros(len(self), dtype=bool)
+        return self.tag_codes == self.tags.index(tag)
+
+    def text_lengths(self) -> np.ndarray:
+        """
+        Returns the number of characters of the sentences of every block.
+        """
+        return self.sentence_offsets[self.sentence_end] - self.sentence_offsets[self.sentence_start]
+
+    def filter(self, mask: np.ndarray) -> "BlockTable":
+        """
+        Keeps the blocks selected by a boolean mask or an array of indices. The string pool is shared, not copied.
+
+        Parameters:
+        mask (np.ndarray): The blocks to keep.
+
+        Returns:
+        BlockTable: The filtered table.
+        """
+        indices = np.flatnonzero(mask) if np.asarray(mask).dtype == bool else np.asarray(mask, dtype=np.int64)
+        return BlockTable(bbox=self.bbox[indices],
+                          level=self.level[indices],
+                          page_idx=self.page_idx[indices],
+                          block_idx=self.block_idx[indices],
+                          tag_codes=self.tag_codes[indices],
+                          tags=self.tags,
+                          class_codes=self.class_codes[indices],
+                          block_classes=self.block_classes,
+                          sentence_start=self.sentence_start[indices],
+                          sentence_end=self.sentence_end[indices],
+                          sentence_offsets=self.sentence_offsets,
+                          text_pool=self.text_pool,
+                          extras=[self.extras[i] for i in indices])
+
+    def section_boundaries(self, max_level: int = 1) -> np.ndarray:
+        """
+        Returns the index of the first block of every section, i.e. of every header with level up to max_level, as build_flat_json splits sections.
+        A leading section without header starts at 0.
+
+        Parameters:
+        max_level (int): The deepest header level starting a section.
+
+        Returns:
+        np.ndarray: The sorted start indices.
+        """
+        starts = np.flatnonzero(self.tag_mask("header") & (self.level <= max_level))
+        if len(self) and (len(starts) == 0 or starts[0] != 0):
+            starts = np.concatenate(([0], starts))
+        return starts
+
+    def section_page_ranges(self, max_level: int = 1) -> np.ndarray:
+        """
+        Returns the first and last page of every section.
+
+        Parameters:
+        max_level (int): The deepest header level starting a section.
+
+        Returns:
+        np.ndarray: A (sections, 2) array of page indices.
+        """
+        starts = self.section_boundaries(max_level)
+        if len(starts) == 0:
+            return np.empty((0, 2), dtype=np.int32)
+        return np.stack([np.minimum.reduceat(self.page_idx, starts), np.maximum.reduceat(self.page_idx, starts)], axis=1)
+
+    def level_counts(self, tag: Optional[str] = None) -> Dict[int, int]:
+        """
+        Counts the blocks of every hierarchy level.
+
+        Parameters:
+        tag (str): Only count the blocks with this tag. Default is all blocks.
+
+        Returns:
+        Dict[int, int]: The number of blocks per level.
+        """
+        levels = self.level if tag is None else self.level[self.tag_mask(tag)]
+        values, counts = np.unique(levels, return_counts=True)
+        return dict(zip(values.tolist(), counts.tolist()))
+
+    def page_range(self) -> Tuple[int, int]:
+        """
+        Returns the first and last page index of the blocks, or (-1, -1) for an empty table.
+        """
+        if len(self) == 0:
+            return -1, -1
+        return int(self.page_idx.min()), int(self.page_idx.max())
+
+def _boilerplate_text(text: str) -> str:
+    # Page numbers change from page to page, so digits are masked in short blocks such as "Pagina 3 di 10".
+    # Longer blocks are compared verbatim, so dishes differing only by price or quantity are never merged.
+    normalized = normalize_text(text)
+    if len(normalized.split()) <= BOILERPLATE_MASKED_WORDS:
+        return _DIGITS.sub("#", normalized)
+    return normalized
+
+def remove_repeated_blocks(table: BlockTable, min_page_fraction: float = BOILERPLATE_PAGE_FRACTION, min_pages: int = BOILERPLATE_MIN_PAGES,
+                           position_quantum: float = BOILERPLATE_POSITION_QUANTUM, keep_section_headers: bool = True,
+                           band_fraction: float = BOILERPLATE_BAND_FRACTION) -> Tuple[BlockTable, dict]:
+    """
+    Removes running headers, footers, page numbers and boilerplate, i.e. blocks whose normalized text recurs at the same position on many pages.
+    Blocks are grouped by text hash and quantized bounding box with NumPy; a group is dropped when it spans at least min_page_fraction of the pages.
+    A recurring header with content below it on its page is a heading of the content, e.g. "Ingredienti" above every recipe, so it is only dropped
+    in the top or bottom band of the page, where running headers and footers sit.
+
+    Parameters:
+    table (BlockTable): The blocks of a document.
+    min_page_fraction (float): The fraction of the pages a block must recur on to be removed.
+    min_pages (int): The minimum number of pages a block must recur on to be removed, so short documents are left untouched.
+    position_quantum (float): The size, in points, of the grid the bounding boxes are snapped to.
+    keep_section_headers (bool): Whether to keep headers with level 0 or 1 even when they recur, since build_flat_json starts a section on them.
+    band_fraction (float): The fraction of the page height, at the top and at the bottom, where recurring headers are treated as running headers and footers.
+
+    Returns:
+    Tuple[BlockTable, dict]: The filtered blocks and a report with the number of blocks and estimated tokens removed, and one example text per removed pattern.
+    """
+    first_page, last_page = table.page_range()
+    pages = last_page - first_page + 1
+    report = {"pages": max(pages, 0), "blocks": len(table), "blocks_removed": 0, "tokens_removed": 0, "removed_texts": []}
+    if len(table) == 0:
+        return table, report
+
+    texts = ["\n".join(table.sentences(i)) for i in range(len(table))]
+    text_hashes = hash_values(_boilerplate_text(text) for text in texts).view(np.int64)
+    # The right edge moves with the text length (e.g. "Page 9" and "Page 10"), so only the left edge and the vertical extent are compared
+    positions = np.floor(table.bbox[:, [0, 1, 3]] / position_quantum).astype(np.int64)
+    keys = np.column_stack([text_hashes, positions])
+    _, groups = np.unique(keys, axis=0, return_inverse=True)
+    groups = groups.reshape(-1)
+
+    # Count every group once per page
+    group_pages = np.unique(np.column_stack([groups, table.page_idx]), axis=0)[:, 0]
+    pages_per_group = np.bincount(group_pages, minlength=groups.max() + 1)
+    repeated = pages_per_group[groups] >= max(min_pages, min_page_fraction * pages)
+    repeated &= table.text_lengths() > 0
+    # The page extent is taken from the blocks of the whole document, since the parser does not report the page size
+    top, bottom = table.bbox[:, 1].min(), table.bbox[:, 3].max()
+    band = band_fraction * (bottom - top)
+    in_band = (table.bbox[:, 1] <= top + band) | (table.bbox[:, 3] >= bottom - band)
+    headers = table.tag_mask("header")
+    content_below = np.zeros(len(table), dtype=bool)
+    content_below[:-1] = (table.page_idx[1:] == table.page_idx[:-1]) & ~headers[1:]
+    repeated &= in_band | ~(headers & content_below)
+    if keep_section_headers:
+        repeated &= ~(headers & (table.level <= 1))
+
+    removed = np.flatnonzero(repeated)
+    report["blocks_removed"] = len(removed)
+    if len(removed):
+        report["tokens_removed"] = rate_limiter.estimate_tokens("\n".join(texts[i] for i in removed))
+        patterns = {}
+        for i in removed:
+            patterns.setdefault(_boilerplate_text(texts[i]), texts[i])
+        report["removed_texts"] = list(patterns.values())
+    return table.filter(~repeated), report
 
 def clean_non_utf8_characters(text):
     """Remove non-UTF-8 characters."""
@@ -349,12 +626,12 @@ def sanitize_pdf(file: str, prefix: Optional[str] = CLEANED_PDF_PREFIX) -> str:
         pdf.save(cleaned_file)
     return cleaned_file
 
-def get_hierarchical_json_representation(data:dict, include_titles: bool = False) -> dict:
+def get_hierarchical_json_representation(data: Iterable[dict], include_titles: bool = False) -> dict:
     """
     Get a hierarchical JSON representation of the document content.
 
     Parameters:
-    data (dict): The document content.
+    data (Iterable[dict]): The document blocks, either the LLMSherpaDocument.json list or the iterator returned by iter_llmsherpa_blocks.
     include_titles (bool): Whether to include titles in the JSON representation. Default is False.
 
     Returns:
@@ -379,39 +656,150 @@ def build_llmsherpa_api_url(llmsherpa_api_url: str, apply_ocr: Optional[bool] =
     new_indent_parser = "&useNewIndentParser=yes" if new_indent_parser else ""
     return f"{llmsherpa_api_url}{apply_ocr}{new_indent_parser}"
 
+def iter_json_array(chunks: Iterable[str], key: str) -> Iterator[Any]:
+    """
+    Incrementally parses the items of the first JSON array stored under a key, e.g. "blocks", from a stream of text chunks.
+    Only the item being decoded is buffered, never the whole document.
+
+    Parameters:
+    chunks (Iterable[str]): The chunks of the JSON text.
+    key (str): The key of the array.
+
+    Returns:
+    Iterator[Any]: The decoded items of the array.
+    """
+    decoder = json.JSONDecoder()
+    array_start = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+    chunks = iter(chunks)
+    buffer = ""
+    # Skip everything up to the opening bracket of the array
+    while (match := array_start.search(buffer)) is None:
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError(f'No "{key}" array found in the response.')
+        # Keep a tail long enough to match a key split across chunks
+        buffer = buffer[-(len(key) + 64):] + chunk
+    buffer = buffer[match.end():]
+    while True:
+        position = _WHITESPACE_AND_COMMAS.match(buffer).end()
+        if buffer.startswith("]", position):
+            return
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The item is incomplete, read more of the stream
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError(f'The "{key}" array is truncated.')
+            buffer += chunk
+            continue
+        yield item
+        buffer = buffer[position:]
+
+def iter_llmsherpa_blocks(file: str, llmsherpa_api_url: str, http: Optional[urllib3.PoolManager] = None, chunk_size: int = STREAM_CHUNK_SIZE,
+                          timeout: urllib3.Timeout = PARSE_TIMEOUT) -> Iterator[dict]:
+    """
+    Sends a PDF file to the LLM Sherpa parseDocument API and yields its blocks while the response is being received.
+    The blocks are the same dictionaries as LLMSherpaDocument.json, but the full response, the document tree and the block list are never held in memory.
+
+    Parameters:
+    file (str): The path to the PDF file.
+    llmsherpa_api_url (str): The API URL for the LLM Sherpa service.
+    http (urllib3.PoolManager): The connection pool to use. Default is a new pool.
+    chunk_size (int): The number of bytes read from the response at a time.
+    timeout (urllib3.Timeout): The timeout of the request. Default is PARSE_TIMEOUT.
+
+    Returns:
+    Iterator[dict]: The blocks of the document, in document order.
+    """
+    http = http or urllib3.PoolManager()
+    with open(file, "rb") as f:
+        pdf_file = (os.path.basename(file), f.read(), "application/pdf")
+    response = http.request("POST", llmsherpa_api_url, fields={"file": pdf_file}, preload_content=False, timeout=timeout)
+    completed = False
+    try:
+        if response.status > 200:
+            raise ParserResponseError(f"LLM Sherpa failed to parse {file}: {response.read().decode('utf-8', 'ignore')}", response.status)
+        utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+        yield from iter_json_array((utf8_decoder.decode(chunk) for chunk in response.stream(chunk_size)), "blocks")
+        completed = True
+    finally:
+        # A connection returned to the pool with an unread body would hand the rest of this response to the next request,
+        # so an abandoned or failed stream is closed instead; the few bytes after the blocks array are drained
+        if completed:
+            response.drain_conn()
+        else:
+            response.close()
+        response.release_conn()
+
+def read_llmsherpa_document(file: str, llmsherpa_api_url: str, http: Optional[urllib3.PoolManager] = None, timeout: urllib3.Timeout = PARSE_TIMEOUT) -> LLMSherpaDocument:
+    """
+    Sends a PDF file to the LLM Sherpa parseDocument API and returns the parsed document, like LayoutPDFReader.read_pdf, on a given connection pool.
+
+    Parameters:
+    file (str): The path to the PDF file.
+    llmsherpa_api_url (str): The API URL for the LLM Sherpa service.
+    http (urllib3.PoolManager): The connection pool to use. Default is a new pool.
+    timeout (urllib3.Timeout): The timeout of the request. Default is PARSE_TIMEOUT.
+
+    Returns:
+    LLMSherpaDocument: The parsed document.
+    """
+    http = http or urllib3.PoolManager()
+    with open(file, "rb") as f:
+        pdf_file = (os.path.basename(file), f.read(), "application/pdf")
+    response = http.request("POST", llmsherpa_api_url, fields={"file": pdf_file}, timeout=timeout)
+    if response.status > 200:
+        raise ParserResponseError(f"LLM Sherpa failed to parse {file}: {response.data.decode('utf-8', 'ignore')}", response.status)
+    return LLMSherpaDocument(json.loads(response.data.decode("utf-8"))["return_dict"]["result"]["blocks"])
+
 class PdfLoader:
 
     def __init__(self, files: List[str],
-                 llmsherpa_api_url: Optional[str] = "http://localhost:5010/api/parseDocument?renderFormat=all",
+                 llmsherpa_api_url: Optional[str] = LLMSHERPA_API_URL,
                  apply_ocr: Optional[bool] = False,
                  new_indent_parser: Optional[bool] = False,
                  strategy: Optional[str] = "sections",
-                 provider: Optional[str] = "llmsherpa"):
+                 provider: Optional[str] = "llmsherpa",
+                 stream: Optional[bool] = False,
+                 reader: Optional[LayoutPDFReader] = None,
+                 http: Optional[urllib3.PoolManager] = None,
+                 pool: Optional[ParserPool] = None):
         """
             Initializes the PdfLoader class.
 
             Parameters:
             files (List[str]): A list of PDF files to load.
-            llmsherpa_api_url (str): The API URL for the LLM Sherpa service.
+            llmsherpa_api_url (str): The API URL for the LLM Sherpa service. Ignored when a pool is given.
             apply_ocr (bool): Whether to apply OCR to the PDF files. Default is False.
             new_indent_parser (bool): Whether to use the new indent parser. Default is False.
             strategy (str): The strategy for splitting the PDF files. Options include "chunks" and "pages".
             provider (str): The provider of the PDF files. Default is "llmsherpa". Possible values are "llmsherpa" and "langchain".
+            stream (bool): Whether the "llmsherpa" provider returns an iterator of blocks parsed while the response is received, instead of an LLMSherpaDocument. Default is False.
+            reader (LayoutPDFReader): The reader to reuse, e.g. one kept warm by a long-lived process. Default is a new reader.
+            http (urllib3.PoolManager): The connection pool of the streaming parser to reuse. Default is a new pool.
+            pool (ParserPool): The parser replicas to spread the requests over. The pool is meant to be shared by the loaders of a process,
+            its circuit breakers and latencies only take effect across documents, and it is closed by its owner.
         """
         self.files = files
+        self.http = http or urllib3.PoolManager()
+        self.pool = pool
+        if pool is not None:
+            llmsherpa_api_url = pool.urls[0]
         self.llmsherpa_api_url = build_llmsherpa_api_url(llmsherpa_api_url, apply_ocr, new_indent_parser)
         self.apply_ocr = apply_ocr
         self.new_indent_parser = new_indent_parser
         self.strategy = strategy
-        self.sherpaReader = LayoutPDFReader(llmsherpa_api_url)
+        self.sherpaReader = reader or LayoutPDFReader(llmsherpa_api_url)
         self.provider = provider
+        self.stream = stream
 
-    def load_pdf_documents(self) -> Union[LLMSherpaDocument, List[LangchainDocument]]:
+    def load_pdf_documents(self) -> Union[LLMSherpaDocument, Iterator[dict], List[LangchainDocument]]:
         """
             Loads and splits PDF documents into smaller chunks.
 
             Returns:
-            List[Document]: A list of Document objects containing the split content of the PDF files.
+            List[Document]: A list of Document objects containing the split content of the PDF files. With stream=True, an iterator of the LLM Sherpa blocks.
         """
         docs = []
         if not self.files:
@@ -421,16 +809,25 @@ class PdfLoader:
                 raise ValueError(f'{file} is not a PDF file')
             match self.provider:
                 case "langchain":
-                    pdf_reader = LLMSherpaFileLoader(file_path=file,
-                                                     new_indent_parser=self.new_indent_parser,
-                                                     apply_ocr=self.apply_ocr,
-                                                     strategy=self.strategy,
-                                                     llmsherpa_api_url=self.llmsherpa_api_url,
-                                                     )
-                    docs.extend(pdf_reader.load())
+                    load = lambda url: LLMSherpaFileLoader(file_path=file,
+                                                           new_indent_parser=self.new_indent_parser,
+                                                           apply_ocr=self.apply_ocr,
+                                                           strategy=self.strategy,
+                                                           llmsherpa_api_url=url,
+                                                           ).load()
+                    docs.extend(self.pool.call(lambda url: load(self._replica_url(url))) if self.pool is not None else load(self.llmsherpa_api_url))
                     return docs
+                case "llmsherpa" if self.stream and self.pool is not None:
+                    return self.pool.stream(lambda url: iter_llmsherpa_blocks(file, self._replica_url(url), self.http))
+                case "llmsherpa" if self.stream:
+                    return iter_llmsherpa_blocks(file, self.llmsherpa_api_url, self.http)
+                case "llmsherpa" if self.pool is not None:
+                    return self.pool.call(lambda url: read_llmsherpa_document(file, self._replica_url(url), self.http))
                 case "llmsherpa":
                     pdf_reader = self.sherpaReader
                     return pdf_reader.read_pdf(file)
                 case _:
-                    raise ValueError(f"Unsupported provider: {self.provider}")
\ No newline at end of file
+                    raise ValueError(f"Unsupported provider: {self.provider}")
+
+    def _replica_url(self, url: str) -> str:
+        return build_llmsherpa_api_url(url, self.apply_ocr, self.new_indent_parser)
@@ -0,0 +1,203 @@
+import asyncio
+import random
+import time
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple, Type, TypeVar
+
+import tiktoken
+
+DEFAULT_ENCODING = "cl100k_base"
+# System prompt and schema description sent by LLMGraphTransformer with every document
+PROMPT_OVERHEAD_TOKENS = 1000
+COMPLETION_TOKENS_ESTIMATE = 500
+
+T = TypeVar("T")
+R = TypeVar("R")
+# The retry of the call being made (0 for the first attempt), set by the retry loops and read by llm_ledger.LLMLedger
+current_attempt: ContextVar[int] = ContextVar("current_attempt", default=0)
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: Optional[str]) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding(DEFAULT_ENCODING)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def estimate_tokens(text: str, model: Optional[str] = None) -> int:
+    """
+    Estimates the number of tokens of a text with tiktoken.
+
+    Parameters:
+    text (str): The text.
+    model (str): The model name, used to pick the encoding. Default is cl100k_base.
+
+    Returns:
+    int: The number of tokens.
+    """
+    return len(_encoding(model).encode(text, disallowed_special=()))
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """
+    Tells whether an exception raised by an LLM client is a rate-limit (HTTP 429) error.
+    """
+    if getattr(error, "status_code", None) == 429 or getattr(getattr(error, "response", None), "status_code", None) == 429:
+        return True
+    message = f"{type(error).__name__} {error}".lower()
+    return "ratelimit" in message or "rate limit" in message or "429" in message
+
+
+class TokenBucket:
+
+    def __init__(self, per_minute: float):
+        """
+        Initializes the TokenBucket class.
+
+        Parameters:
+        per_minute (float): The refill rate, which is also the bucket capacity.
+        """
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = per_minute
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, per_minute: float) -> None:
+        """
+        Changes the refill rate and the capacity. On a decrease the stored tokens shrink by the same factor, and never exceed the new capacity,
+        so a rate limit is not followed by a burst of what was saved at the old rate.
+        """
+        self._refill()
+        if per_minute < self.capacity:
+            self.available *= per_minute / self.capacity
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = min(self.available, per_minute)
+
+    async def acquire(self, amount: float) -> None:
+        """
+        Waits until the given amount can be taken from the bucket. Waiters are served in arrival order.
+        """
+        async with self.lock:
+            while True:
+                self._refill()
+                needed = min(amount, self.capacity)
+                if self.available >= needed:
+                    self.available -= needed
+                    return
+                await asyncio.sleep((needed - self.available) / self.rate)
+
+
+class AdaptiveRateLimiter:
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, target_fraction: float = 0.95, min_fraction: float = 0.1,
+                 increase_step: float = 0.02, decrease_factor: float = 0.5, max_concurrency: int = 32, cooldown_seconds: float = 5.0):
+        """
+        Initializes the AdaptiveRateLimiter class. Requests and tokens are limited with two token buckets whose rate follows
+        an AIMD policy: it grows by increase_step after every success and is multiplied by decrease_factor on rate-limit errors.
+
+        Parameters:
+        requests_per_minute (float): The account request limit.
+        tokens_per_minute (float): The account token limit.
+        target_fraction (float): The fraction of the account limits the limiter converges to.
+        min_fraction (float): The lowest fraction the limiter can back off to.
+        increase_step (float): The additive increase of the fraction after each success.
+        decrease_factor (float): The multiplicative decrease of the fraction on a rate-limit error.
+        max_concurrency (int): The maximum number of requests in flight.
+        cooldown_seconds (float): Rate-limit errors within this window after a decrease count as the same event.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.target_fraction = target_fraction
+        self.min_fraction = min_fraction
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.cooldown_seconds = cooldown_seconds
+        self.fraction = target_fraction
+        self.last_decrease = 0.0
+        self.requests = TokenBucket(requests_per_minute * target_fraction)
+        self.tokens = TokenBucket(tokens_per_minute * target_fraction)
+        self.concurrency = asyncio.Semaphore(max_concurrency)
+
+    def _apply(self) -> None:
+        self.requests.set_rate(self.requests_per_minute * self.fraction)
+        self.tokens.set_rate(self.tokens_per_minute * self.fraction)
+
+    async def acquire(self, tokens: int) -> None:
+        await self.requests.acquire(1)
+        await self.tokens.acquire(tokens)
+
+    def on_success(self) -> None:
+        if self.fraction < self.target_fraction:
+            self.fraction = min(self.target_fraction, self.fraction + self.increase_step)
+            self._apply()
+
+    def on_rate_limit(self) -> None:
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown_seconds:
+            return
+        self.last_decrease = now
+        self.fraction = max(self.min_fraction, self.fraction * self.decrease_factor)
+        self._apply()
+        print(f"Rate limited, throttling to {self.fraction:.0%} of the account limits")
+
+
+async def map_with_rate_limit(items: List[T],
+                              process: Callable[[T], Awaitable[R]],
+                              cost: Callable[[T], int],
+                              limiter: AdaptiveRateLimiter,
+                              max_retries: int = 5,
+                              base_delay: float = 1.0,
+                              fatal_errors: Tuple[Type[BaseException], ...] = ()) -> AsyncIterator[Tuple[int, Optional[R], Optional[BaseException]]]:
+    """
+    Processes items concurrently under a rate limiter and yields results as they complete.
+    Every item is retried on its own, with exponential backoff and jitter, so one failure never loses a whole batch.
+
+    Parameters:
+    items (List[T]): The items to process.
+    process (Callable[[T], Awaitable[R]]): The coroutine function processing one item.
+    cost (Callable[[T], int]): The estimated number of tokens consumed by one item.
+    limiter (AdaptiveRateLimiter): The rate limiter.
+    max_retries (int): The number of retries per item.
+    base_delay (float): The first backoff delay, in seconds.
+    fatal_errors (Tuple[Type[BaseException], ...]): Errors that are reported at once, without retrying the item.
+
+    Returns:
+    AsyncIterator[Tuple[int, Optional[R], Optional[BaseException]]]: The index of each item with its result, or with the last error once retries are exhausted.
+    """
+    async def run(index: int, item: T) -> Tuple[int, Optional[R], Optional[BaseException]]:
+        error = None
+        for attempt in range(max_retries + 1):
+            await limiter.acquire(cost(item))
+            current_attempt.set(attempt)
+            try:
+                async with limiter.concurrency:
+                    result = await process(item)
+                limiter.on_success()
+                return index, result, None
+            except fatal_errors as e:
+                return index, None, e
+            except Exception as e:
+                error = e
+                if is_rate_limit_error(e):
+                    limiter.on_rate_limit()
+                # No backoff once the retries are exhausted, the error is reported at once
+                if attempt < max_retries:
+                    await asyncio.sleep(base_delay * (2 ** attempt) * (0.5 + random.random()))
+        return index, None, error
+
+    tasks = [asyncio.create_task(run(index, item)) for index, item in enumerate(items)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -35,17 +35,24 @@ llmsherpa_api_url = "http://localhost:5010/api/parseDocument?renderFormat=all"
 
 import json
 
+from artifact_io import ArtifactWriter, artifact_paths, iter_artifact
 
-def transform_to_hierarchical_json(input_file_, output_file_):
-    with open(input_file_, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+
+def transform_to_hierarchical_json(input_file_, output_dir_):
+    # I blocchi salvati come artefatto (un blocco per riga) vengono letti uno alla volta
+    if artifact_paths(input_file_):
+        data = iter_artifact(input_file_)
+    else:
+        with open(input_file_, 'r', encoding='utf-8') as f:
+            data = json.load(f)
 
     hierarchical_data = get_hierarchical_json_representation(data, include_titles=False)
 
-    with open(output_file_, 'w', encoding='utf-8') as f:
-        json.dump(hierarchical_data, f, ensure_ascii=False, indent=4)
+    with ArtifactWriter(output_dir_, "hierarchies") as writer:
+        writer.write({"file": input_file_, "hierarchy": hierarchical_data})
+    return writer.parts
 
 # Example usage
 input_file = 'output/output_sherpa.json'
-output_file = 'output/hierarchical_prova_pdf.json'
-transform_to_hierarchical_json(input_file, output_file)
\ No newline at end of file
+output_dir = 'output/hierarchies'
+transform_to_hierarchical_json(input_file, output_dir)
@@ -1,6 +1,8 @@
 import asyncio
+import glob
 import json
 import os
+import time
 from typing import List
 
 from dotenv import load_dotenv
@@ -10,7 +12,15 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 
-from pdf_loader import PdfLoader, build_flat_json
+from artifact_io import ArtifactWriter
+from batch_extraction import BatchExtractor
+from gazetteer import Gazetteer, build_gazetteer
+from llm_ledger import BudgetExceededError, LedgerStore, LLMLedger
+from model_router import ModelRouter
+from pdf_loader import BlockTable, PdfLoader, build_flat_json, remove_repeated_blocks
+from section_dedup import SectionDedupIndex, apply_json_delta, json_delta
+from table_extraction import TableMapper, load_table_mapping
+from text_vectors import normalize_text
 
 load_dotenv()
 llm= ChatOpenAI(model="gpt-4o", temperature=0)
@@ -46,13 +56,71 @@ class EntityContainer(BaseModel):
     Planet: str = Field(..., description="The name of the planet")
 
 chain = prompt | llm.with_structured_output(EntityContainer)
+fallback_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+fallback_chain = prompt | fallback_llm.with_structured_output(EntityContainer)
 metadata=[]
 entities_list=["Restaurant", "Chef", "Dish", "Ingredient", "Technique", "License", "Planet"]
+# Sezioni già estratte in esecuzioni precedenti, riusate per le sezioni quasi identiche di altri menu.
+# L'indice viene aperto al primo uso, non all'import del modulo
+dedup_index_path = "output/section_dedup.sqlite"
+dedup_index = None
+# Ledger, gazetteer, writer, tabelle, router ed estrattori leggono e creano file in output/, quindi vengono creati da open_outputs
+# all'avvio di main, non all'import del modulo
+ledger_path = "output/llm_ledger.sqlite"
+ledger = None
+gazetteer_path = "output/gazetteer.json"
+gazetteer = None
+section_writer = None
+entity_writer = None
+table_mapper = None
+router = None
+batch_extractor = None
+cheap_batch_extractor = None
+# Più sezioni brevi, anche di menu diversi, in un'unica richiesta con un risultato per sezione
+batch_instructions = ("You are a top tier NER algorithm capable of extracting entities from a document. These are the named entities you can extract:\n"
+                      f"<entities>\n{entities_list}\n</entities>.\n"
+                      "Pay particular attention to not confuse entities. For example, ingredients only refer to food used to make dishes! "
+                      "Do not try to infer entities that are not expressly mentioned in the text. "
+                      "If a entity is not present in the text, just don't include it in the output, leaving strings and lists empty.")
 
 
+def menu_looks_incomplete(result, features, already_extracted_entities=None):
+    before = already_extracted_entities.model_dump() if already_extracted_entities is not None else None
+    delta = json_delta(before, result.model_dump())
+    # Piatti senza ingredienti o tecniche vengono scartati da merge_restaurant_objects, quindi vanno estratti di nuovo.
+    # Contano solo i piatti nuovi o modificati da questa sezione, non quelli incompleti delle sezioni precedenti
+    if any(not dish.get("Ingredients") or not dish.get("Techniques") for dish in (delta or {}).get("Dishes", [])):
+        return True
+    # Nomi sconosciuti nel testo ma nessuna entità nuova nel risultato
+    return features["unexplained"] > 0 and delta is None
 
-def extract_entities(document, already_extracted_entities):
-    results = chain.invoke({'document': document['page_content'], 'entities': entities_list, 'already_extracted_entities': already_extracted_entities.model_dump_json()})
+
+def open_outputs():
+    global ledger, gazetteer, section_writer, entity_writer, table_mapper, router, batch_extractor, cheap_batch_extractor
+    # Ogni chiamata al LLM viene registrata; oltre il budget per menu si passa al modello più economico
+    ledger = LLMLedger(LedgerStore(ledger_path), max_document_tokens=50_000, budget_action="degrade", fallback_llm=fallback_llm)
+    # Entità già note dalle estrazioni precedenti: le sezioni che contengono solo entità note non vengono inviate al LLM
+    gazetteer = Gazetteer.load(gazetteer_path) if os.path.exists(gazetteer_path) else build_gazetteer(sorted(glob.glob("output/metadata_*.json") + glob.glob("output/entities/*.jsonl")))
+    # Sezioni ed entità estratte vengono scritte in JSON Lines, un record per riga, leggibili con artifact_io.iter_artifact
+    section_writer = ArtifactWriter("output/sections", "sections")
+    entity_writer = ArtifactWriter("output/entities", "entities")
+    # Le tabelle dei menu con le colonne previste diventano piatti senza passare dal LLM
+    table_mapper = TableMapper(load_table_mapping(os.path.join(os.path.dirname(os.path.abspath(__file__)), "menu_table_mapping.json")))
+    # Le sezioni brevi e già note vanno al modello economico, le altre (o quelle con un risultato incompleto) al modello più forte
+    router = ModelRouter(fallback_chain, chain, gazetteer=gazetteer, is_incomplete=menu_looks_incomplete, fatal_errors=(BudgetExceededError,),
+                         model_name="gpt-4o", log=ArtifactWriter("output/routing", "routing"))
+    batch_extractor = BatchExtractor(llm, EntityContainer, batch_instructions, ledger=ledger)
+    cheap_batch_extractor = BatchExtractor(fallback_llm, EntityContainer, batch_instructions, ledger=ledger)
+
+
+
+def extract_entities(document, already_extracted_entities, source=None, section=None):
+    inputs = {'document': document['page_content'], 'entities': entities_list, 'already_extracted_entities': already_extracted_entities.model_dump_json()}
+    config = ledger.config("extraction", source, section)
+    # Oltre il budget del menu si usa solo il modello economico, senza escalation
+    allow_strong = ledger.select_llm(llm, source) is llm
+    results = router.run(document['page_content'], lambda selected_chain: selected_chain.invoke(inputs, config=config), allow_strong=allow_strong,
+                         is_incomplete=lambda result, features: menu_looks_incomplete(result, features, already_extracted_entities))
     return results
 
 
@@ -137,35 +205,174 @@ def merge_restaurant_objects(objs: list[EntityContainer]) -> dict:
 
     return final_obj
 
-async def handle_file(path):
+def merge_menu_delta(extracted_entities, delta):
+    # Come apply_json_delta, ma i piatti vengono uniti per nome normalizzato come in merge_restaurant_objects:
+    # lo stesso piatto estratto da due sezioni con campi diversi resta un solo piatto
+    delta = delta or {}
+    merged = apply_json_delta(extracted_entities, {key: value for key, value in delta.items() if key != "Dishes"} or None)
+    dishes = {normalize_text(dish.get("Name", "")): dish for dish in merged.get("Dishes", [])}
+    for dish in delta.get("Dishes", []):
+        existing = dishes.get(normalize_text(dish.get("Name", "")))
+        if existing is None:
+            existing = dishes[normalize_text(dish.get("Name", ""))] = {"Name": dish.get("Name", ""), "Ingredients": [], "Techniques": []}
+            merged.setdefault("Dishes", []).append(existing)
+        for field in ("Ingredients", "Techniques"):
+            for value in dish.get(field, []):
+                if value not in existing.setdefault(field, []):
+                    existing[field].append(value)
+    return merged
+
+def section_dedup_index():
+    global dedup_index
+    if dedup_index is None:
+        os.makedirs(os.path.dirname(dedup_index_path), exist_ok=True)
+        dedup_index = SectionDedupIndex(dedup_index_path)
+    return dedup_index
+
+def reusable_match(match):
+    # Le entità della sezione simile possono venire da frasi tolte o cambiate in questa sezione: in quel caso si estrae di nuovo tutto
+    if match is not None and match["removed_sentences"]:
+        return None
+    return match
+
+def load_sections(path):
     loader = PdfLoader([path], provider='llmsherpa')
     sherpa_doc = loader.load_pdf_documents()
+    # Intestazioni, piè di pagina e numeri di pagina ripetuti non vengono inviati al LLM
+    blocks, report = remove_repeated_blocks(BlockTable.from_blocks(sherpa_doc))
+    print(f"Removed {report['blocks_removed']} repeated blocks ({report['tokens_removed']} tokens) from {path}")
+
+    # Solo il testo libero e le tabelle non mappate vengono inviati al LLM
+    tables = table_mapper.extract(blocks)
+    print(f"Tables of {path}: {table_mapper.stats}")
+    docs = build_flat_json(blocks, table_mapper.handles)
+    section_writer.write_many({"file": path, "key": key, **doc} for key, doc in docs.items())
+    return docs, tables["container"]
+
+def save_extracted_entities(path, extracted_entities):
+    entity_writer.write({"file": path, **extracted_entities})
 
-    docs = build_flat_json(sherpa_doc)
-    path_base_name = os.path.basename(path).split(".")[0]
-    with open(f'output/flat_{path_base_name}.json', 'w', encoding='utf-8') as f:
-        json.dump(docs, f, ensure_ascii=False, indent=4)
+async def handle_file(path):
+    docs, table_entities = load_sections(path)
     extracted_entities = EntityContainer(Restaurant="", Chef=Chef(Name="", Licenses=[]), Dishes=[], Planet="")
-    for doc in docs.values():
-        extracted_entities = extract_entities(doc, extracted_entities)
-    with open(f'output/metadata_{path_base_name}.json', 'a+', encoding='utf-8') as f:
-        json.dump(extracted_entities.model_dump(), f, ensure_ascii=False, indent=4)
-        f.write("\n")
+    extracted_entities = EntityContainer.model_validate(apply_json_delta(extracted_entities.model_dump(), table_entities))
+    for section, doc in docs.items():
+        before = extracted_entities.model_dump()
+        match = reusable_match(section_dedup_index().lookup(doc['page_content']))
+        if match is None:
+            known_entities = gazetteer.extract(doc['page_content'], before)
+            if known_entities is not None:
+                extracted_entities = EntityContainer.model_validate(known_entities)
+            else:
+                extracted_entities = extract_entities(doc, extracted_entities, path, section)
+                gazetteer.learn(doc['page_content'], json_delta(before, extracted_entities.model_dump()) or {})
+            delta = json_delta(before, extracted_entities.model_dump())
+        else:
+            # Replay what the matching section added, then extract only the sentences it did not contain
+            extracted_entities = EntityContainer.model_validate(apply_json_delta(before, match["result"]))
+            if match["new_sentences"]:
+                extracted_entities = extract_entities({'page_content': "\n".join(match["new_sentences"])}, extracted_entities, path, section)
+            delta = apply_json_delta(match["result"], json_delta(before, extracted_entities.model_dump()))
+        section_dedup_index().add(doc['page_content'], path, delta)
+    gazetteer.save(gazetteer_path)
+    print(f"Gazetteer: {gazetteer.stats['skipped']} of {gazetteer.stats['sections']} sections extracted without the LLM")
+    print(router.report())
+    save_extracted_entities(path, extracted_entities.model_dump())
 
     # final_obj = merge_restaurant_objects(metadata)
 
     # with open('output/merged_prova_pdf.json', 'a+', encoding='utf-8') as f:
     #     json.dump(final_obj, f, ensure_ascii=False, indent=4)
 
-async def main():
+async def handle_files_batched(paths):
+    empty_entities = EntityContainer(Restaurant="", Chef=Chef(Name="", Licenses=[]), Dishes=[], Planet="").model_dump()
+    documents, table_entities = {}, {}
+    for path in paths:
+        documents[path], table_entities[path] = load_sections(path)
+    # Ogni sezione viene estratta da sola, quindi il risultato di ogni sezione è un delta rispetto al contenitore vuoto
+    deltas, pending = {}, []
+    for path, docs in documents.items():
+        for section, doc in docs.items():
+            section_id = f"{path}#{section}"
+            match = reusable_match(section_dedup_index().lookup(doc['page_content']))
+            if match is not None:
+                deltas[section_id] = match["result"]
+                if match["new_sentences"]:
+                    pending.append({"id": section_id, "text": "\n".join(match["new_sentences"]), "source": path})
+                continue
+            known_entities = gazetteer.extract(doc['page_content'], empty_entities)
+            if known_entities is not None:
+                deltas[section_id] = json_delta(empty_entities, known_entities)
+            else:
+                pending.append({"id": section_id, "text": doc['page_content'], "source": path})
+
+    # Le sezioni rimaste, anche di menu diversi, vengono inviate al LLM più alla volta:
+    # prima al modello economico, poi al modello più forte quelle instradate lì e quelle fallite o incomplete
+    cheap_pending, strong_pending, features = router.partition(pending)
+    start = time.perf_counter()
+    results = await cheap_batch_extractor.aextract(cheap_pending)
+    cheap_seconds = (time.perf_counter() - start) / max(len(cheap_pending), 1)
+    escalated = {}
+    for section in cheap_pending:
+        if section["id"] not in results:
+            escalated[section["id"]] = "invalid"
+        elif menu_looks_incomplete(results[section["id"]], features[section["id"]]):
+            escalated[section["id"]] = "incomplete"
+            del results[section["id"]]
+        else:
+            router.observe("cheap", cheap_seconds, True, features[section["id"]])
+    strong_sections = strong_pending + [section for section in cheap_pending if section["id"] in escalated]
+    start = time.perf_counter()
+    results.update(await batch_extractor.aextract(strong_sections))
+    strong_seconds = (time.perf_counter() - start) / max(len(strong_sections), 1)
+    for section in strong_sections:
+        if section["id"] in escalated:
+            router.observe("escalated", cheap_seconds + strong_seconds, section["id"] in results, features[section["id"]], escalated[section["id"]])
+        else:
+            router.observe("strong", strong_seconds, section["id"] in results, features[section["id"]])
+    print(router.report())
+    for section in pending:
+        if section["id"] in results:
+            delta = json_delta(empty_entities, results[section["id"]].model_dump())
+            gazetteer.learn(section["text"], delta or {})
+            deltas[section["id"]] = merge_menu_delta(deltas.get(section["id"]) or {}, delta)
+    print(f"Batched extraction: {batch_extractor.stats}")
+    gazetteer.save(gazetteer_path)
+
+    for path, docs in documents.items():
+        extracted_entities = apply_json_delta(empty_entities, table_entities[path])
+        for section, doc in docs.items():
+            section_id = f"{path}#{section}"
+            if section_id in batch_extractor.errors:
+                # Le sezioni fallite non entrano nell'indice, così vengono estratte di nuovo alla prossima esecuzione
+                continue
+            section_dedup_index().add(doc['page_content'], path, deltas.get(section_id))
+            extracted_entities = merge_menu_delta(extracted_entities, deltas.get(section_id))
+        save_extracted_entities(path, EntityContainer.model_validate(extracted_entities).model_dump())
+
+async def main(batched=True):
+    global dedup_index
     file_list = os.listdir("cleaned_resources")
     pdf_paths = [os.path.join("cleaned_resources", file) for file in file_list]
-    tasks = [
-        asyncio.create_task(handle_file(path))
-        for path in pdf_paths
-    ]
-    results = await asyncio.gather(*tasks)
-    return results
+    open_outputs()
+    try:
+        if batched:
+            return await handle_files_batched(pdf_paths)
+        tasks = [
+            asyncio.create_task(handle_file(path))
+            for path in pdf_paths
+        ]
+        results = await asyncio.gather(*tasks)
+        return results
+    finally:
+        # Le parti dei file vengono rinominate solo quando sono complete
+        section_writer.close()
+        entity_writer.close()
+        router.log.close()
+        ledger.store.close()
+        if dedup_index is not None:
+            dedup_index.close()
+            dedup_index = None
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -5,6 +5,7 @@ from dotenv import load_dotenv
 
 import galactus
 import optimus_prime
+from graph_schema import GraphSchema
 from resources.demo.llm import llm
 
 load_dotenv()
@@ -80,7 +81,9 @@ async def main():
                                                                 summarize_info = False,
                                                                 summarize_paragraphs = False,
                                                                 additional_prompt= additional_prompt)
-    optimus_prime.create_knowledge_graph(schema)
+    # Vincoli di unicità sugli id dei nodi, creati prima della scrittura così le MERGE usano un indice
+    graph_schema = GraphSchema.from_graph_params(graph_params["allowed_nodes"], graph_params["allowed_relationships"])
+    optimus_prime.create_knowledge_graph(schema, schema=graph_schema)
     print(f"Knowledge graph {os.environ['NEO4J_DB_NAME']} created.")
 
 if __name__ == "__main__":
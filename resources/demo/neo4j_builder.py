@@ -1,8 +1,18 @@
 import json
+import os
 import time
 
 from neo4j import GraphDatabase
 
+from entity_resolution import resolve_extracted_entities
+from graph_schema import GraphSchema, GraphSchemaManager, driver_query
+from graph_sharding import ShardedGraphWriter
+from graph_sink import GraphBatch, Neo4jGraphSink, get_graph_sink
+
+# Chiavi usate dalle MERGE di add_menu_to_batch: il nome, e nome e livello per le licenze
+menu_schema = GraphSchema.from_graph_params(["Pianeta", "Ristorante", "Chef", "Licenza", "Piatto", "Ingrediente", "Tecnica"],
+                                            key_properties=("name",), label_keys={"Licenza": [("name", "level")]})
+
 def create_database_if_not_exists(driver, database_name):
     # Utilizza il database "system" per gestire la creazione di altri database
     with driver.session(database="system") as sys_session:
@@ -17,109 +27,95 @@ def create_database_if_not_exists(driver, database_name):
         else:
             print(f"Database '{database_name}' già esistente.")
 
-def build_neo4j_graph(json_data):
-    # Parametri di connessione (modifica secondo la tua configurazione)
-    uri = "bolt://localhost:7687"
-    user = "neo4j"
-    password = "password"  # Sostituisci con la password corretta
-    database_name = "ingestor"
+def add_menu_to_batch(batch, json_data):
+    # 1. Nodi Pianeta e Ristorante e relazione (Ristorante)-[:LOCALIZZATO_SU]->(Pianeta)
+    planet = {"name": json_data.get("Planet")}
+    restaurant = {"name": json_data.get("Restaurant")}
+    batch.add_node("Pianeta", planet)
+    batch.add_node("Ristorante", restaurant)
+    batch.add_relationship("LOCALIZZATO_SU", "Ristorante", restaurant, "Pianeta", planet)
 
-    driver = GraphDatabase.driver(uri, auth=(user, password))
+    # 2. Nodo Chef e relazione LAVORA_IN
+    chef_data = json_data.get("Chef", {})
+    chef = {"name": chef_data.get("Name")}
+    batch.add_node("Chef", chef)
+    batch.add_relationship("LAVORA_IN", "Chef", chef, "Ristorante", restaurant)
 
-    # Verifica e crea il database se non esiste
-    create_database_if_not_exists(driver, database_name)
+    # 3. Nodi Licenza (identificati da nome e livello) e relazione HA_LICENZA
+    for lic in chef_data.get("Licenses", []):
+        licence = {"name": lic.get("Name"), "level": lic.get("Level")}
+        batch.add_node("Licenza", licence)
+        batch.add_relationship("HA_LICENZA", "Chef", chef, "Licenza", licence)
 
-    with driver.session(database=database_name) as session:
-        # 1. Creazione del nodo Pianeta e del nodo Ristorante
-        planet = json_data.get("Planet")
-        restaurant_name = json_data.get("Restaurant")
+    # 4. Piatti con ingredienti e tecniche, con le relazioni in entrambe le direzioni
+    for dish_data in json_data.get("Dishes", []):
+        dish = {"name": dish_data.get("Name")}
+        batch.add_node("Piatto", dish)
+        batch.add_relationship("SERVITO_IN", "Piatto", dish, "Ristorante", restaurant)
+        batch.add_relationship("PREPARATO_DA", "Piatto", dish, "Chef", chef)
+        batch.add_relationship("PREPARA", "Chef", chef, "Piatto", dish)
+        for ingredient in dish_data.get("Ingredients", []):
+            batch.add_relationship("CONTIENE_INGREDIENTE", "Piatto", dish, "Ingrediente", {"name": ingredient})
+            batch.add_relationship("UTILIZZATO_PER_PREPARARE", "Ingrediente", {"name": ingredient}, "Piatto", dish)
+        for technique in dish_data.get("Techniques", []):
+            batch.add_relationship("APPLICA_TECNICA", "Piatto", dish, "Tecnica", {"name": technique})
+            batch.add_relationship("USATA_PER_PREPARARE", "Tecnica", {"name": technique}, "Piatto", dish)
+    return batch
 
-        session.run("MERGE (p:Pianeta {name: $name})", name=planet)
-        session.run("MERGE (r:Ristorante {name: $name})", name=restaurant_name)
-        # Relazione: (Ristorante)-[:LOCALIZZATO_SU]->(Pianeta)
-        session.run("""
-            MATCH (r:Ristorante {name: $r_name}), (p:Pianeta {name: $p_name})
-            MERGE (r)-[:LOCALIZZATO_SU]->(p)
-        """, r_name=restaurant_name, p_name=planet)
+# Parametri di connessione (modifica secondo la tua configurazione)
+uri = "bolt://localhost:7687"
+user = "neo4j"
+password = "password"  # Sostituisci con la password corretta
 
-        # 2. Creazione del nodo Chef e la relazione LAVORA_IN
-        chef_data = json_data.get("Chef", {})
-        chef_name = chef_data.get("Name")
-        session.run("MERGE (c:Chef {name: $name})", name=chef_name)
-        session.run("""
-            MATCH (c:Chef {name: $c_name}), (r:Ristorante {name: $r_name})
-            MERGE (c)-[:LAVORA_IN]->(r)
-        """, c_name=chef_name, r_name=restaurant_name)
+def menus_to_batch(json_list):
+    batch = GraphBatch()
+    for json_data in json_list:
+        add_menu_to_batch(batch, json_data)
+    return batch
 
-        # 3. Creazione dei nodi Licenza e relazione HA_LICENZA
-        licenses = chef_data.get("Licenses", [])
-        for lic in licenses:
-            lic_name = lic.get("Name")
-            lic_level = lic.get("Level")
-            session.run(
-                "MERGE (l:Licenza {name: $name, level: $level})",
-                name=lic_name, level=lic_level
-            )
-            session.run("""
-                MATCH (c:Chef {name: $c_name}), (l:Licenza {name: $l_name, level: $l_level})
-                MERGE (c)-[:HA_LICENZA]->(l)
-            """, c_name=chef_name, l_name=lic_name, l_level=lic_level)
+def default_graph_sink(database_name="ingestor"):
+    # Con GRAPH_SINK=sqlite:<percorso> il grafo viene scritto in un file SQLite locale
+    if os.environ.get("GRAPH_SINK", "neo4j") != "neo4j":
+        return get_graph_sink()
 
-        # (Opzionale) Se è necessario creare il nodo "Ordine" e la relazione APPARTIENE_ORDINE,
-        # si dovrà prevedere i dati relativi all'ordine. In questo esempio non sono presenti.
+    driver = GraphDatabase.driver(uri, auth=(user, password))
+    # Verifica e crea il database se non esiste
+    create_database_if_not_exists(driver, database_name)
+    # Crea vincoli e indici (se mancano) prima di scrivere
+    print(GraphSchemaManager.format_report(GraphSchemaManager(driver_query(driver, database_name)).ensure(menu_schema)))
+    return Neo4jGraphSink(driver, database_name, close_driver=True)
 
-        # 4. Elaborazione dei piatti
-        dishes = json_data.get("Dishes", [])
-        for dish in dishes:
-            dish_name = dish.get("Name")
-            # Crea il nodo Piatto
-            session.run("MERGE (d:Piatto {name: $name})", name=dish_name)
-            # Relazione: (Piatto)-[:SERVITO_IN]->(Ristorante)
-            session.run("""
-                MATCH (d:Piatto {name: $d_name}), (r:Ristorante {name: $r_name})
-                MERGE (d)-[:SERVITO_IN]->(r)
-            """, d_name=dish_name, r_name=restaurant_name)
-            # Relazione: (Piatto)-[:PREPARATO_DA]->(Chef) e (Chef)-[:PREPARA]->(Piatto)
-            session.run("""
-                MATCH (d:Piatto {name: $d_name}), (c:Chef {name: $c_name})
-                MERGE (d)-[:PREPARATO_DA]->(c)
-            """, d_name=dish_name, c_name=chef_name)
-            session.run("""
-                MATCH (c:Chef {name: $c_name}), (d:Piatto {name: $d_name})
-                MERGE (c)-[:PREPARA]->(d)
-            """, c_name=chef_name, d_name=dish_name)
+def build_neo4j_graph(json_data, sink=None, database_name="ingestor"):
+    build_neo4j_graphs([json_data], sink, resolve_entities=False, database_name=database_name)
 
-            # 4a. Elaborazione degli ingredienti del piatto
-            ingredients = dish.get("Ingredients", [])
-            for ingredient in ingredients:
-                session.run("MERGE (i:Ingrediente {name: $name})", name=ingredient)
-                # Relazioni: (Piatto)-[:CONTIENE_INGREDIENTE]->(Ingrediente)
-                session.run("""
-                    MATCH (d:Piatto {name: $d_name}), (i:Ingrediente {name: $i_name})
-                    MERGE (d)-[:CONTIENE_INGREDIENTE]->(i)
-                """, d_name=dish_name, i_name=ingredient)
-                # Relazione inversa: (Ingrediente)-[:UTILIZZATO_PER_PREPARARE]->(Piatto)
-                session.run("""
-                    MATCH (i:Ingrediente {name: $i_name}), (d:Piatto {name: $d_name})
-                    MERGE (i)-[:UTILIZZATO_PER_PREPARARE]->(d)
-                """, i_name=ingredient, d_name=dish_name)
+def build_neo4j_graphs(json_list, sink=None, resolve_entities=True, database_name="ingestor"):
+    if resolve_entities:
+        # Unifica le varianti di nomi di piatti, ingredienti e tecniche tra tutti i menu prima della scrittura
+        json_list = resolve_extracted_entities(json_list)
+    # Tutti i menu vengono raccolti in un unico batch, così ogni nodo condiviso viene scritto una sola volta
+    batch = menus_to_batch(json_list)
 
-            # 4b. Elaborazione delle tecniche utilizzate per il piatto
-            techniques = dish.get("Techniques", [])
-            for technique in techniques:
-                session.run("MERGE (t:Tecnica {name: $name})", name=technique)
-                # Relazione: (Piatto)-[:APPLICA_TECNICA]->(Tecnica)
-                session.run("""
-                    MATCH (d:Piatto {name: $d_name}), (t:Tecnica {name: $t_name})
-                    MERGE (d)-[:APPLICA_TECNICA]->(t)
-                """, d_name=dish_name, t_name=technique)
-                # Relazione inversa: (Tecnica)-[:USATA_PER_PREPARARE]->(Piatto)
-                session.run("""
-                    MATCH (t:Tecnica {name: $t_name}), (d:Piatto {name: $d_name})
-                    MERGE (t)-[:USATA_PER_PREPARARE]->(d)
-                """, t_name=technique, d_name=dish_name)
+    graph_sink = sink or default_graph_sink(database_name)
+    try:
+        graph_sink.write_batch(batch)
+        print(graph_sink.report())
+    finally:
+        if sink is None:
+            graph_sink.close()
 
-    driver.close()
+def build_sharded_neo4j_graphs(json_list, shard_by="Planet", writer=None, resolve_entities=True, database_prefix="ingestor"):
+    if resolve_entities:
+        json_list = resolve_extracted_entities(json_list)
+    # Ogni pianeta (o ristorante) ha il suo database, creato al primo uso; i database vengono scritti in parallelo
+    graph_writer = writer or ShardedGraphWriter(servers=[{"uri": uri, "username": user, "password": password}],
+                                                database_prefix=database_prefix, schema=menu_schema)
+    try:
+        report = graph_writer.write(json_list, key=lambda json_data: json_data.get(shard_by), to_batch=menus_to_batch,
+                                    source=lambda json_data: json_data.get("file") or json_data.get("Restaurant"))
+        print(ShardedGraphWriter.format_report(report))
+    finally:
+        if writer is None:
+            graph_writer.close()
 
 
 # Esempio di utilizzo:
@@ -0,0 +1,211 @@
+import copy
+import hashlib
+import json
+import re
+import sqlite3
+from typing import Any, List, Optional
+
+import numpy as np
+
+from sketches import MinHash, hash_values
+from text_vectors import normalize_text
+
+DEFAULT_NUM_PERM = 128
+# 16 bands of 8 rows: sections become candidates from a Jaccard similarity of about 0.7
+DEFAULT_BANDS = 16
+DEFAULT_THRESHOLD = 0.8
+SHINGLE_SIZE = 3
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?;])\s+|\n+")
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    Splits a section into sentences and lines, dropping empty ones.
+
+    Parameters:
+    text (str): The section text.
+
+    Returns:
+    List[str]: The sentences, in order.
+    """
+    return [sentence.strip() for sentence in _SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> List[str]:
+    """
+    Returns the word shingles of a normalized text. Texts shorter than one shingle become a single shingle.
+
+    Parameters:
+    text (str): The text.
+    size (int): The number of words per shingle.
+
+    Returns:
+    List[str]: The distinct shingles.
+    """
+    words = normalize_text(text).split()
+    if len(words) <= size:
+        return [" ".join(words)] if words else []
+    return list(dict.fromkeys(" ".join(words[i:i + size]) for i in range(len(words) - size + 1)))
+
+
+def json_delta(before: Any, after: Any) -> Any:
+    """
+    Computes what an extraction step added to a JSON-like result: new list items, changed scalars and, recursively, the delta of nested objects.
+    Empty deltas are returned as None.
+
+    Parameters:
+    before (Any): The result before the step.
+    after (Any): The result after the step.
+
+    Returns:
+    Any: The delta, to be replayed with apply_json_delta.
+    """
+    if isinstance(after, dict):
+        before = before if isinstance(before, dict) else {}
+        delta = {key: json_delta(before.get(key), value) for key, value in after.items()}
+        delta = {key: value for key, value in delta.items() if value is not None}
+        return delta or None
+    if isinstance(after, list):
+        before = before if isinstance(before, list) else []
+        added = [item for item in after if item not in before]
+        return added or None
+    if after == before or after in (None, ""):
+        return None
+    return after
+
+
+def apply_json_delta(target: Any, delta: Any) -> Any:
+    """
+    Replays a delta computed by json_delta on another result. List items are appended when missing and scalars only fill empty values,
+    so what was already extracted is never overwritten.
+
+    Parameters:
+    target (Any): The result to update. It is not modified.
+    delta (Any): The delta.
+
+    Returns:
+    Any: The updated result.
+    """
+    if delta is None:
+        return copy.deepcopy(target)
+    if isinstance(delta, dict):
+        result = copy.deepcopy(target) if isinstance(target, dict) else {}
+        for key, value in delta.items():
+            result[key] = apply_json_delta(result.get(key), value)
+        return result
+    if isinstance(delta, list):
+        result = copy.deepcopy(target) if isinstance(target, list) else []
+        result.extend(copy.deepcopy(item) for item in delta if item not in result)
+        return result
+    return delta if target in (None, "") else target
+
+
+def _digest(text: str) -> str:
+    return hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class SectionDedupIndex:
+
+    def __init__(self, path: str, num_perm: int = DEFAULT_NUM_PERM, bands: int = DEFAULT_BANDS, threshold: float = DEFAULT_THRESHOLD):
+        """
+        Initializes the SectionDedupIndex class, a MinHash LSH index over the sections already sent to the LLM, persisted in SQLite so it
+        survives across ingestion runs. Every section is stored with its extraction result, so near-duplicates can reuse it.
+
+        Parameters:
+        path (str): The path to the SQLite file. It is created if missing.
+        num_perm (int): The number of MinHash permutations. It must not change once the index is created.
+        bands (int): The number of LSH bands. It must divide num_perm.
+        threshold (float): The minimum estimated Jaccard similarity of the shingles for a section to be a near-duplicate.
+        """
+        if num_perm % bands:
+            raise ValueError(f"The number of bands ({bands}) must divide the number of permutations ({num_perm}).")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.threshold = threshold
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sections ("
+                                "id INTEGER PRIMARY KEY, digest TEXT NOT NULL UNIQUE, source TEXT, signature BLOB NOT NULL, sentences TEXT NOT NULL, result TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS bands (bucket INTEGER NOT NULL, section_id INTEGER NOT NULL, PRIMARY KEY (bucket, section_id)) WITHOUT ROWID")
+        self.connection.commit()
+
+    def _signature(self, text: str) -> np.ndarray:
+        minhash = MinHash(self.num_perm)
+        minhash.update(hash_values(shingles(text)))
+        return minhash.signature
+
+    def _buckets(self, signature: np.ndarray) -> List[int]:
+        # One signed 64-bit bucket per band, so all bands are probed with a single indexed IN query
+        return [int.from_bytes(hashlib.blake2b(band.to_bytes(2, "little") + rows.tobytes(), digest_size=8).digest(), "little", signed=True)
+                for band, rows in enumerate(signature.reshape(self.bands, -1))]
+
+    def lookup(self, text: str) -> Optional[dict]:
+        """
+        Finds the most similar section already in the index.
+
+        Parameters:
+        text (str): The section text.
+
+        Returns:
+        Optional[dict]: None when no section reaches the threshold. Otherwise the "id", "source", estimated "similarity" and stored "result"
+        of the match, the "new_sentences" of text that the match does not contain and the "removed_sentences" of the match missing from text.
+        The result of a match with removed sentences may hold entities text no longer mentions, so it should not be reused as is.
+        """
+        row = self.connection.execute("SELECT id, source, sentences, result FROM sections WHERE digest = ?", (_digest(text),)).fetchone()
+        if row is not None:
+            return {"id": row[0], "source": row[1], "similarity": 1.0, "result": json.loads(row[3]) if row[3] else None, "new_sentences": [],
+                    "removed_sentences": []}
+
+        signature = self._signature(text)
+        buckets = self._buckets(signature)
+        candidates = self.connection.execute(f"SELECT id, source, signature, sentences, result FROM sections WHERE id IN "
+                                             f"(SELECT section_id FROM bands WHERE bucket IN ({','.join('?' * len(buckets))}))", buckets).fetchall()
+        if not candidates:
+            return None
+        similarities = (np.stack([np.frombuffer(candidate[2], dtype=np.uint64) for candidate in candidates]) == signature).mean(axis=1)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        match = candidates[best]
+        known = json.loads(match[3])
+        known_set = set(known)
+        sentences = split_sentences(text)
+        current = {normalize_text(sentence) for sentence in sentences}
+        return {"id": match[0],
+                "source": match[1],
+                "similarity": float(similarities[best]),
+                "result": json.loads(match[4]) if match[4] else None,
+                "new_sentences": [sentence for sentence in sentences if normalize_text(sentence) not in known_set],
+                "removed_sentences": [sentence for sentence in known if sentence not in current]}
+
+    def add(self, text: str, source: str, result: Any) -> int:
+        """
+        Adds a processed section with its extraction result. A section with the same normalized text replaces the previous one.
+
+        Parameters:
+        text (str): The section text.
+        source (str): The file the section comes from.
+        result (Any): The JSON-serializable extraction result to reuse for near-duplicates.
+
+        Returns:
+        int: The id of the section.
+        """
+        digest = _digest(text)
+        signature = self._signature(text)
+        sentences = json.dumps([normalize_text(sentence) for sentence in split_sentences(text)], ensure_ascii=False)
+        with self.connection:
+            previous = self.connection.execute("SELECT id FROM sections WHERE digest = ?", (digest,)).fetchone()
+            if previous is not None:
+                self.connection.execute("DELETE FROM bands WHERE section_id = ?", (previous[0],))
+                self.connection.execute("DELETE FROM sections WHERE id = ?", (previous[0],))
+            cursor = self.connection.execute("INSERT INTO sections (digest, source, signature, sentences, result) VALUES (?, ?, ?, ?, ?)",
+                                             (digest, source, signature.tobytes(), sentences, json.dumps(result, ensure_ascii=False)))
+            self.connection.executemany("INSERT OR IGNORE INTO bands (bucket, section_id) VALUES (?, ?)",
+                                        [(bucket, cursor.lastrowid) for bucket in self._buckets(signature)])
+        return cursor.lastrowid
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM sections").fetchone()[0]
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,125 @@
+import hashlib
+from functools import lru_cache
+from typing import Iterable
+
+import numpy as np
+
+MAX_HASH = np.uint64(np.iinfo(np.uint64).max)
+UPDATE_CHUNK = 8192
+
+
+def hash_values(values: Iterable[str]) -> np.ndarray:
+    """
+    Hashes strings to 64-bit unsigned integers, stable across processes (unlike the builtin hash).
+
+    Parameters:
+    values (Iterable[str]): The values to hash.
+
+    Returns:
+    np.ndarray: The uint64 hashes.
+    """
+    return np.fromiter((int.from_bytes(hashlib.blake2b(str(v).encode("utf-8"), digest_size=8).digest(), "little") for v in values),
+                       dtype=np.uint64)
+
+
+@lru_cache(maxsize=None)
+def _permutation_seeds(num_perm: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer: a plain a * x + b permutation is too correlated for min-wise hashing
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+class MinHash:
+    """
+    MinHash signature of a set. Signatures built with the same num_perm and seed can be compared to estimate Jaccard similarity.
+    """
+
+    def __init__(self, num_perm: int = 128, seed: int = 1):
+        self.num_perm = num_perm
+        self.seed = seed
+        self.signature = np.full(num_perm, MAX_HASH, dtype=np.uint64)
+
+    def update(self, hashes: np.ndarray) -> None:
+        """
+        Adds hashed values (see hash_values) to the set.
+        """
+        seeds = _permutation_seeds(self.num_perm, self.seed)
+        for start in range(0, len(hashes), UPDATE_CHUNK):
+            chunk = hashes[start:start + UPDATE_CHUNK, None]
+            np.minimum(self.signature, _mix(chunk ^ seeds).min(axis=0), out=self.signature)
+
+    def jaccard(self, other: "MinHash") -> float:
+        """
+        Estimates the Jaccard similarity with another signature.
+        """
+        return float(np.mean(self.signature == other.signature))
+
+    def is_empty(self) -> bool:
+        return bool(np.all(self.signature == MAX_HASH))
+
+
+class HyperLogLog:
+    """
+    HyperLogLog cardinality sketch with 2**p one-byte registers.
+    """
+
+    def __init__(self, p: int = 12):
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    @staticmethod
+    def _bit_length(values: np.ndarray) -> np.ndarray:
+        # frexp is exact on 32-bit halves, so the high and low words are measured separately
+        high = (values >> np.uint64(32)).astype(np.float64)
+        low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+        return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+
+    def update(self, hashes: np.ndarray) -> None:
+        """
+        Adds hashed values (see hash_values) to the sketch.
+        """
+        if len(hashes) == 0:
+            return
+        width = 64 - self.p
+        index = (hashes >> np.uint64(width)).astype(np.int64)
+        remainder = hashes & np.uint64((1 << width) - 1)
+        rank = (width - self._bit_length(remainder) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other: "HyperLogLog") -> None:
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self) -> float:
+        """
+        Estimates the number of distinct values added.
+        """
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            return m * np.log(m / zeros)
+        return float(estimate)
+
+
+def containment(jaccard: float, size_a: float, size_b: float) -> float:
+    """
+    Estimates the fraction of set A contained in set B from their Jaccard similarity and cardinalities.
+
+    Parameters:
+    jaccard (float): The Jaccard similarity of A and B.
+    size_a (float): The cardinality of A.
+    size_b (float): The cardinality of B.
+
+    Returns:
+    float: The estimated |A ∩ B| / |A|, capped at 1.
+    """
+    if size_a <= 0:
+        return 0.0
+    return min(1.0, jaccard * (size_a + size_b) / ((1 + jaccard) * size_a))
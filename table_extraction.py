@@ -0,0 +1,284 @@
+import json
+import re
+from typing import Any, Iterable, Iterator, List, Optional, Union
+
+from graph_sink import GraphBatch
+from text_vectors import normalize_text
+
+DEFAULT_ID_PROPERTY = "name"
+DEFAULT_SEPARATOR = ","
+# Pseudo-columns a mapping can read besides the table header
+GROUP_COLUMN = "_group"
+SECTION_COLUMN = "_section"
+_INTEGER = re.compile(r"[+-]?(?:0|[1-9]\d*)")
+_DECIMAL = re.compile(r"[+-]?\d{1,3}(?:\.\d{3})*,\d+|[+-]?\d+(?:[.,]\d+)?")
+_CURRENCY = re.compile(r"^[€$£]\s*|\s*(?:[€$£]|eur|euro)$", re.IGNORECASE)
+
+
+def _cell_text(value: Any) -> str:
+    # Cells holding a paragraph come as a nested block
+    if isinstance(value, dict):
+        return "\n".join(value.get("sentences", []))
+    return "" if value is None else str(value)
+
+
+def parse_value(text: str) -> Union[None, int, float, str]:
+    """
+    Types a table cell: integers and decimal numbers, with an optional currency symbol and a comma or point as decimal separator,
+    become numbers, empty cells become None and everything else stays a string. Zero-padded codes are kept as strings.
+
+    Parameters:
+    text (str): The cell text.
+
+    Returns:
+    Union[None, int, float, str]: The typed value.
+    """
+    text = text.strip()
+    if not text:
+        return None
+    number = _CURRENCY.sub("", text)
+    if _INTEGER.fullmatch(number):
+        return int(number)
+    if number.lstrip("+-").isdigit():
+        return text
+    if _DECIMAL.fullmatch(number):
+        if "," in number:
+            number = number.replace(".", "").replace(",", ".")
+        return float(number)
+    return text
+
+
+def _is_label_row(cells: List[str]) -> bool:
+    values = [parse_value(cell) for cell in cells]
+    return all(isinstance(value, str) for value in values) and len({normalize_text(value) for value in values}) == len(values)
+
+
+def parse_table(block: dict, header_hint: Optional[List[str]] = None, section: Optional[str] = None) -> dict:
+    """
+    Turns an LLM Sherpa table block into typed rows.
+    The header is, in order of preference: the rows Sherpa marks as table_header, the list items right before the table when there is one per column
+    (as build_flat_json assumes), or the first row when it only holds distinct labels and a later row holds numbers or empty cells.
+    Full-width rows are captions grouping the rows below them.
+
+    Parameters:
+    block (dict): The table block.
+    header_hint (List[str]): The list items that precede the table.
+    section (str): The title of the section of the table.
+
+    Returns:
+    dict: The "title" and "section" of the table, its "header", where the header comes from ("header_source") and the "rows",
+    each a dict of typed values by column plus the GROUP_COLUMN caption and the SECTION_COLUMN title.
+    """
+    header_rows, data_rows, groups, group = [], [], [], None
+    for row in block.get("table_rows", []):
+        if row.get("type") == "full_row" or "cells" not in row:
+            group = _cell_text(row.get("cell_value")).strip() or None
+            continue
+        cells = [_cell_text(cell.get("cell_value")).strip() for cell in row.get("cells", [])]
+        if row.get("type") == "table_header" and not data_rows:
+            header_rows.append(cells)
+            continue
+        data_rows.append(cells)
+        groups.append(group)
+
+    columns = max((len(cells) for cells in header_rows + data_rows), default=0)
+    header, header_source = None, None
+    if header_rows:
+        # Multi-line headers are joined column by column
+        header = [" ".join(cells[i] for cells in header_rows if i < len(cells) and cells[i]) for i in range(columns)]
+        header_source = "table"
+    elif header_hint and len(header_hint) == columns:
+        header, header_source = [item.strip() for item in header_hint], "list_items"
+    elif len(data_rows) > 1 and _is_label_row(data_rows[0]) and any(not isinstance(parse_value(cell), str) for cells in data_rows[1:] for cell in cells):
+        header, header_source = data_rows[0], "first_row"
+        data_rows, groups = data_rows[1:], groups[1:]
+    if header is None:
+        header = [f"col_{i + 1}" for i in range(columns)]
+    header = [name or f"col_{i + 1}" for i, name in enumerate(header)]
+
+    rows = []
+    for cells, row_group in zip(data_rows, groups):
+        row = {name: parse_value(cells[i]) if i < len(cells) else None for i, name in enumerate(header)}
+        row[GROUP_COLUMN] = row_group
+        row[SECTION_COLUMN] = section
+        rows.append(row)
+    return {"title": "\n".join(block.get("sentences", [])), "section": section, "header": header, "header_source": header_source,
+            "page_idx": block.get("page_idx"), "rows": rows}
+
+
+def iter_document_tables(blocks: Iterable[dict]) -> Iterator[dict]:
+    """
+    Parses the tables of a document, with the list items right before every table as header hint and the section they belong to.
+    Sections start at headers of level 0 or 1, like in build_flat_json.
+
+    Parameters:
+    blocks (Iterable[dict]): The LLM Sherpa blocks.
+
+    Returns:
+    Iterator[dict]: The tables parsed with parse_table, in document order.
+    """
+    section, pending_list_items = None, []
+    for block in blocks:
+        tag = block.get("tag", "")
+        if tag == "header" and block.get("level", 0) <= 1:
+            section, pending_list_items = "\n".join(block.get("sentences", [])), []
+        elif tag == "list_item":
+            pending_list_items.append("\n".join(block.get("sentences", [])))
+        elif tag == "table":
+            yield parse_table(block, pending_list_items, section)
+            pending_list_items = []
+        elif tag != "header":
+            pending_list_items = []
+
+
+def load_table_mapping(path: str) -> dict:
+    """
+    Loads a declarative table-to-entity mapping file.
+
+    The mapping is a JSON object with a "tables" list, in the format of csv_graph_loader. Every entry lists the "columns" a table header
+    must contain for the entry to apply (compared after normalization), and the "nodes" and "relationships" produced by each row:
+    a node has a "label", a "key" column and a "properties" object mapping graph properties to columns; a relationship has a "type",
+    "from" and "to" endpoints (each with "label" and "key") and optional "properties". Keys with a "split" separator produce one node per item.
+    An optional "container" object fills a list field of an EntityContainer instead: its "field", a dotted path for the list field of a nested
+    object (e.g. "Chef.Licenses"), the "item" object mapping item fields to columns, and the item fields that are "lists" of separated values. The top-level "id_property" names the key property of the nodes, "name" by default.
+
+    Parameters:
+    path (str): The path to the mapping file.
+
+    Returns:
+    dict: The mapping.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        mapping = json.load(f)
+    if not mapping.get("tables"):
+        raise ValueError(f"Mapping {path} does not define any table.")
+    return mapping
+
+
+def _nest(containers: dict, field: str, items: List[dict]) -> dict:
+    # "Chef.Licenses" fills containers["Chef"]["Licenses"]
+    *parents, name = field.split(".")
+    node = containers
+    for parent in parents:
+        node = node.setdefault(parent, {})
+    node.setdefault(name, []).extend(item for item in items if item not in node.get(name, []))
+    return containers
+
+
+def _split(value: Any, separator: Optional[str]) -> List[Any]:
+    if value is None:
+        return []
+    if separator is None or not isinstance(value, str):
+        return [value]
+    return [item.strip() for item in value.split(separator) if item.strip()]
+
+
+class TableMapper:
+
+    def __init__(self, mapping: dict):
+        """
+        Initializes the TableMapper class, turning the tables matched by a mapping into graph elements or EntityContainer fields without the LLM.
+
+        Parameters:
+        mapping (dict): The mapping, see load_table_mapping.
+        """
+        self.mapping = mapping
+        self.id_property = mapping.get("id_property", DEFAULT_ID_PROPERTY)
+        self.stats = {"tables": 0, "mapped_tables": 0, "rows": 0}
+
+    def match(self, table: dict) -> Optional[dict]:
+        """
+        Returns the first mapping entry whose columns are all in the header of a parsed table, or None.
+        """
+        columns = {normalize_text(name): name for name in table["header"]}
+        for entry in self.mapping["tables"]:
+            if entry.get("columns") and all(normalize_text(column) in columns for column in entry["columns"]):
+                return entry
+        return None
+
+    def handles(self, block: dict, header_hint: Optional[List[str]] = None) -> bool:
+        """
+        Tells whether a table block is mapped, i.e. whether it can be left out of the text sent to the LLM.
+        Meant as the exclude_tables callback of pdf_loader.build_flat_json.
+        """
+        return self.match(parse_table(block, header_hint)) is not None
+
+    @staticmethod
+    def _column(row: dict, column: str) -> Any:
+        if column in row:
+            return row[column]
+        normalized = normalize_text(column)
+        return next((value for name, value in row.items() if normalize_text(name) == normalized), None)
+
+    def add_to_batch(self, table: dict, batch: GraphBatch) -> int:
+        """
+        Adds the nodes and relationships of the rows of a parsed table to a batch.
+
+        Returns:
+        int: The number of rows mapped, 0 when no mapping entry matches the table.
+        """
+        entry = self.match(table)
+        if entry is None:
+            return 0
+        for row in table["rows"]:
+            for node in entry.get("nodes", []):
+                properties = {name: self._column(row, column) for name, column in node.get("properties", {}).items() if self._column(row, column) is not None}
+                for key in _split(self._column(row, node["key"]), node.get("split")):
+                    batch.add_node(node["label"], {self.id_property: key}, properties)
+            for rel in entry.get("relationships", []):
+                properties = {name: self._column(row, column) for name, column in rel.get("properties", {}).items() if self._column(row, column) is not None}
+                for source in _split(self._column(row, rel["from"]["key"]), rel["from"].get("split")):
+                    for target in _split(self._column(row, rel["to"]["key"]), rel["to"].get("split")):
+                        batch.add_relationship(rel["type"], rel["from"]["label"], {self.id_property: source}, rel["to"]["label"], {self.id_property: target}, properties)
+        return len(table["rows"])
+
+    def to_container(self, table: dict) -> Optional[dict]:
+        """
+        Maps the rows of a parsed table to a partial EntityContainer, e.g. {"Dishes": [...]} or {"Chef": {"Licenses": [...]}},
+        to be merged with section_dedup.apply_json_delta.
+
+        Returns:
+        Optional[dict]: The partial container, or None when no mapping entry with a "container" matches the table.
+        """
+        entry = self.match(table)
+        if entry is None or "container" not in entry:
+            return None
+        return _nest({}, entry["container"]["field"], self._container_items(table, entry["container"]))
+
+    def _container_items(self, table: dict, container: dict) -> List[dict]:
+        lists = set(container.get("lists", []))
+        items = []
+        for row in table["rows"]:
+            item = {}
+            for field, column in container["item"].items():
+                value = self._column(row, column)
+                item[field] = _split(value, container.get("separator", DEFAULT_SEPARATOR)) if field in lists else ("" if value is None else str(value))
+            if any(item.values()):
+                items.append(item)
+        return items
+
+    def extract(self, blocks: Iterable[dict], batch: Optional[GraphBatch] = None) -> dict:
+        """
+        Maps every table of a document.
+
+        Parameters:
+        blocks (Iterable[dict]): The LLM Sherpa blocks.
+        batch (GraphBatch): If given, the nodes and relationships of the mapped tables are added to it.
+
+        Returns:
+        dict: The "container" fields of the mapped tables, merged in document order, and the "unmapped" tables, which still need the LLM.
+        """
+        containers, unmapped = {}, []
+        for table in iter_document_tables(blocks):
+            self.stats["tables"] += 1
+            entry = self.match(table)
+            if entry is None:
+                unmapped.append(table)
+                continue
+            self.stats["mapped_tables"] += 1
+            self.stats["rows"] += len(table["rows"])
+            if batch is not None:
+                self.add_to_batch(table, batch)
+            if "container" in entry:
+                _nest(containers, entry["container"]["field"], self._container_items(table, entry["container"]))
+        return {"container": containers, "unmapped": unmapped}
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from artifact_io import ArtifactWriter, artifact_paths, iter_artifact
+
+
+@pytest.mark.parametrize("format", ["jsonl", "parquet"])
+def test_part_rotation(tmp_path, format):
+    records = [{"id": i, "text": f"section {i}"} for i in range(7)]
+    with ArtifactWriter(str(tmp_path), "sections", format=format, max_records=3, row_group_size=2) as writer:
+        writer.write_many(records)
+    assert [os.path.basename(path) for path in writer.parts] == [f"sections-{i:05d}.{format}" for i in range(3)]
+    assert list(iter_artifact(str(tmp_path), "sections")) == records
+
+
+def test_new_run_does_not_overwrite(tmp_path):
+    for run in range(2):
+        with ArtifactWriter(str(tmp_path), "entities") as writer:
+            writer.write({"run": run})
+    assert [os.path.basename(path) for path in artifact_paths(str(tmp_path), "entities")] == ["entities-00000.jsonl", "entities-00001.jsonl"]
+    assert list(iter_artifact(str(tmp_path), "entities")) == [{"run": 0}, {"run": 1}]
+
+
+def test_parquet_schema_widening(tmp_path):
+    records = [{"id": 1, "price": 10}, {"id": 2, "price": 12},
+               {"id": 3, "price": 9.5, "chef": "Lyra"}, {"id": 4, "price": None, "chef": None},
+               {"id": 5, "price": 7, "dish": {"Name": "Zuppa", "Ingredients": ["Polvere di Stelle"]}}]
+    with ArtifactWriter(str(tmp_path), "sections", format="parquet", row_group_size=2) as writer:
+        writer.write_many(records)
+    # Every row group with new columns or wider types starts a new part
+    assert len(writer.parts) == 3
+    expected = [{"chef": None, "dish": None, **record} for record in records]
+    assert [{"chef": None, "dish": None, **record} for record in iter_artifact(str(tmp_path), "sections")] == expected
+
+
+def test_parquet_mixed_scalar_types(tmp_path):
+    records = [{"a": 3}, {"a": "str"}, {"a": None}, {"a": 1.5}]
+    with ArtifactWriter(str(tmp_path), "sections", format="parquet", row_group_size=2) as writer:
+        writer.write_many(records)
+    assert list(iter_artifact(str(tmp_path), "sections")) == records
+
+
+@pytest.mark.parametrize("format", ["jsonl", "parquet"])
+def test_discard(tmp_path, format):
+    writer = ArtifactWriter(str(tmp_path), "sections", format=format, max_records=2, row_group_size=1)
+    writer.write_many([{"id": i} for i in range(3)])
+    writer.discard()
+    assert writer.close() == [str(tmp_path / f"sections-00000.{format}")]
+    assert sorted(os.listdir(tmp_path)) == [f"sections-00000.{format}"]
+    assert list(iter_artifact(str(tmp_path), "sections")) == [{"id": 0}, {"id": 1}]
+
+
+def test_error_discards_current_part(tmp_path):
+    with pytest.raises(RuntimeError):
+        with ArtifactWriter(str(tmp_path), "sections") as writer:
+            writer.write({"id": 0})
+            raise RuntimeError("interrupted")
+    assert os.listdir(tmp_path) == []
+
+
+def test_unsupported_format(tmp_path):
+    with pytest.raises(ValueError):
+        ArtifactWriter(str(tmp_path), "sections", format="csv")
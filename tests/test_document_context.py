@@ -0,0 +1,20 @@
+import json
+
+import pytest
+
+pytest.importorskip("langchain_experimental")
+from langchain_experimental.graph_transformers.llm import get_default_prompt
+
+from optimus_prime import document_context_instructions
+
+
+def test_json_document_context_is_not_a_template_variable():
+    document_context = json.dumps({"Restaurant": "Anima Cosmica", "Chef": {"Name": "Lyra"}})
+    messages = get_default_prompt(document_context_instructions(document_context)).format_messages(input="Piatto: Pasta")
+    assert any(document_context in message.content for message in messages)
+    assert any("Piatto: Pasta" in message.content for message in messages)
+
+
+def test_no_document_context():
+    assert document_context_instructions(None) == ""
+    assert document_context_instructions("") == ""
@@ -0,0 +1,78 @@
+from gazetteer import AhoCorasick, Gazetteer
+
+EMPTY = {"Restaurant": "", "Chef": {"Name": "", "Licenses": []}, "Dishes": [], "Planet": ""}
+CONTAINER = {"Restaurant": "Anima Cosmica", "Chef": {"Name": "Lyra Stellaris", "Licenses": [{"Name": "Psionica", "Level": "II"}]},
+             "Dishes": [{"Name": "Zuppa di Nebulosa", "Ingredients": ["Polvere di Stelle", "Carne di Drago"], "Techniques": ["Sferificazione"]}],
+             "Planet": "Pandora"}
+
+
+def gazetteer():
+    gazetteer = Gazetteer()
+    gazetteer.add_container(CONTAINER)
+    return gazetteer
+
+
+def test_aho_corasick_overlapping_matches():
+    automaton = AhoCorasick()
+    automaton.add(["carne", "di", "drago"], "dish")
+    automaton.add(["di", "drago"], "suffix")
+    automaton.add(["drago"], "word")
+    matches = sorted(automaton.iter_matches("la carne di drago e il drago".split()))
+    assert matches == [(1, 4, "dish"), (2, 4, "suffix"), (3, 4, "word"), (6, 7, "word")]
+
+
+def test_aho_corasick_rebuilds_after_add():
+    automaton = AhoCorasick()
+    automaton.add(["a", "b"], 1)
+    assert list(automaton.iter_matches(["a", "b", "c"])) == [(0, 2, 1)]
+    automaton.add(["b", "c"], 2)
+    assert list(automaton.iter_matches(["a", "b", "c"])) == [(0, 2, 1), (1, 3, 2)]
+
+
+def test_tag_known_and_unexplained():
+    tagged = gazetteer().tag("La Zuppa di Nebulosa dello chef Lyra Stellaris, con Spezie Oscure.")
+    assert [(kind, name) for kind, name, _, _ in tagged["matches"]] == [("Dish", "Zuppa di Nebulosa"), ("Chef", "Lyra Stellaris")]
+    assert tagged["unexplained"] == ["Spezie Oscure"]
+
+
+def test_tag_leftmost_longest():
+    tagged = gazetteer().tag("carne di drago")
+    assert [(kind, name, start, end) for kind, name, start, end in tagged["matches"]] == [("Ingredient", "Carne di Drago", 0, 14)]
+
+
+def test_extract_known_section():
+    text = "Zuppa di Nebulosa: Polvere di Stelle e Carne di Drago, servita con Sferificazione."
+    result = gazetteer().extract(text, EMPTY)
+    assert result["Dishes"] == [{"Name": "Zuppa di Nebulosa", "Ingredients": ["Polvere di Stelle", "Carne di Drago"], "Techniques": ["Sferificazione"]}]
+    assert EMPTY["Dishes"] == []
+
+
+def test_extract_needs_llm():
+    known = gazetteer()
+    assert known.extract("Zuppa di Nebulosa con Radice Lunare.", EMPTY) is None
+    # A licence of unknown level cannot be filled in without the LLM
+    known.add("License", "Telepatia")
+    assert known.extract("Lyra Stellaris ha la licenza Telepatia.", EMPTY) is None
+    assert known.stats == {"sections": 2, "skipped": 0}
+
+
+def test_learn_entities_and_common_spans():
+    known = gazetteer()
+    text = "Benvenuti Viaggiatori! Provate il Gelato di Cometa."
+    known.learn(text, {**EMPTY, "Dishes": [{"Name": "Gelato di Cometa", "Ingredients": [], "Techniques": []}]})
+    tagged = known.tag(text)
+    assert ("Dish", "Gelato di Cometa") in [(kind, name) for kind, name, _, _ in tagged["matches"]]
+    assert tagged["unexplained"] == []
+    # Only the whole span is remembered, a new name sharing one of its words is still unexplained
+    assert known.tag("Viaggiatori Galattici")["unexplained"] == ["Viaggiatori Galattici"]
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "gazetteer.json")
+    known = gazetteer()
+    known.learn("Benvenuti Viaggiatori!", EMPTY)
+    known.save(path)
+    loaded = Gazetteer.load(path)
+    assert len(loaded) == len(known)
+    assert loaded.tag("Benvenuti Viaggiatori!")["unexplained"] == []
+    assert loaded.extract("Psionica", EMPTY)["Chef"]["Licenses"] == [{"Name": "Psionica", "Level": "II"}]
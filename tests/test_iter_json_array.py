@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+pytest.importorskip("pikepdf")
+pytest.importorskip("llmsherpa")
+pytest.importorskip("langchain_community")
+from pdf_loader import iter_json_array
+
+BLOCKS = [{"tag": "header", "level": 0, "sentences": ["Menu"]},
+          {"tag": "para", "level": 1, "sentences": ["Pasta [al] {pomodoro}, \"fresca\"", "€ 12"]},
+          {"tag": "list_item", "level": 1, "sentences": []}]
+RESPONSE = json.dumps({"return_dict": {"result": {"blocks": BLOCKS}}}, ensure_ascii=False)
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 64, len(RESPONSE)])
+def test_items_split_across_chunks(size):
+    assert list(iter_json_array(chunked(RESPONSE, size), "blocks")) == BLOCKS
+
+
+def test_key_split_across_chunks():
+    position = RESPONSE.index('"blocks"') + 3
+    assert list(iter_json_array([RESPONSE[:position], RESPONSE[position:]], "blocks")) == BLOCKS
+
+
+def test_empty_array():
+    assert list(iter_json_array(chunked('{"blocks": [ ]}', 3), "blocks")) == []
+
+
+def test_missing_array():
+    with pytest.raises(ValueError):
+        list(iter_json_array(chunked('{"result": {}}', 4), "blocks"))
@@ -0,0 +1,143 @@
+import threading
+import time
+
+import pytest
+
+from parser_pool import ParserPool, ParserResponseError, is_replica_failure
+
+A, B = "http://parser-a/api/parseDocument", "http://parser-b/api/parseDocument"
+
+
+@pytest.fixture
+def make_pool():
+    pools = []
+
+    def make_pool(urls=(A, B), **kwargs):
+        pool = ParserPool(list(urls), **kwargs)
+        pools.append(pool)
+        return pool
+
+    yield make_pool
+    for pool in pools:
+        pool.close()
+
+
+def fake_parser(failing=(), calls=None):
+    def call(url):
+        if calls is not None:
+            calls.append(url)
+        if url in failing:
+            raise ConnectionError(f"{url} is down")
+        return f"parsed by {url}"
+    return call
+
+
+def test_is_replica_failure():
+    assert is_replica_failure(ConnectionError())
+    assert is_replica_failure(ParserResponseError("unavailable", 503))
+    assert not is_replica_failure(ParserResponseError("bad pdf", 400))
+    assert not is_replica_failure(ValueError("not JSON"))
+
+
+def test_failover(make_pool):
+    pool = make_pool(hedge=False)
+    calls = []
+    assert pool.call(fake_parser(failing={A}, calls=calls)) == f"parsed by {B}"
+    assert calls == [A, B]
+    assert pool.stats["failovers"] == 1
+
+
+def test_document_error_is_not_retried(make_pool):
+    pool = make_pool(hedge=False)
+    calls = []
+
+    def call(url):
+        calls.append(url)
+        raise ParserResponseError("bad pdf", 400)
+
+    with pytest.raises(ParserResponseError):
+        pool.call(call)
+    assert calls == [A]
+    assert pool.report()["replicas"][0]["state"] == "closed"
+
+
+def test_all_replicas_failing(make_pool):
+    pool = make_pool(hedge=False)
+    with pytest.raises(ConnectionError):
+        pool.call(fake_parser(failing={A, B}))
+
+
+def test_circuit_breaker(make_pool):
+    pool = make_pool(failure_threshold=2, reset_seconds=0.2, hedge=False)
+    for _ in range(2):
+        pool.call(fake_parser(failing={A}))
+    assert [replica["state"] for replica in pool.report()["replicas"]] == ["open", "closed"]
+    calls = []
+    pool.call(fake_parser(failing={A}, calls=calls))
+    assert calls == [B]
+
+    # After reset_seconds the replica gets a trial request, whose success closes the circuit
+    time.sleep(0.25)
+    assert pool.report()["replicas"][0]["state"] == "half-open"
+    calls = []
+    pool.call(fake_parser(calls=calls))
+    assert calls == [A]
+    assert pool.report()["replicas"][0]["state"] == "closed"
+
+
+def test_no_replica_available(make_pool):
+    pool = make_pool([A], failure_threshold=1, reset_seconds=60)
+    with pytest.raises(ConnectionError):
+        pool.call(fake_parser(failing={A}))
+    with pytest.raises(ValueError, match="No parser replica available"):
+        pool.call(fake_parser())
+
+
+def test_hedging(make_pool):
+    pool = make_pool(hedge_after=0.05)
+    release = threading.Event()
+
+    def call(url):
+        if url == A:
+            release.wait(5)
+        return f"parsed by {url}"
+
+    try:
+        assert pool.call(call) == f"parsed by {B}"
+    finally:
+        release.set()
+    assert pool.stats["hedged"] == 1 and pool.stats["hedges_won"] == 1
+
+
+def test_hedge_delay_from_latencies(make_pool):
+    pool = make_pool(hedge_min_samples=3, hedge_quantile=0.5)
+    assert pool.hedge_delay() is None
+    pool.latencies.extend([0.1, 0.3, 0.2])
+    assert pool.hedge_delay() == 0.2
+    assert make_pool([A]).hedge_delay() is None
+
+
+def test_stream_failover_before_first_item(make_pool):
+    pool = make_pool()
+
+    def stream(url):
+        if url == A:
+            raise ConnectionError(f"{url} is down")
+        yield from ("block 1", "block 2")
+
+    assert list(pool.stream(stream)) == ["block 1", "block 2"]
+    assert pool.stats["failovers"] == 1
+
+
+def test_stream_failure_after_first_item(make_pool):
+    pool = make_pool()
+    calls = []
+
+    def stream(url):
+        calls.append(url)
+        yield "block 1"
+        raise ConnectionError(f"{url} dropped the connection")
+
+    with pytest.raises(ConnectionError):
+        list(pool.stream(stream))
+    assert calls == [A]
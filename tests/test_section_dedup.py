@@ -0,0 +1,68 @@
+import pytest
+
+from section_dedup import SectionDedupIndex, apply_json_delta, json_delta
+
+SECTION = ("Spaghetti della Nebulosa. Pasta fresca tirata a mano con pomodori lunari. "
+           "Il sugo cuoce per sei ore a fuoco lento. Servito con basilico di Marte e olio antico. "
+           "Lo chef consiglia un vino rosso della valle di Orione. Porzione per due persone.")
+RESULT = {"Dishes": [{"Name": "Spaghetti della Nebulosa", "Ingredients": ["Pomodori lunari"], "Techniques": ["Cottura lenta"]}]}
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = SectionDedupIndex(str(tmp_path / "dedup.sqlite"))
+    yield index
+    index.close()
+
+
+def test_exact_duplicate(index):
+    section_id = index.add(SECTION, "menu_a.pdf", RESULT)
+    match = index.lookup("  " + SECTION.upper() + "  ")
+    assert match["id"] == section_id
+    assert match["similarity"] == 1.0
+    assert match["result"] == RESULT
+    assert match["new_sentences"] == [] and match["removed_sentences"] == []
+
+
+def test_near_duplicate_with_added_sentence(index):
+    index.add(SECTION, "menu_a.pdf", RESULT)
+    match = index.lookup(SECTION + " Disponibile anche senza glutine.")
+    assert match is not None and match["similarity"] < 1.0
+    assert match["result"] == RESULT
+    assert match["new_sentences"] == ["Disponibile anche senza glutine."]
+    assert match["removed_sentences"] == []
+
+
+def test_near_duplicate_with_removed_sentence(index):
+    index.add(SECTION, "menu_a.pdf", RESULT)
+    match = index.lookup(SECTION.replace(" Porzione per due persone.", ""))
+    assert match is not None
+    assert match["new_sentences"] == []
+    assert match["removed_sentences"] == ["porzione per due persone"]
+
+
+def test_different_section(index):
+    index.add(SECTION, "menu_a.pdf", RESULT)
+    assert index.lookup("Tiramisù cosmico con mascarpone di cometa e caffè stellare, servito freddo.") is None
+
+
+def test_same_text_replaces_previous(index):
+    index.add(SECTION, "menu_a.pdf", RESULT)
+    index.add(SECTION, "menu_b.pdf", None)
+    assert len(index) == 1
+    assert index.lookup(SECTION)["source"] == "menu_b.pdf"
+
+
+def test_json_delta_round_trip():
+    before = {"Restaurant": "", "Chef": {"Name": "Lyra"}, "Dishes": [{"Name": "A", "Ingredients": ["x"]}]}
+    after = {"Restaurant": "Anima Cosmica", "Chef": {"Name": "Lyra"}, "Dishes": [{"Name": "A", "Ingredients": ["x"]}, {"Name": "B", "Ingredients": []}]}
+    delta = json_delta(before, after)
+    assert delta == {"Restaurant": "Anima Cosmica", "Dishes": [{"Name": "B", "Ingredients": []}]}
+    assert apply_json_delta(before, delta) == after
+    assert json_delta(after, after) is None
+
+
+def test_apply_json_delta_does_not_overwrite():
+    target = {"Restaurant": "Anima Cosmica", "Dishes": []}
+    assert apply_json_delta(target, {"Restaurant": "Altro", "Dishes": [{"Name": "B"}]}) == {"Restaurant": "Anima Cosmica", "Dishes": [{"Name": "B"}]}
+    assert target == {"Restaurant": "Anima Cosmica", "Dishes": []}
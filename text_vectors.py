@@ -0,0 +1,161 @@
+import re
+import unicodedata
+import zlib
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+_NON_ALNUM = re.compile(r"[^0-9a-z]+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes a string for comparison: strips accents, casefolds and collapses punctuation and whitespace.
+
+    Parameters:
+    text (str): The text to normalize.
+
+    Returns:
+    str: The normalized text.
+    """
+    decomposed = unicodedata.normalize("NFKD", str(text))
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return _NON_ALNUM.sub(" ", stripped.casefold()).strip()
+
+
+def char_ngrams(text: str, ngram_range: Tuple[int, int] = (2, 4)) -> List[str]:
+    """
+    Returns the character n-grams of a normalized, space-padded text.
+
+    Parameters:
+    text (str): The text to split.
+    ngram_range (Tuple[int, int]): Minimum and maximum n-gram size, inclusive.
+
+    Returns:
+    List[str]: The character n-grams.
+    """
+    padded = f" {normalize_text(text)} "
+    grams = []
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        grams.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return grams
+
+
+class HashedCharNgramVectorizer:
+    """
+    Character n-gram TF-IDF vectorizer using the hashing trick, so the vocabulary never has to be stored.
+    Vectors are dense float32 rows, L2-normalized, ready for inner-product search with faiss.
+    """
+
+    def __init__(self, n_features: int = 256, ngram_range: Tuple[int, int] = (2, 4), use_idf: bool = True):
+        """
+        Initializes the vectorizer.
+
+        Parameters:
+        n_features (int): Number of hash buckets, i.e. the dimension of the output vectors.
+        ngram_range (Tuple[int, int]): Minimum and maximum character n-gram size.
+        use_idf (bool): Whether to weight buckets by inverse document frequency. When False the vectorizer is stateless.
+        """
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self.use_idf = use_idf
+        self.idf: Optional[np.ndarray] = None
+
+    def _buckets(self, text: str) -> np.ndarray:
+        grams = char_ngrams(text, self.ngram_range)
+        return np.fromiter((zlib.crc32(g.encode("utf-8")) % self.n_features for g in grams), dtype=np.int64, count=len(grams))
+
+    def fit(self, texts: List[str]) -> "HashedCharNgramVectorizer":
+        """
+        Computes the inverse document frequency of every bucket.
+
+        Parameters:
+        texts (List[str]): The corpus.
+
+        Returns:
+        HashedCharNgramVectorizer: The fitted vectorizer.
+        """
+        df = np.zeros(self.n_features, dtype=np.float64)
+        for text in texts:
+            df[np.unique(self._buckets(text))] += 1
+        self.idf = (np.log((1 + len(texts)) / (1 + df)) + 1).astype(np.float32)
+        return self
+
+    def transform(self, texts: List[str], chunk_size: int = 65536) -> np.ndarray:
+        """
+        Vectorizes texts into L2-normalized rows.
+
+        Parameters:
+        texts (List[str]): The texts to vectorize.
+        chunk_size (int): Number of texts filled per step, to bound temporary memory.
+
+        Returns:
+        np.ndarray: A (len(texts), n_features) float32 matrix.
+        """
+        matrix = np.zeros((len(texts), self.n_features), dtype=np.float32)
+        for start in range(0, len(texts), chunk_size):
+            chunk = texts[start:start + chunk_size]
+            buckets = [self._buckets(t) for t in chunk]
+            lengths = np.fromiter((len(b) for b in buckets), dtype=np.int64, count=len(buckets))
+            if lengths.sum() == 0:
+                continue
+            rows = np.repeat(np.arange(start, start + len(chunk)), lengths)
+            np.add.at(matrix, (rows, np.concatenate(buckets)), 1.0)
+        if self.use_idf and self.idf is not None:
+            matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+
+    def fit_transform(self, texts: List[str]) -> np.ndarray:
+        """
+        Fits the vectorizer and vectorizes the same texts.
+
+        Parameters:
+        texts (List[str]): The corpus.
+
+        Returns:
+        np.ndarray: A (len(texts), n_features) float32 matrix.
+        """
+        if self.use_idf:
+            self.fit(texts)
+        return self.transform(texts)
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, n_iter: int = 20, seed: int = 0, chunk_size: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Spherical k-means with k-means++ seeding, for L2-normalized rows such as the ones of HashedCharNgramVectorizer.
+
+    Parameters:
+    vectors (np.ndarray): The (n, d) matrix of normalized vectors.
+    n_clusters (int): The number of clusters. It is capped at the number of rows.
+    n_iter (int): The maximum number of iterations.
+    seed (int): The random seed, for reproducible clusters.
+    chunk_size (int): Number of rows assigned per step, to bound temporary memory.
+
+    Returns:
+    Tuple[np.ndarray, np.ndarray]: The cluster label of every row and the (n_clusters, d) centroids.
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = np.empty((n_clusters, vectors.shape[1]), dtype=np.float32)
+    centroids[0] = vectors[rng.integers(len(vectors))]
+    distances = np.maximum(1 - vectors @ centroids[0], 0).astype(np.float64)
+    for c in range(1, n_clusters):
+        total = distances.sum()
+        choice = rng.choice(len(vectors), p=distances / total) if total > 0 else rng.integers(len(vectors))
+        centroids[c] = vectors[choice]
+        np.minimum(distances, np.maximum(1 - vectors @ centroids[c], 0), out=distances)
+
+    labels = np.full(len(vectors), -1, dtype=np.int64)
+    for _ in range(n_iter):
+        new_labels = np.concatenate([np.argmax(vectors[s:s + chunk_size] @ centroids.T, axis=1) for s in range(0, len(vectors), chunk_size)])
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Empty clusters keep their previous centroid
+        centroids = np.where(norms > 0, sums / np.where(norms > 0, norms, 1), centroids).astype(np.float32)
+    return labels, centroids
@@ -0,0 +1,222 @@
+import json
+import os
+import sqlite3
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from text_vectors import HashedCharNgramVectorizer
+
+INDEX_FILENAME = "sections.faiss"
+# New sections go to a small delta index, merged into the main one once it holds DEFAULT_MERGE_SIZE sections
+DELTA_FILENAME = "sections.delta.faiss"
+DEFAULT_MERGE_SIZE = 10_000
+METADATA_FILENAME = "sections.sqlite"
+DEFAULT_DIMENSION = 512
+
+EmbeddingFunction = Callable[[List[str]], np.ndarray]
+
+
+def hashed_ngram_embedding(n_features: int = DEFAULT_DIMENSION) -> EmbeddingFunction:
+    """
+    Returns a local, stateless embedding function based on hashed character n-grams. It needs no model or network access.
+
+    Parameters:
+    n_features (int): The dimension of the vectors.
+
+    Returns:
+    EmbeddingFunction: A function mapping a list of texts to a float32 matrix.
+    """
+    vectorizer = HashedCharNgramVectorizer(n_features=n_features, use_idf=False)
+    return vectorizer.transform
+
+
+def _section_title(doc: Document) -> str:
+    return doc.metadata.get("section_title", "")
+
+
+class SectionVectorIndex:
+
+    def __init__(self, directory: str, embedding_function: Optional[Union[EmbeddingFunction, Embeddings]] = None, merge_size: int = DEFAULT_MERGE_SIZE):
+        """
+        Initializes the SectionVectorIndex class, a persistent faiss index over the ingested sections.
+        Vectors live in faiss files, while source file, section title and graph node IDs live in a SQLite table keyed by
+        the same IDs. Adding sections only rewrites a small delta index; the main index is rewritten when the delta is merged into it.
+        Replaced sections stay in the main index until the merge, but are no longer in the table, so searches skip them.
+
+        Parameters:
+        directory (str): The directory holding the index files. It is created if missing.
+        embedding_function: A function mapping texts to vectors, or a LangChain Embeddings object. Default is hashed_ngram_embedding().
+        merge_size (int): The number of sections in the delta index, or of replaced sections, after which it is merged into the main index.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, INDEX_FILENAME)
+        self.delta_path = os.path.join(directory, DELTA_FILENAME)
+        self.merge_size = merge_size
+        self.embedding_function = embedding_function or hashed_ngram_embedding()
+        self.metadata = sqlite3.connect(os.path.join(directory, METADATA_FILENAME), check_same_thread=False)
+        # AUTOINCREMENT: the IDs of replaced sections must not be reused while their vectors wait in the main index for a merge
+        schema = self.metadata.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'sections'").fetchone()
+        if schema is not None and "AUTOINCREMENT" not in schema[0]:
+            self.metadata.execute("ALTER TABLE sections RENAME TO sections_old")
+        self.metadata.execute("CREATE TABLE IF NOT EXISTS sections ("
+                              "id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL, section_title TEXT, node_ids TEXT, page_content TEXT)")
+        if schema is not None and "AUTOINCREMENT" not in schema[0]:
+            self.metadata.execute("INSERT INTO sections SELECT * FROM sections_old")
+            self.metadata.execute("DROP TABLE sections_old")
+            self.metadata.commit()
+        self.metadata.execute("CREATE INDEX IF NOT EXISTS sections_source ON sections (source)")
+        self._readers: Dict[str, Tuple[float, faiss.Index]] = {}
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        if isinstance(self.embedding_function, Embeddings):
+            vectors = np.asarray(self.embedding_function.embed_documents(texts), dtype=np.float32)
+        else:
+            vectors = np.asarray(self.embedding_function(texts), dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def _embed_query(self, text: str) -> np.ndarray:
+        if isinstance(self.embedding_function, Embeddings):
+            vector = np.asarray([self.embedding_function.embed_query(text)], dtype=np.float32)
+        else:
+            vector = np.asarray(self.embedding_function([text]), dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+
+    @staticmethod
+    def _load_writable(path: str, dimension: int) -> faiss.Index:
+        if os.path.exists(path):
+            return faiss.read_index(path)
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+
+    @staticmethod
+    def _write(index: faiss.Index, path: str) -> None:
+        # Write next to the live file and swap, so readers never see a partially written index
+        tmp_path = f"{path}.tmp"
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _removed(self) -> int:
+        """
+        Returns the number of vectors of replaced sections, still in the faiss files but no longer in the table.
+        """
+        total = sum(index.ntotal for index in self._indexes())
+        return total - self.metadata.execute("SELECT COUNT(*) FROM sections").fetchone()[0]
+
+    def merge(self) -> None:
+        """
+        Merges the delta index into the main index and drops the vectors of replaced sections. This rewrites the main index.
+        """
+        if not os.path.exists(self.delta_path) and self._removed() <= 0:
+            return
+        delta = faiss.read_index(self.delta_path) if os.path.exists(self.delta_path) else None
+        index = self._load_writable(self.index_path, delta.d if delta is not None else faiss.read_index(self.index_path).d)
+        if delta is not None and delta.ntotal:
+            index.add_with_ids(delta.index.reconstruct_n(0, delta.ntotal), faiss.vector_to_array(delta.id_map))
+        live = {row[0] for row in self.metadata.execute("SELECT id FROM sections")}
+        removed = [i for i in faiss.vector_to_array(index.id_map).tolist() if i not in live]
+        if removed:
+            index.remove_ids(np.asarray(removed, dtype=np.int64))
+        self._write(index, self.index_path)
+        if delta is not None:
+            os.remove(self.delta_path)
+        print(f"Merged the section index: {index.ntotal} sections, {len(removed)} replaced sections dropped")
+
+    def add_documents(self, docs: List[Document], node_ids: Optional[List[List[str]]] = None) -> None:
+        """
+        Adds section documents to the index. Sections previously indexed for the same source files are replaced,
+        so re-ingesting a file does not duplicate its sections.
+
+        Parameters:
+        docs (List[Document]): The section documents, as produced by convert_llmsherpa_dict_to_langchain_doc.
+        node_ids (List[List[str]]): For every document, the IDs of the graph nodes extracted from it.
+
+        Returns:
+        None
+        """
+        if not docs:
+            return
+        node_ids = node_ids or [[] for _ in docs]
+        vectors = self._embed([doc.page_content for doc in docs])
+        index = self._load_writable(self.delta_path, vectors.shape[1])
+
+        sources = sorted({doc.metadata.get("source", "") for doc in docs})
+        placeholders = ",".join("?" * len(sources))
+        stale = [row[0] for row in self.metadata.execute(f"SELECT id FROM sections WHERE source IN ({placeholders})", sources)]
+        if stale:
+            # Stale vectors of the delta are dropped now, those of the main index at the next merge
+            index.remove_ids(np.asarray(stale, dtype=np.int64))
+            self.metadata.execute(f"DELETE FROM sections WHERE source IN ({placeholders})", sources)
+
+        ids = []
+        for doc, nodes in zip(docs, node_ids):
+            cursor = self.metadata.execute("INSERT INTO sections (source, section_title, node_ids, page_content) VALUES (?, ?, ?, ?)",
+                                           (doc.metadata.get("source", ""), _section_title(doc), json.dumps(nodes, ensure_ascii=False), doc.page_content))
+            ids.append(cursor.lastrowid)
+        index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+        self._write(index, self.delta_path)
+        self.metadata.commit()
+        total = self.metadata.execute("SELECT COUNT(*) FROM sections").fetchone()[0]
+        print(f"Indexed {len(docs)} sections from {len(sources)} sources, {total} sections in total")
+        if index.ntotal >= self.merge_size or self._removed() >= self.merge_size:
+            self.merge()
+
+    def _searcher(self, path: str) -> Optional[faiss.Index]:
+        """
+        Returns a read-only view of an index file, memory-mapped where faiss supports it, reopened whenever the file changes.
+        """
+        if not os.path.exists(path):
+            self._readers.pop(path, None)
+            return None
+        mtime = os.path.getmtime(path)
+        cached = self._readers.get(path)
+        if cached is None or cached[0] != mtime:
+            try:
+                reader = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError:
+                reader = faiss.read_index(path, faiss.IO_FLAG_READ_ONLY)
+            cached = self._readers[path] = (mtime, reader)
+        return cached[1]
+
+    def _indexes(self) -> List[faiss.Index]:
+        return [index for index in (self._searcher(self.index_path), self._searcher(self.delta_path)) if index is not None]
+
+    def search(self, query: str, k: int = 5) -> List[dict]:
+        """
+        Finds the sections closest to a query.
+
+        Parameters:
+        query (str): The query text, e.g. an ingredient name.
+        k (int): The number of sections to return.
+
+        Returns:
+        List[dict]: The matching sections with score, source, section_title, node_ids and page_content, best first.
+        """
+        indexes = [index for index in self._indexes() if index.ntotal]
+        if not indexes:
+            return []
+        vector = self._embed_query(query)
+        # Replaced sections may still be among the nearest vectors of the main index, so as many more are fetched
+        fetch = k + max(self._removed(), 0)
+        hits = {}
+        for index in indexes:
+            scores, ids = index.search(vector, min(fetch, index.ntotal))
+            hits.update({int(i): float(s) for i, s in zip(ids[0], scores[0]) if i >= 0})
+        if not hits:
+            return []
+        rows = self.metadata.execute(f"SELECT id, source, section_title, node_ids, page_content FROM sections WHERE id IN ({','.join('?' * len(hits))})",
+                                     list(hits)).fetchall()
+        results = [{"score": hits[row[0]], "source": row[1], "section_title": row[2], "node_ids": json.loads(row[3]), "page_content": row[4]}
+                   for row in rows]
+        return sorted(results, key=lambda r: r["score"], reverse=True)[:k]
+
+    def close(self) -> None:
+        """
+        Merges the delta index into the main index and closes the table.
+        """
+        self.merge()
+        self.metadata.close()